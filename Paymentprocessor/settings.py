@@ -1,6 +1,7 @@
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 from corsheaders.defaults import default_headers
+import copy
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "payments.middleware.MetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -81,13 +83,104 @@ WSGI_APPLICATION = 'Paymentprocessor.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+# (an empty DB_NAME/DB_USER/DB_HOST/DB_PORT in .env falls back to the default)
+
+# "postgres" for production, "sqlite" for single-node installs
+DB_ENGINE = config("DB_ENGINE", default="sqlite")
+
+# seconds a connection is reused across requests (0: close after each
+# request); broken connections are detected before reuse
+DB_CONN_MAX_AGE = config("DB_CONN_MAX_AGE", default=60, cast=int)
+
+if DB_ENGINE == "postgres":
+    # DB_POOL_SIZE > 0 uses psycopg's connection pool instead of persistent
+    # connections, better under ASGI where every thread holds its own
+    # connection. Set DB_DISABLE_SERVER_SIDE_CURSORS behind pgbouncer in
+    # transaction mode (the export streams with server-side cursors).
+    DB_POOL_SIZE = config("DB_POOL_SIZE", default=0, cast=int)
+
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": config("DB_NAME", default="") or "payments",
+            "USER": config("DB_USER", default="") or "payments",
+            "PASSWORD": config("DB_PASSWORD", default=""),
+            "HOST": config("DB_HOST", default="") or "127.0.0.1",
+            "PORT": config("DB_PORT", default="") or "5432",
+            "CONN_MAX_AGE": 0 if DB_POOL_SIZE else DB_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+            "DISABLE_SERVER_SIDE_CURSORS": config("DB_DISABLE_SERVER_SIDE_CURSORS", default=False, cast=bool),
+            "OPTIONS": {
+                "connect_timeout": config("DB_CONNECT_TIMEOUT", default=5, cast=int),
+                "sslmode": config("DB_SSLMODE", default="prefer"),
+                "application_name": config("DB_APPLICATION_NAME", default="payments-processor"),
+            },
+        }
+    }
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+    if DB_POOL_SIZE:
+        DATABASES["default"]["OPTIONS"]["pool"] = {
+            "min_size": config("DB_POOL_MIN_SIZE", default=2, cast=int),
+            "max_size": DB_POOL_SIZE,
+            "timeout": config("DB_POOL_TIMEOUT", default=10, cast=int),
+        }
+else:
+    # WAL lets readers run alongside the writer; IMMEDIATE transactions take
+    # the write lock up front so concurrent callbacks wait for it (up to
+    # DB_SQLITE_BUSY_TIMEOUT) instead of failing with "database is locked"
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": config("DB_NAME", default="") or os.path.join(BASE_DIR, "db.sqlite3"),
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {
+                "timeout": config("DB_SQLITE_BUSY_TIMEOUT", default=20, cast=int),
+                "transaction_mode": "IMMEDIATE",
+                "init_command": (
+                    "PRAGMA journal_mode=WAL;"
+                    "PRAGMA synchronous=NORMAL;"
+                    f"PRAGMA mmap_size={config('DB_SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)};"
+                    "PRAGMA cache_size=-65536;"
+                    "PRAGMA temp_store=MEMORY;"
+                ),
+            },
+            # file-backed test database so threaded tests get real locking
+            "TEST": {
+                "NAME": os.path.join(BASE_DIR, "test_db.sqlite3"),
+            },
+        }
     }
-}
+
+# Read replicas: comma-separated hosts (host or host:port) for postgres,
+# database files for sqlite. Verify and export reads go to them, see
+# payments/routers.py. An app that just wrote, or whose payment just
+# settled, reads from the primary for PAYMENTS_DB_PIN_SECONDS, keep it
+# above the worst replication lag.
+DATABASE_REPLICAS = []
+
+for number, replica in enumerate(config("DB_REPLICAS", default="", cast=Csv()), 1):
+    alias = f"replica{number}"
+    DATABASES[alias] = copy.deepcopy(DATABASES["default"])
+
+    if DB_ENGINE == "postgres":
+        host, _, port = replica.partition(":")
+        DATABASES[alias].update(HOST=host, PORT=port or DATABASES["default"]["PORT"])
+    else:
+        DATABASES[alias]["NAME"] = replica
+
+    # tests read from the primary's test database through a second connection
+    DATABASES[alias]["TEST"] = {"MIRROR": "default"}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ["payments.routers.ReplicaRouter"]
+
+# runs the tests without the connection pool, see payments/test_runner.py
+TEST_RUNNER = "payments.test_runner.PaymentsTestRunner"
+
+PAYMENTS_DB_PIN_SECONDS = config("PAYMENTS_DB_PIN_SECONDS", default=10, cast=int)
+# pins must be seen by every worker, like the API key cache below
+PAYMENTS_DB_PIN_CACHE_ALIAS = config("PAYMENTS_DB_PIN_CACHE_ALIAS", default="default")
 
 
 # Password validation
@@ -146,9 +239,84 @@ REST_FRAMEWORK = {
 
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Cache shared by all worker processes on this host.
+# Point CACHE_BACKEND at redis/memcached when running several nodes.
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": config("CACHE_LOCATION", default=os.path.join(BASE_DIR, "cache")),
+    }
+}
 # AUTH_USER_MODEL = "payments.User"
 
 
+# Callback ingestion: "sync" writes to the DB before acking Safaricom,
+# "journal" acks once the payload is fsync'ed to a local journal and
+# `manage.py consume_callback_journal` applies it in batches
+PAYMENTS_CALLBACK_INGEST_MODE = config("PAYMENTS_CALLBACK_INGEST_MODE", default="sync")
+PAYMENTS_CALLBACK_JOURNAL_DIR = config(
+    "PAYMENTS_CALLBACK_JOURNAL_DIR", default=os.path.join(BASE_DIR, "journal")
+)
+PAYMENTS_CALLBACK_JOURNAL_FSYNC = config("PAYMENTS_CALLBACK_JOURNAL_FSYNC", default=True, cast=bool)
+PAYMENTS_CALLBACK_JOURNAL_SEGMENT_SECONDS = config("PAYMENTS_CALLBACK_JOURNAL_SEGMENT_SECONDS", default=60, cast=int)
+PAYMENTS_CALLBACK_JOURNAL_SEGMENT_BYTES = config("PAYMENTS_CALLBACK_JOURNAL_SEGMENT_BYTES", default=64 * 1024 * 1024, cast=int)
+PAYMENTS_CALLBACK_BATCH_SIZE = config("PAYMENTS_CALLBACK_BATCH_SIZE", default=500, cast=int)
+
+# GET /api/async/payments/status/: how long a request may wait for a result.
+# Status changes reach other worker processes through unix sockets in
+# PAYMENTS_NOTIFY_DIR (keep the path short, socket paths max out at ~100 chars)
+PAYMENTS_STATUS_WAIT_SECONDS = config("PAYMENTS_STATUS_WAIT_SECONDS", default=30, cast=float)
+PAYMENTS_STATUS_STREAM_SECONDS = config("PAYMENTS_STATUS_STREAM_SECONDS", default=180, cast=float)
+PAYMENTS_NOTIFY_DIR = config("PAYMENTS_NOTIFY_DIR", default=os.path.join(BASE_DIR, "run"))
+
+# /metrics: every process writes its numbers to PAYMENTS_METRICS_DIR every
+# PAYMENTS_METRICS_FLUSH_SECONDS; set a token to require it as a Bearer token
+PAYMENTS_METRICS_DIR = config("PAYMENTS_METRICS_DIR", default=os.path.join(BASE_DIR, "run", "metrics"))
+PAYMENTS_METRICS_FLUSH_SECONDS = config("PAYMENTS_METRICS_FLUSH_SECONDS", default=5, cast=float)
+PAYMENTS_METRICS_TOKEN = config("PAYMENTS_METRICS_TOKEN", default="")
+
+# Recently seen C2B receipts kept per process to drop re-deliveries early
+PAYMENTS_C2B_DEDUPE_SIZE = config("PAYMENTS_C2B_DEDUPE_SIZE", default=100000, cast=int)
+
+
+# Idempotency-Key support on /api/stk-push/
+IDEMPOTENCY_KEY_TTL = config("IDEMPOTENCY_KEY_TTL", default=24 * 60 * 60, cast=int)
+# how long a repeat waits for the first request to finish
+IDEMPOTENCY_WAIT_SECONDS = config("IDEMPOTENCY_WAIT_SECONDS", default=40, cast=int)
+# an IN_PROGRESS key older than this belongs to a dead worker
+IDEMPOTENCY_LOCK_TIMEOUT = config("IDEMPOTENCY_LOCK_TIMEOUT", default=120, cast=int)
+
+
+# Max receipts + references in one bulk claim/verify request
+PAYMENTS_BULK_MAX_ITEMS = config("PAYMENTS_BULK_MAX_ITEMS", default=100, cast=int)
+
+
+# Rows fetched per round trip by the streaming payment export
+PAYMENTS_EXPORT_CHUNK_SIZE = config("PAYMENTS_EXPORT_CHUNK_SIZE", default=2000, cast=int)
+
+
+# Statement receipts looked up per query by reconcile_statement / the admin upload
+PAYMENTS_RECONCILE_CHUNK_SIZE = config("PAYMENTS_RECONCILE_CHUNK_SIZE", default=2000, cast=int)
+
+
+# PaymentAdmin stops counting rows past this, the changelist shows "10000+"
+PAYMENTS_ADMIN_COUNT_LIMIT = config("PAYMENTS_ADMIN_COUNT_LIMIT", default=10000, cast=int)
+
+
+# In-process ExternalApp cache used by APIKeyAuthentication.
+# Saves/deletes invalidate it in every worker through the cache above.
+API_KEY_CACHE_TTL = config("API_KEY_CACHE_TTL", default=300, cast=int)
+API_KEY_CACHE_MAX_SIZE = config("API_KEY_CACHE_MAX_SIZE", default=1024, cast=int)
+API_KEY_CACHE_SHARED_INVALIDATION = config("API_KEY_CACHE_SHARED_INVALIDATION", default=True, cast=bool)
+API_KEY_CACHE_ALIAS = config("API_KEY_CACHE_ALIAS", default="default")
+API_KEY_CACHE_SYNC_INTERVAL = config("API_KEY_CACHE_SYNC_INTERVAL", default=5, cast=int)
+
+
 
 
 MPESA_CONSUMER_KEY = config("MPESA_CONSUMER_KEY")
@@ -157,6 +325,51 @@ MPESA_SHORTCODE = config("MPESA_SHORTCODE")
 MPESA_PASSKEY = config("MPESA_PASSKEY")
 MPESA_CALLBACK_URL = config("MPESA_CALLBACK_URL")
 MPESA_ENVIRONMENT = config("MPESA_ENVIRONMENT")
+# overrides the sandbox/live URL picked by MPESA_ENVIRONMENT
+MPESA_BASE_URL = config("MPESA_BASE_URL", default="")
+
+# OAuth token cache (shared by all workers through CACHES above)
+MPESA_TOKEN_CACHE_ALIAS = config("MPESA_TOKEN_CACHE_ALIAS", default="default")
+MPESA_TOKEN_REFRESH_MARGIN = config("MPESA_TOKEN_REFRESH_MARGIN", default=300, cast=int)
+MPESA_TOKEN_LOCK_TIMEOUT = config("MPESA_TOKEN_LOCK_TIMEOUT", default=10, cast=int)
+
+# HTTP client used for all Daraja calls (one keep-alive pool per process)
+MPESA_HTTP_POOL_SIZE = config("MPESA_HTTP_POOL_SIZE", default=20, cast=int)
+MPESA_HTTP_CONNECT_TIMEOUT = config("MPESA_HTTP_CONNECT_TIMEOUT", default=3.05, cast=float)
+MPESA_HTTP_READ_TIMEOUT = config("MPESA_HTTP_READ_TIMEOUT", default=30, cast=float)
+MPESA_HTTP_MAX_RETRIES = config("MPESA_HTTP_MAX_RETRIES", default=2, cast=int)
+MPESA_HTTP_BACKOFF_FACTOR = config("MPESA_HTTP_BACKOFF_FACTOR", default=0.5, cast=float)
+MPESA_HTTP_BACKOFF_JITTER = config("MPESA_HTTP_BACKOFF_JITTER", default=0.5, cast=float)
+
+# STK dispatch: "sync" calls Daraja inside the request,
+# "queue" returns 202 and leaves it to `manage.py run_stk_dispatcher`
+MPESA_STK_DISPATCH_MODE = config("MPESA_STK_DISPATCH_MODE", default="sync")
+MPESA_STK_DISPATCH_WORKERS = config("MPESA_STK_DISPATCH_WORKERS", default=8, cast=int)
+MPESA_STK_DISPATCH_LEASE_SECONDS = config("MPESA_STK_DISPATCH_LEASE_SECONDS", default=120, cast=int)
+MPESA_STK_DISPATCH_POLL_INTERVAL = config("MPESA_STK_DISPATCH_POLL_INTERVAL", default=0.5, cast=float)
+
+
+# `manage.py deliver_webhooks`: outbound payment webhooks to ExternalApps
+PAYMENTS_WEBHOOK_WORKERS = config("PAYMENTS_WEBHOOK_WORKERS", default=8, cast=int)
+PAYMENTS_WEBHOOK_MAX_PER_ENDPOINT = config("PAYMENTS_WEBHOOK_MAX_PER_ENDPOINT", default=2, cast=int)
+# events for a host already at that limit are retried this much later
+PAYMENTS_WEBHOOK_BUSY_DELAY_SECONDS = config("PAYMENTS_WEBHOOK_BUSY_DELAY_SECONDS", default=1, cast=float)
+PAYMENTS_WEBHOOK_TIMEOUT = config("PAYMENTS_WEBHOOK_TIMEOUT", default=10, cast=float)
+PAYMENTS_WEBHOOK_MAX_ATTEMPTS = config("PAYMENTS_WEBHOOK_MAX_ATTEMPTS", default=12, cast=int)
+PAYMENTS_WEBHOOK_BACKOFF_SECONDS = config("PAYMENTS_WEBHOOK_BACKOFF_SECONDS", default=30, cast=int)
+PAYMENTS_WEBHOOK_BACKOFF_MAX_SECONDS = config("PAYMENTS_WEBHOOK_BACKOFF_MAX_SECONDS", default=21600, cast=int)
+PAYMENTS_WEBHOOK_LEASE_SECONDS = config("PAYMENTS_WEBHOOK_LEASE_SECONDS", default=120, cast=int)
+PAYMENTS_WEBHOOK_POLL_INTERVAL = config("PAYMENTS_WEBHOOK_POLL_INTERVAL", default=1, cast=float)
+
+
+# `manage.py sweep_pending_stk`: STK Query for PENDING pushes with no callback
+MPESA_STK_QUERY_AFTER_SECONDS = config("MPESA_STK_QUERY_AFTER_SECONDS", default=120, cast=int)
+MPESA_STK_QUERY_RETRY_SECONDS = config("MPESA_STK_QUERY_RETRY_SECONDS", default=300, cast=int)
+MPESA_STK_QUERY_GIVE_UP_SECONDS = config("MPESA_STK_QUERY_GIVE_UP_SECONDS", default=86400, cast=int)
+MPESA_STK_QUERY_WORKERS = config("MPESA_STK_QUERY_WORKERS", default=4, cast=int)
+# queries per second per sweeper process
+MPESA_STK_QUERY_RATE = config("MPESA_STK_QUERY_RATE", default=5, cast=float)
+MPESA_STK_QUERY_POLL_INTERVAL = config("MPESA_STK_QUERY_POLL_INTERVAL", default=30, cast=float)
 
 
 
@@ -171,6 +384,12 @@ LOG_DIR = os.path.join(BASE_DIR, "logs")
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+# High-volume INFO logs (callbacks received, Daraja responses) kept, 0..1
+PAYMENTS_LOG_SAMPLE_RATE = config("PAYMENTS_LOG_SAMPLE_RATE", default=1.0, cast=float)
+# log files rotate at midnight or at this size, whichever comes first
+PAYMENTS_LOG_MAX_BYTES = config("PAYMENTS_LOG_MAX_BYTES", default=100 * 1024 * 1024, cast=int)
+PAYMENTS_LOG_BACKUP_COUNT = config("PAYMENTS_LOG_BACKUP_COUNT", default=14, cast=int)
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -180,28 +399,50 @@ LOGGING = {
             "format": "{asctime} | {levelname} | {name} | {message}",
             "style": "{",
         },
+        "json": {
+            "()": "payments.logs.JsonFormatter",
+        },
+    },
+
+    "filters": {
+        "sampling": {
+            "()": "payments.logs.SamplingFilter",
+            "rate": PAYMENTS_LOG_SAMPLE_RATE,
+        },
     },
 
     "handlers": {
         "file": {
             "level": "INFO",
-            "class": "logging.FileHandler",
+            "class": "payments.logs.CompressedRotatingFileHandler",
             "filename": os.path.join(LOG_DIR, "payments.log"),
-            "formatter": "verbose",
+            "formatter": "json",
+            "when": "midnight",
+            "max_bytes": PAYMENTS_LOG_MAX_BYTES,
+            "backupCount": PAYMENTS_LOG_BACKUP_COUNT,
+            "delay": True,
         },
         "error_file": {
             "level": "ERROR",
-            "class": "logging.FileHandler",
+            "class": "payments.logs.CompressedRotatingFileHandler",
             "filename": os.path.join(LOG_DIR, "errors.log"),
-            "formatter": "verbose",
+            "formatter": "json",
+            "when": "midnight",
+            "max_bytes": PAYMENTS_LOG_MAX_BYTES,
+            "backupCount": PAYMENTS_LOG_BACKUP_COUNT,
+            "delay": True,
+        },
+        # request threads only enqueue, a listener thread writes the files
+        "queue": {
+            "class": "payments.logs.BackgroundHandler",
+            "targets": ["file", "error_file"],
+            "filters": ["sampling"],
         },
-
-
     },
 
     "loggers": {
         "payments": {
-            "handlers": ["file"],
+            "handlers": ["queue"],
             "level": "INFO",
             "propagate": True,
         },
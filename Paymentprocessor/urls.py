@@ -4,9 +4,13 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.views.static import serve
 
+from payments import views as payments_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", include("payments.api.urls")),
+    path("api/async/", include("payments.api.async_urls")),
+    path("metrics", payments_views.metrics, name="metrics"),
 ]
 
 
@@ -1,16 +1,193 @@
+import io
+import json
+import uuid
+
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.html import format_html
 from rangefilter.filters import DateRangeFilter
-from .models import Payment, ExternalApp
+from .models import Payment, PaymentPayload, ExternalApp, StkDispatchJob, WebhookEvent
+from .services.reconciliation import ISSUES, StatementError, read_statement, reconcile
+from .services.webhooks import requeue
 
 
 @admin.register(ExternalApp)
 class ExternalAppAdmin(admin.ModelAdmin):
-    list_display = ("name", "api_key", "is_active", "created_at")
-    readonly_fields = ("api_key", "created_at")
+    list_display = ("name", "api_key", "is_active", "webhook_url", "created_at")
+    readonly_fields = ("api_key", "webhook_secret", "created_at")
     search_fields = ("name",)
     list_filter = ("is_active", "created_at")
 
 
+class PaymentPayloadInline(admin.TabularInline):
+    """
+    Raw Daraja payloads, only loaded on the payment detail page.
+    """
+
+    model = PaymentPayload
+    fields = ("event_type", "created_at", "payload")
+    readonly_fields = ("event_type", "created_at", "payload")
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description="Payload")
+    def payload(self, obj):
+        return format_html("<pre>{}</pre>", json.dumps(obj.body, indent=2))
+
+
+CURSOR_VAR = "cursor"
+
+
+def estimated_count(queryset, limit):
+    """
+    Count rows without a full COUNT(*) over a big table.
+
+    Returns (count, label). Unfiltered Postgres tables use the planner's
+    estimate, everything else is counted up to ``limit``.
+    """
+    connection = connections[queryset.db]
+
+    if connection.vendor == "postgresql" and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+
+        if row and row[0] > limit:
+            return row[0], f"~{row[0]:,}"
+
+    count = queryset.order_by()[: limit + 1].count()
+
+    if count > limit:
+        return limit, f"{limit:,}+"
+
+    return count, f"{count:,}"
+
+
+class EstimatedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        count, _ = estimated_count(self.object_list, settings.PAYMENTS_ADMIN_COUNT_LIMIT)
+        return count
+
+
+def prefix_q(field, prefix):
+    """
+    ``field`` starts with ``prefix``, as a range the index can serve.
+    """
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f"{field}__gte": prefix, f"{field}__lt": upper})
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Pages newest first on (created_at, id) instead of LIMIT/OFFSET, so the
+    thousandth page costs the same as the first. Sorting by another column
+    falls back to numbered pages.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = self.decode_cursor(request.GET.get(CURSOR_VAR))
+        self.keyset = ORDER_VAR not in request.GET
+        self.next_cursor = None
+        super().__init__(request, *args, **kwargs)
+
+    @staticmethod
+    def decode_cursor(value):
+        if not value:
+            return None
+
+        created_at, _, pk = value.partition(",")
+
+        try:
+            created_at = parse_datetime(created_at)
+            pk = uuid.UUID(pk)
+        except ValueError:
+            raise IncorrectLookupParameters
+
+        if created_at is None:
+            raise IncorrectLookupParameters
+
+        return created_at, pk
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # sorting or filtering starts again from the first page
+        if not new_params or CURSOR_VAR not in new_params:
+            remove = [CURSOR_VAR, *(remove or [])]
+        return super().get_query_string(new_params, remove)
+
+    def get_results(self, request):
+        if not self.keyset:
+            super().get_results(request)
+            self.result_count_label = f"{self.result_count:,}"
+            return
+
+        page = self.queryset
+
+        if self.cursor:
+            created_at, pk = self.cursor
+            page = page.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            )
+
+        rows = list(page[: self.list_per_page + 1])
+        result_list = rows[: self.list_per_page]
+
+        if len(rows) > self.list_per_page:
+            last = result_list[-1]
+            self.next_cursor = f"{last.created_at.isoformat()},{last.pk}"
+
+        self.result_count, self.result_count_label = estimated_count(
+            self.queryset, settings.PAYMENTS_ADMIN_COUNT_LIMIT
+        )
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = self.model_admin.get_paginator(
+            request, self.queryset, self.list_per_page
+        )
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    @property
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class StatementUploadForm(forms.Form):
+    statement = forms.FileField(help_text="M-Pesa statement CSV export")
+
+
+# discrepancies listed on the page, the full count is in the summary
+RECONCILE_PREVIEW_ROWS = 500
+
+
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = (
@@ -32,13 +209,114 @@ class PaymentAdmin(admin.ModelAdmin):
         "mpesa_receipt_number",
         "checkout_request_id",
     )
+    search_help_text = "Exact receipt, checkout ID or reference, or the start of a phone number"
 
     readonly_fields = (
         "mpesa_receipt_number",
         "checkout_request_id",
         "merchant_request_id",
-        "raw_callback",
         "created_at",
     )
 
-    ordering = ("-created_at",)
+    inlines = [PaymentPayloadInline]
+
+    ordering = ("-created_at", "-id")
+
+    # no COUNT(*) over the whole table or per filter option
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+
+    def get_urls(self):
+        urls = [
+            path(
+                "reconcile/",
+                self.admin_site.admin_view(self.reconcile_view),
+                name="payments_payment_reconcile",
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def reconcile_view(self, request):
+        form = StatementUploadForm(request.POST or None, request.FILES or None)
+        summary = None
+        issues = []
+
+        def report(*issue):
+            if len(issues) < RECONCILE_PREVIEW_ROWS:
+                issues.append(issue)
+
+        if request.method == "POST" and form.is_valid():
+            upload = form.cleaned_data["statement"]
+            lines = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+
+            try:
+                summary = reconcile(read_statement(lines), report)
+            except (StatementError, UnicodeDecodeError) as e:
+                form.add_error("statement", str(e))
+
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": "Reconcile M-Pesa statement",
+            "form": form,
+            "summary": summary and [(issue, summary[issue]) for issue in ISSUES],
+            "statement_rows": summary and summary["statement_rows"],
+            "matched": summary and summary["matched"],
+            "issues": issues,
+            "preview_rows": RECONCILE_PREVIEW_ROWS,
+        }
+
+        return TemplateResponse(request, "admin/payments/payment/reconcile.html", context)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        # icontains over four columns can't use an index, only exact
+        # matches and phone prefixes are searched
+        term = search_term.strip()
+
+        if not term:
+            return queryset, False
+
+        query = (
+            Q(mpesa_receipt_number=term.upper())
+            | Q(checkout_request_id=term)
+            | Q(external_reference=term)
+        )
+
+        if term.isdigit():
+            query |= prefix_q("phone_number", term)
+
+        return queryset.filter(query), False
+
+
+@admin.register(StkDispatchJob)
+class StkDispatchJobAdmin(admin.ModelAdmin):
+    list_display = ("payment", "status", "lease_owner", "created_at", "updated_at")
+    list_filter = ("status",)
+    raw_id_fields = ("payment",)
+    readonly_fields = ("lease_owner", "lease_expires_at", "last_error", "created_at", "updated_at")
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ("event_type", "app", "payment", "status", "attempts", "next_attempt_at", "created_at")
+    list_filter = ("status", "event_type")
+    raw_id_fields = ("payment",)
+    readonly_fields = (
+        "payload",
+        "attempts",
+        "lease_owner",
+        "lease_expires_at",
+        "last_error",
+        "created_at",
+        "delivered_at",
+    )
+    actions = ["requeue_dead"]
+
+    @admin.action(description="Requeue selected dead events")
+    def requeue_dead(self, request, queryset):
+        count = requeue(queryset)
+        self.message_user(request, f"Requeued {count} event(s)")
@@ -0,0 +1,23 @@
+from django.urls import path
+from . import async_views
+
+# Same routes as urls.py, served by the async views (run under ASGI)
+urlpatterns = [
+    # 🔹 STK Push
+    path("stk-push/", async_views.stk_push, name="async-stk-push"),
+
+    # 🔹 STK Callback (Daraja)
+    path("mpesa/stk-callback/", async_views.stk_callback, name="async-stk-callback"),
+
+    # 🔹 C2B Confirmation (Daraja)
+    path("mpesa/c2b/confirmation/", async_views.c2b_confirmation, name="async-c2b-confirmation"),
+
+    # 🔹 Payment Verification
+    path("payments/verify/", async_views.verify_payment, name="async-verify-payment"),
+
+    # 🔹 Payment Status (long-poll / SSE)
+    path("payments/status/", async_views.payment_status, name="async-payment-status"),
+
+    # 🔹 Claim Payment
+    path("payments/claim/", async_views.claim_payment, name="async-claim-payment"),
+]
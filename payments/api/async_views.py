@@ -0,0 +1,392 @@
+"""
+Async versions of the hot endpoints, for running under ASGI (uvicorn).
+
+Same behaviour and responses as the views in views.py (dispatch mode,
+ingest mode, Idempotency-Key), but Daraja calls go through
+AsyncDarajaService and the ORM is used through its async API, so a single
+worker can hold many STK pushes and callbacks in flight. Callbacks are
+recorded by the same services as the sync views, in one transaction.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.exceptions import AuthenticationFailed
+
+from payments.logs import SAMPLED
+from payments.models import Payment
+from payments.routers import replica_reads
+from payments.services.app_cache import app_cache
+from payments.services import claims
+from payments.services.callbacks import (
+    C2B,
+    STK,
+    apply_c2b_confirmation,
+    apply_stk_callback,
+    is_duplicate_c2b,
+    remember_c2b,
+)
+from payments.services.daraja_async import AsyncDarajaService
+from payments.services.idempotency import IdempotencyConflict, arun_idempotent, request_fingerprint
+from payments.services.journal import get_journal
+from payments.services.notifier import waiters
+from .authentication import aauthenticate_api_key
+from .serializers import STKPushSerializer
+from .views import payment_summary, queue_stk_push, record_stk_push, stk_push_completed
+
+logger = logging.getLogger("payments")
+
+
+def api_key_required(view):
+    """
+    Authenticate with X-API-KEY and pass the ExternalApp as ``request.app``.
+    """
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            request.app = await aauthenticate_api_key(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({"detail": str(e.detail)}, status=403)
+
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+async def get_admin_app(create=False):
+    # peek never blocks the loop, on a miss (or a due generation check)
+    # the lookup goes to a thread
+    admin_app = app_cache.peek_admin_app()
+
+    if admin_app is None:
+        admin_app = await sync_to_async(app_cache.admin_app)(create=create)
+
+    return admin_app
+
+
+def request_data(request):
+    try:
+        return json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+
+
+@csrf_exempt
+@require_POST
+async def c2b_confirmation(request):
+    data = request_data(request)
+
+    logger.info("C2B CONFIRMATION RECEIVED: %s", data, extra=SAMPLED)
+
+    if not isinstance(data, dict):
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid body"}, status=400)
+
+    if is_duplicate_c2b(data):
+        return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+
+    if settings.PAYMENTS_CALLBACK_INGEST_MODE == "journal":
+        await sync_to_async(get_journal().append, thread_sensitive=False)(C2B, data)
+        remember_c2b(data)
+        return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+
+    try:
+        # payment, payload and webhook event in one transaction
+        await sync_to_async(apply_c2b_confirmation)(data)
+    except IntegrityError:
+        # not recorded, a non-success ack makes Safaricom retry
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Failed"}, status=500)
+
+    return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+
+
+@csrf_exempt
+@require_POST
+async def stk_callback(request):
+    data = request_data(request)
+    logger.info("STK Callback Received: %s", data, extra=SAMPLED)
+
+    if settings.PAYMENTS_CALLBACK_INGEST_MODE == "journal":
+        await sync_to_async(get_journal().append, thread_sensitive=False)(STK, data)
+        return JsonResponse({"ResultCode": 0, "ResultDesc": "Accepted"})
+
+    try:
+        # payment, payload and webhook event in one transaction
+        await sync_to_async(apply_stk_callback)(data)
+
+    except Payment.DoesNotExist:
+        logger.error("Payment not found for CheckoutRequestID")
+
+    except Exception as e:
+        logger.error("Error processing STK callback: %s", e)
+
+    return JsonResponse({"ResultCode": 0, "ResultDesc": "Accepted"})
+
+
+@csrf_exempt
+@require_POST
+@api_key_required
+async def stk_push(request):
+    """
+    See STKPushView, including the Idempotency-Key handling.
+    """
+    key = request.headers.get("Idempotency-Key")
+    data = request_data(request)
+
+    if not key:
+        status_code, body = await push_stk(request.app, data)
+        return JsonResponse(body, status=status_code)
+
+    if len(key) > 255:
+        return JsonResponse({"error": "Idempotency-Key must be at most 255 characters"}, status=400)
+
+    try:
+        status_code, body, replayed = await arun_idempotent(
+            request.app,
+            key,
+            request_fingerprint(data),
+            functools.partial(push_stk, request.app, data),
+            keep=stk_push_completed,
+        )
+    except IdempotencyConflict as e:
+        return JsonResponse({"error": str(e)}, status=e.status_code)
+
+    response = JsonResponse(body, status=status_code)
+
+    if replayed:
+        response["Idempotent-Replayed"] = "true"
+
+    return response
+
+
+async def push_stk(external_app, data):
+    """
+    (status_code, body) of an STK push request.
+    """
+    serializer = STKPushSerializer(data=data)
+
+    if not serializer.is_valid():
+        return 400, serializer.errors
+
+    data = serializer.validated_data
+
+    if settings.MPESA_STK_DISPATCH_MODE == "queue":
+        payment = await sync_to_async(queue_stk_push)(data, external_app)
+        return 202, {"message": "STK queued", "payment_id": payment.id}
+
+    response = await AsyncDarajaService().stk_push(
+        phone_number=data["phone_number"],
+        amount=data["amount"],
+        reference=data["reference"],
+        description=data["description"],
+    )
+
+    # payment and payload in one transaction
+    payment = await sync_to_async(record_stk_push)(data, external_app, response)
+
+    return 200, {
+        "message": "STK initiated",
+        "payment_id": payment.id,
+        "daraja_response": response
+    }
+
+
+@require_GET
+@api_key_required
+async def verify_payment(request):
+    receipt = request.GET.get("receipt")
+    reference = request.GET.get("reference")
+    phone = request.GET.get("phone")
+
+    if not receipt and not reference:
+        return JsonResponse({"error": "Provide receipt or reference"}, status=400)
+
+    payment = Payment.objects.filter(app=request.app, status="SUCCESS")
+
+    if receipt:
+        payment = payment.filter(mpesa_receipt_number=receipt)
+
+        if phone:
+            payment = payment.filter(phone_number=phone)
+
+    else:
+        payment = payment.filter(external_reference=reference)
+
+    # served by a replica unless the app just wrote
+    with replica_reads(request.app):
+        payment = await payment.afirst()
+
+    if not payment:
+        return JsonResponse({"paid": False})
+
+    return JsonResponse(payment_summary(payment))
+
+
+@csrf_exempt
+@require_POST
+@api_key_required
+async def claim_payment(request):
+    app = request.app
+    data = request_data(request) or {}
+
+    receipt = data.get("receipt")
+    reference = data.get("reference")
+
+    if not receipt and not reference:
+        return JsonResponse({"error": "Provide receipt or reference"}, status=400)
+
+    admin_app = await get_admin_app()
+
+    if admin_app is None:
+        return JsonResponse({"error": "Admin intake app not configured"}, status=500)
+
+    outcome, receipt = await sync_to_async(claims.claim_payment)(
+        app, admin_app, receipt=receipt, reference=reference
+    )
+
+    if outcome == claims.NOT_FOUND:
+        return JsonResponse({"error": "Payment not found"}, status=404)
+
+    if outcome == claims.ALREADY_CLAIMED:
+        return JsonResponse({"message": "Payment already claimed"}, status=400)
+
+    return JsonResponse({
+        "message": "Payment claimed successfully",
+        "receipt": receipt
+    })
+
+
+FINAL_STATUSES = ("SUCCESS", "FAILED")
+
+# SSE comment sent while nothing happens, keeps proxies from closing the stream
+KEEPALIVE_SECONDS = 15
+
+
+def payment_status_body(payment):
+    body = {
+        "payment_id": payment.id,
+        "checkout_request_id": payment.checkout_request_id,
+        "status": payment.status,
+        "paid": False,
+    }
+
+    if payment.status == "SUCCESS":
+        body.update(payment_summary(payment))
+
+    return body
+
+
+async def wait_for_result(payment, timeout):
+    """
+    Return the payment once it is SUCCESS/FAILED or ``timeout`` has passed.
+    Woken by notifier.publish, the database is only read again then.
+    """
+    deadline = time.monotonic() + timeout
+
+    while payment.status not in FINAL_STATUSES:
+        future = waiters.wait(payment.id)
+
+        try:
+            # registered first, so a result written in between isn't missed
+            payment = await Payment.objects.aget(pk=payment.pk)
+
+            if payment.status in FINAL_STATUSES:
+                break
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            await asyncio.wait_for(future, remaining)
+        except asyncio.TimeoutError:
+            break
+        finally:
+            waiters.discard(payment.id, future)
+
+    return payment
+
+
+async def status_events(payment, duration):
+    deadline = time.monotonic() + duration
+    sent = None
+
+    while True:
+        if payment.status != sent:
+            body = json.dumps(payment_status_body(payment), cls=DjangoJSONEncoder)
+            yield f"event: status\ndata: {body}\n\n"
+            sent = payment.status
+
+        remaining = deadline - time.monotonic()
+
+        if payment.status in FINAL_STATUSES or remaining <= 0:
+            return
+
+        payment = await wait_for_result(payment, min(remaining, KEEPALIVE_SECONDS))
+
+        if payment.status == sent:
+            yield ": keep-alive\n\n"
+
+
+@require_GET
+@api_key_required
+async def payment_status(request):
+    """
+    Wait for the result of an STK push instead of polling verify.
+
+    Query params: payment_id or checkout_request_id, optional timeout
+    (seconds, capped at PAYMENTS_STATUS_WAIT_SECONDS).
+
+    Answers as soon as the payment is SUCCESS/FAILED, or with the current
+    status at the timeout. With "Accept: text/event-stream" the status is
+    pushed as Server-Sent Events instead, until the payment settles.
+    """
+    payment_id = request.GET.get("payment_id")
+    checkout_request_id = request.GET.get("checkout_request_id")
+
+    if not payment_id and not checkout_request_id:
+        return JsonResponse({"error": "Provide payment_id or checkout_request_id"}, status=400)
+
+    payments = Payment.objects.filter(app=request.app)
+
+    try:
+        if payment_id:
+            payment = await payments.filter(pk=payment_id).afirst()
+        else:
+            payment = await payments.filter(checkout_request_id=checkout_request_id).afirst()
+    except ValidationError:
+        payment = None
+
+    if not payment:
+        return JsonResponse({"error": "Payment not found"}, status=404)
+
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        response = StreamingHttpResponse(
+            status_events(payment, settings.PAYMENTS_STATUS_STREAM_SECONDS),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    try:
+        timeout = float(request.GET.get("timeout", settings.PAYMENTS_STATUS_WAIT_SECONDS))
+    except ValueError:
+        return JsonResponse({"error": "timeout must be a number"}, status=400)
+
+    timeout = max(0, min(timeout, settings.PAYMENTS_STATUS_WAIT_SECONDS))
+
+    payment = await wait_for_result(payment, timeout)
+
+    return JsonResponse(payment_status_body(payment))
+
@@ -1,6 +1,8 @@
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-from payments.models import ExternalApp
+from asgiref.sync import sync_to_async
+
+from payments.services.app_cache import app_cache
 
 
 class APIKeyAuthentication(BaseAuthentication):
@@ -11,10 +13,31 @@ class APIKeyAuthentication(BaseAuthentication):
         if not api_key:
             raise AuthenticationFailed("API key required")
 
-        try:
-            app = ExternalApp.objects.get(api_key=api_key, is_active=True)
-        except ExternalApp.DoesNotExist:
+        app = app_cache.by_api_key(api_key)
+
+        if app is None:
             raise AuthenticationFailed("Invalid API Key")
 
         return (app, None)
         # return bool(request.user)
+
+
+async def aauthenticate_api_key(request):
+    """
+    Async counterpart of APIKeyAuthentication for the async views.
+    Returns the ExternalApp or raises AuthenticationFailed.
+    """
+    api_key = request.headers.get("X-API-KEY")
+
+    if not api_key:
+        raise AuthenticationFailed("API key required")
+
+    app = app_cache.peek_api_key(api_key)
+
+    if app is None:
+        app = await sync_to_async(app_cache.by_api_key)(api_key)
+
+    if app is None:
+        raise AuthenticationFailed("Invalid API Key")
+
+    return app
@@ -15,7 +15,12 @@ urlpatterns = [
 
     # 🔹 Payment Verification
     path("payments/verify/", views.VerifyPaymentView.as_view(), name="verify-payment"),
+    path("payments/verify/bulk/", views.BulkVerifyPaymentView.as_view(), name="bulk-verify-payment"),
 
     # 🔹 Claim Payment
     path("payments/claim/", views.ClaimPaymentView.as_view(), name="claim-payment"),
+    path("payments/claim/bulk/", views.BulkClaimPaymentView.as_view(), name="bulk-claim-payment"),
+
+    # 🔹 Payment Export
+    path("payments/export/", views.ExportPaymentsView.as_view(), name="export-payments"),
 ]
@@ -9,14 +9,39 @@ from rest_framework.permissions import AllowAny
 
 
 from .serializers import STKPushSerializer
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
 from django.utils.timezone import now
-from datetime import timedelta
+from datetime import datetime, time, timedelta
 from django.utils import timezone
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 import json
 
-from payments.models import Payment, ExternalApp
+from payments.logs import SAMPLED
+from payments.models import Payment, PaymentPayload, ExternalApp, StkDispatchJob
+from payments.routers import pin_to_primary, read_alias, replica_reads
 from payments.services.daraja import DarajaService
+from payments.services.app_cache import app_cache
+from payments.services.claims import ALREADY_CLAIMED, NOT_FOUND, claim_payment, claim_payments
+from payments.services.callbacks import (
+    C2B,
+    STK,
+    apply_c2b_confirmation,
+    apply_stk_callback,
+    is_duplicate_c2b,
+    remember_c2b,
+)
+from payments.services.idempotency import (
+    IdempotencyConflict,
+    request_fingerprint,
+    run_idempotent,
+)
+from payments.services.export import CONTENT_TYPES, CSV, export_rows, parse_cursor, stream_export
+from payments.services.journal import get_journal
 from .authentication import APIKeyAuthentication
 from rest_framework.permissions import IsAuthenticated
 from .permissions import IsAPIKeyAuthenticated
@@ -35,7 +60,7 @@ def c2b_validation(request):
     data = json.loads(request.body)
 
     # print("VALIDATION REQUEST:", data)
-    logger.info(f"C2B VALIDATION REQUEST: {data}")
+    logger.info("C2B VALIDATION REQUEST: %s", data, extra=SAMPLED)
 
 
     # accept all payments for now
@@ -53,40 +78,132 @@ def c2b_confirmation(request):
     """
     data = json.loads(request.body)
 
-    logger.info(f"C2B CONFIRMATION RECEIVED: {data}")
+    logger.info("C2B CONFIRMATION RECEIVED: %s", data, extra=SAMPLED)
 
+    # 🔁 Daraja re-delivers confirmations, repeats get the same ack
+    if is_duplicate_c2b(data):
+        return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
 
-    # ✅ get or create default admin shop
-    admin_app, _ = ExternalApp.objects.get_or_create(
-        name="ADMIN_SHOP",
-        defaults={
-            "is_active": True,
-        },
-    )
+    if settings.PAYMENTS_CALLBACK_INGEST_MODE == "journal":
+        # ⚡ ack once durable on disk, consume_callback_journal saves it
+        get_journal().append(C2B, data)
+        remember_c2b(data)
+    else:
+        try:
+            apply_c2b_confirmation(data)
+        except IntegrityError:
+            # not recorded, a non-success ack makes Safaricom retry
+            return JsonResponse({"ResultCode": 1, "ResultDesc": "Failed"}, status=500)
 
-    Payment.objects.create(
-        app=admin_app,  # ✅ assign owner
-        phone_number=data.get("MSISDN"),
-        amount=data.get("TransAmount"),
-        external_reference=data.get("BillRefNumber"),
-        mpesa_receipt_number=data.get("TransID"),
-        payment_type="C2B",
-        status="SUCCESS",
-        raw_callback=data,
-    )
+    return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
 
-    logger.info(
-        f"PAYMENT RECORDED: Receipt={data.get('TransID')} Amount={data.get('TransAmount')}"
-    )
 
-    return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+def queue_stk_push(data, external_app):
+    """
+    Record the payment and leave the Daraja call to run_stk_dispatcher.
+    checkout_request_id is filled in once the push has been sent.
+    """
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            external_reference=data["reference"],
+            app_name=external_app.name,
+            app=external_app,
+            phone_number=data["phone_number"],
+            amount=data["amount"],
+            payment_type="STK",
+            status="PENDING",
+        )
+
+        StkDispatchJob.objects.create(
+            payment=payment,
+            description=data["description"],
+        )
+
+    pin_to_primary([external_app.id])
+
+    return payment
+
+
+def record_stk_push(data, external_app, response):
+    """
+    Record the payment of a push sent to Daraja, with its response.
+    """
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            external_reference=data["reference"],
+            app_name=external_app.name,
+            app=external_app,
+            phone_number=data["phone_number"],
+            amount=data["amount"],
+            payment_type="STK",
+            checkout_request_id=response.get("CheckoutRequestID"),
+            merchant_request_id=response.get("MerchantRequestID"),
+            status="PENDING",
+        )
+
+        PaymentPayload.record(payment, "STK_INITIATION", response)
+
+    pin_to_primary([external_app.id])
+
+    return payment
+
+
+def stk_push_completed(status_code, body):
+    """
+    Whether an STK push response is final for its Idempotency-Key.
+    Daraja errors come back with HTTP 200 and no CheckoutRequestID; they
+    release the key so a retry pushes again instead of replaying them.
+    """
+    if status_code >= 500:
+        return False
+
+    daraja_response = body.get("daraja_response")
+    return daraja_response is None or bool(daraja_response.get("CheckoutRequestID"))
 
 
 class STKPushView(APIView):
+    """
+    Initiate an STK push.
+
+    Send an ``Idempotency-Key`` header to make retries safe: a repeat with
+    the same key and body replays the first response instead of pushing
+    again, and a concurrent repeat waits for the first to finish.
+    """
+
     authentication_classes = [APIKeyAuthentication]
     permission_classes = [IsAPIKeyAuthenticated]
 
     def post(self, request):
+        key = request.headers.get("Idempotency-Key")
+
+        if not key:
+            return self.push(request)
+
+        if len(key) > 255:
+            return Response(
+                {"error": "Idempotency-Key must be at most 255 characters"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        def handler():
+            response = self.push(request)
+            return response.status_code, response.data
+
+        try:
+            status_code, body, replayed = run_idempotent(
+                request.user, key, request_fingerprint(request.data), handler, keep=stk_push_completed
+            )
+        except IdempotencyConflict as e:
+            return Response({"error": str(e)}, status=e.status_code)
+
+        response = Response(body, status=status_code)
+
+        if replayed:
+            response["Idempotent-Replayed"] = "true"
+
+        return response
+
+    def push(self, request):
         serializer = STKPushSerializer(data=request.data)
 
         if not serializer.is_valid():
@@ -95,6 +212,9 @@ class STKPushView(APIView):
         data = serializer.validated_data
         external_app = request.user  # This is ExternalApp (from APIKeyAuthentication)
 
+        if settings.MPESA_STK_DISPATCH_MODE == "queue":
+            return self.queue_push(data, external_app)
+
         daraja = DarajaService()
 
         response = daraja.stk_push(
@@ -105,18 +225,7 @@ class STKPushView(APIView):
         )
 
         # Save initial payment record
-        payment = Payment.objects.create(
-            external_reference=data["reference"],
-            app_name=external_app.name,
-            app=external_app,
-            phone_number=data["phone_number"],
-            amount=data["amount"],
-            payment_type="STK",
-            checkout_request_id=response.get("CheckoutRequestID"),
-            merchant_request_id=response.get("MerchantRequestID"),
-            status="PENDING",
-            raw_callback=response
-        )
+        payment = record_stk_push(data, external_app, response)
 
         return Response({
             "message": "STK initiated",
@@ -124,6 +233,14 @@ class STKPushView(APIView):
             "daraja_response": response
         }, status=status.HTTP_200_OK)
 
+    def queue_push(self, data, external_app):
+        payment = queue_stk_push(data, external_app)
+
+        return Response({
+            "message": "STK queued",
+            "payment_id": payment.id,
+        }, status=status.HTTP_202_ACCEPTED)
+
 
 
 @csrf_exempt
@@ -133,45 +250,56 @@ class STKPushView(APIView):
 def stk_callback(request):
 
     data = request.data
-    logger.info(f"STK Callback Received: {data}")
+    logger.info("STK Callback Received: %s", data, extra=SAMPLED)
+
+    if settings.PAYMENTS_CALLBACK_INGEST_MODE == "journal":
+        get_journal().append(STK, data)
+        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
 
     try:
-        stk_data = data["Body"]["stkCallback"]
-        checkout_request_id = stk_data["CheckoutRequestID"]
-        result_code = stk_data["ResultCode"]
-        result_desc = stk_data["ResultDesc"]
+        apply_stk_callback(data)
 
-        payment = Payment.objects.get(checkout_request_id=checkout_request_id)
+    except Payment.DoesNotExist:
+        logger.error("Payment not found for CheckoutRequestID")
 
-        payment.raw_callback = data
+    except Exception as e:
+        logger.error("Error processing STK callback: %s", e)
 
-        if result_code == 0:
-            # SUCCESS
-            metadata = stk_data.get("CallbackMetadata", {}).get("Item", [])
+    return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
 
-            receipt_number = None
-            for item in metadata:
-                if item["Name"] == "MpesaReceiptNumber":
-                    receipt_number = item["Value"]
+def validate_identifier_lists(receipts, references):
+    """
+    Error message for a bad bulk request body, or None.
+    """
+    if not isinstance(receipts, list) or not isinstance(references, list):
+        return "receipts and references must be lists"
 
-            payment.status = "SUCCESS"
-            payment.mpesa_receipt_number = receipt_number
+    if not receipts and not references:
+        return "Provide receipts or references"
 
-            logger.info(f"Payment SUCCESS: {receipt_number}")
+    if len(receipts) + len(references) > settings.PAYMENTS_BULK_MAX_ITEMS:
+        return f"At most {settings.PAYMENTS_BULK_MAX_ITEMS} items per request"
 
-        else:
-            payment.status = "FAILED"
-            logger.warning(f"Payment FAILED: {result_desc}")
+    if not all(isinstance(value, str) and value for value in receipts + references):
+        return "receipts and references must be non-empty strings"
 
-        payment.save()
+    return None
 
-    except Payment.DoesNotExist:
-        logger.error("Payment not found for CheckoutRequestID")
 
-    except Exception as e:
-        logger.error(f"Error processing STK callback: {str(e)}")
+def payment_summary(payment):
+    """
+    Verify response body for a paid payment.
+    """
+    return {
+        "paid": True,
+        "amount": payment.amount,
+        "phone": payment.phone_number,
+        "receipt": payment.mpesa_receipt_number,
+        "reference": payment.external_reference,
+        "claimed": payment.claimed,
+        "date": payment.created_at,
+    }
 
-    return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
 
 class VerifyPaymentView(APIView):
     """
@@ -204,30 +332,100 @@ class VerifyPaymentView(APIView):
             status="SUCCESS"
         )
 
-        # 1️⃣ Receipt + optional phone
-        if receipt:
-            payment = payment.filter(mpesa_receipt_number=receipt)
+        # 📖 read-only, served by a replica unless the app just wrote
+        with replica_reads(app):
+            # 1️⃣ Receipt + optional phone
+            if receipt:
+                payment = payment.filter(mpesa_receipt_number=receipt)
 
-            if phone:
-                payment = payment.filter(phone_number=phone)
+                if phone:
+                    payment = payment.filter(phone_number=phone)
 
-            payment = payment.first()
+                payment = payment.first()
 
-        # 2️⃣ Reference lookup (STK initiated payments)
-        elif reference:
-            payment = payment.filter(external_reference=reference).first()
+            # 2️⃣ Reference lookup (STK initiated payments)
+            elif reference:
+                payment = payment.filter(external_reference=reference).first()
 
         if not payment:
             return Response({"paid": False})
 
+        return Response(payment_summary(payment))
+
+
+class BulkVerifyPaymentView(APIView):
+    """
+    Verify many payments in one call.
+
+    Body: {"receipts": [...], "references": [...], "phones": {receipt: phone}}
+
+    Same priority as VerifyPaymentView per item:
+    1. receipt + phone (when phones has an entry for the receipt)
+    2. receipt only
+    3. reference
+
+    Everything is resolved with one query scoped to the calling app.
+    """
+
+    authentication_classes = [APIKeyAuthentication]
+    permission_classes = [IsAPIKeyAuthenticated]
+
+    def post(self, request):
+        app = request.user
+
+        receipts = request.data.get("receipts") or []
+        references = request.data.get("references") or []
+        phones = request.data.get("phones") or {}
+
+        error = validate_identifier_lists(receipts, references)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not isinstance(phones, dict):
+            return Response(
+                {"error": "phones must map receipts to phone numbers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        payments = Payment.objects.filter(
+            app=app,
+            status="SUCCESS",
+        ).filter(
+            Q(mpesa_receipt_number__in=receipts)
+            | Q(external_reference__in=references)
+        ).order_by("pk")
+
+        by_receipt = {}
+        by_reference = {}
+
+        with replica_reads(app):
+            payments = list(payments)
+
+        for payment in payments:
+            by_receipt[payment.mpesa_receipt_number] = payment
+            # first match wins, like .first() in VerifyPaymentView
+            by_reference.setdefault(payment.external_reference, payment)
+
+        receipt_results = {}
+
+        for receipt in receipts:
+            payment = by_receipt.get(receipt)
+            phone = phones.get(receipt)
+
+            if payment and phone and payment.phone_number != phone:
+                payment = None
+
+            receipt_results[receipt] = payment_summary(payment) if payment else {"paid": False}
+
+        reference_results = {}
+
+        for reference in references:
+            payment = by_reference.get(reference)
+            reference_results[reference] = payment_summary(payment) if payment else {"paid": False}
+
         return Response({
-            "paid": True,
-            "amount": payment.amount,
-            "phone": payment.phone_number,
-            "receipt": payment.mpesa_receipt_number,
-            "reference": payment.external_reference,
-            "claimed": payment.claimed,
-            "date": payment.created_at,
+            "receipts": receipt_results,
+            "references": reference_results,
         })
 
 
@@ -258,64 +456,150 @@ class ClaimPaymentView(APIView):
             )
 
         # 🔐 fetch admin intake app
-        try:
-            admin_app = ExternalApp.objects.get(name="ADMIN_SHOP")
-        except ExternalApp.DoesNotExist:
+        admin_app = app_cache.admin_app()
+
+        if admin_app is None:
             return Response(
                 {"error": "Admin intake app not configured"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
-        # 🔍 allow access to:
+        # ⚡ find, check and claim in one conditional UPDATE
         # - app's own payments
-        # - admin shop (C2B intake)
-        payment_qs = Payment.objects.filter(
-            status="SUCCESS",
-            app__in=[app, admin_app]
+        # - admin shop (C2B intake), ownership moves to the claiming app
+        outcome, receipt = claim_payment(
+            app, admin_app, receipt=receipt, reference=reference
         )
 
-        # ✅ 1️⃣ Receipt lookup (BEST)
-        if receipt:
-            payment = payment_qs.filter(
-                mpesa_receipt_number=receipt
-            ).first()
-
-        # ✅ 2️⃣ Reference fallback (STK only)
-        else:
-            payment = payment_qs.filter(
-                external_reference=reference
-            ).first()
-
-        if not payment:
+        if outcome == NOT_FOUND:
             return Response(
                 {"error": "Payment not found"},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        if payment.claimed:
+        if outcome == ALREADY_CLAIMED:
             return Response(
                 {"message": "Payment already claimed"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # ⭐ Transfer ownership if C2B intake payment
-        if payment.app == admin_app:
-            payment.app = app
-            logger.info(
-                f"Ownership transferred to {app.name} "
-                f"for receipt {payment.mpesa_receipt_number}"
+        return Response({
+            "message": "Payment claimed successfully",
+            "receipt": receipt
+        })
+
+class BulkClaimPaymentView(APIView):
+    """
+    Claim many payments in one call.
+
+    Body: {"receipts": [...], "references": [...]}
+    Same lookup and ownership rules as ClaimPaymentView, resolved with one
+    query and claimed with one UPDATE. Returns a result per item.
+    """
+
+    authentication_classes = [APIKeyAuthentication]
+    permission_classes = [IsAPIKeyAuthenticated]
+
+    def post(self, request):
+        app = request.user
+
+        receipts = request.data.get("receipts") or []
+        references = request.data.get("references") or []
+
+        error = validate_identifier_lists(receipts, references)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        admin_app = app_cache.admin_app()
+
+        if admin_app is None:
+            return Response(
+                {"error": "Admin intake app not configured"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+        results = claim_payments(
+            app, admin_app, receipts=receipts, references=references
+        )
+
+        return Response({"results": results})
+
+
+def parse_export_bound(value, end=False):
+    """
+    A date or datetime query param as a datetime. A plain ``end`` date
+    includes that whole day.
+    """
+    moment = parse_datetime(value)
+
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        if end:
+            day += timedelta(days=1)
+        moment = datetime.combine(day, time.min)
+
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+
+    return moment
+
+
+@method_decorator(gzip_page, name="dispatch")
+class ExportPaymentsView(APIView):
+    """
+    Stream every payment of the calling app, oldest first.
+
+    Query params:
+    - start, end: dates or datetimes (optional, end date is inclusive)
+    - output: csv (default) or ndjson
+    - after: "<created_at>,<id>" of the last row received, to resume
+    """
+
+    authentication_classes = [APIKeyAuthentication]
+    permission_classes = [IsAPIKeyAuthenticated]
+
+    def get(self, request):
+        app = request.user
+
+        output = request.GET.get("output", CSV)
+        if output not in CONTENT_TYPES:
+            return Response(
+                {"error": "output must be csv or ndjson"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        payment.claimed = True
-        payment.claimed_at = timezone.now()
-        payment.save()
+        try:
+            start = request.GET.get("start")
+            start = start and parse_export_bound(start)
+            end = request.GET.get("end")
+            end = end and parse_export_bound(end, end=True)
+        except ValueError:
+            return Response(
+                {"error": "start and end must be dates or datetimes"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        logger.info(f"PAYMENT CLAIMED: {payment.mpesa_receipt_number}")
+        after = request.GET.get("after")
+        if after:
+            after = parse_cursor(after)
+            if after is None:
+                return Response(
+                    {"error": "Invalid after cursor"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+        logger.info("Payment export for %s: start=%s end=%s after=%s", app.name, start, end, after)
+
+        response = StreamingHttpResponse(
+            # rows are read while streaming, after this view returned
+            stream_export(export_rows(app, start, end, after, using=read_alias(app)), output),
+            content_type=CONTENT_TYPES[output],
+        )
+        response["Content-Disposition"] = f'attachment; filename="payments-{app.name}.{output}"'
+        return response
 
-        return Response({
-            "message": "Payment claimed successfully",
-            "receipt": payment.mpesa_receipt_number
-        })
 
 # class ClaimPaymentView(APIView):
 #     """
@@ -6,6 +6,7 @@ class PaymentsConfig(AppConfig):
     name = 'payments'
 
     def ready(self):
+        from . import signals  # noqa: F401
         from .models import ExternalApp
         from django.db.utils import OperationalError, ProgrammingError
 
@@ -0,0 +1,350 @@
+"""
+Logging pipeline for the payments logger, wired up in settings.LOGGING.
+
+Request threads only put records on a queue (``BackgroundHandler``). A
+listener thread writes them as JSON lines to files that rotate on size or
+age and are gzipped once rotated. High-volume INFO
+records logged with ``extra=SAMPLED`` are kept at PAYMENTS_LOG_SAMPLE_RATE.
+Records dropped because the queue is full are counted in the
+``payments_log_records_dropped_total`` metric and logged once it drains.
+"""
+
+import atexit
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+from logging.handlers import QueueListener, TimedRotatingFileHandler
+
+
+# pass as extra= on chatty INFO logs to let SamplingFilter thin them out
+SAMPLED = {"sampled": True}
+
+# LogRecord attributes that are not user supplied extras
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sampled"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line; ``extra`` fields become top-level keys.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a ``rate`` share of records marked with SAMPLED at INFO or below.
+    Everything else passes.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or record.levelno > logging.INFO:
+            return True
+
+        return self.rate >= 1 or random.random() < self.rate
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class CompressedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    Rotates at ``when``/``interval`` like TimedRotatingFileHandler, and also
+    once the file reaches ``max_bytes``. Rotated files are gzipped.
+
+    Each process writes its own ``<name>.<pid><ext>`` (``payments.log``
+    becomes ``payments.4242.log``), so worker processes never rotate a
+    file another one is still writing. ``backupCount`` applies per
+    process; rotated files of processes that exited are deleted oldest
+    first along with the handler's own, and their last file is gzipped.
+    """
+
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.template = os.path.abspath(filename)
+        self._pid = os.getpid()
+        super().__init__(self._process_filename(), **kwargs)
+        self.max_bytes = max_bytes
+        self.namer = self._gz_name
+        self.rotator = self._gzip
+
+    def _process_filename(self):
+        root, ext = os.path.splitext(self.template)
+        return f"{root}.{self._pid}{ext}"
+
+    def _process_files(self):
+        """
+        {pid: [file names]} of every process that wrote ``template``.
+        """
+        directory, name = os.path.split(self.template)
+        root, ext = os.path.splitext(name)
+        pattern = re.compile(rf"^{re.escape(root)}\.(\d+){re.escape(ext)}(\..+)?$")
+        files = {}
+
+        for entry in os.listdir(directory):
+            match = pattern.match(entry)
+            if match:
+                files.setdefault(int(match.group(1)), []).append(entry)
+
+        return files
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # forked: the parent keeps writing its own file
+            self.acquire()
+            try:
+                if self.stream is not None:
+                    self.stream.close()
+                    self.stream = None
+                self._pid = os.getpid()
+                self.baseFilename = self._process_filename()
+            finally:
+                self.release()
+
+        super().emit(record)
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+
+        if self.max_bytes and self.stream is not None:
+            return self.stream.tell() >= self.max_bytes
+
+        return False
+
+    def doRollover(self):
+        self._gzip_orphans()
+        super().doRollover()
+
+    def _gzip_orphans(self):
+        directory = os.path.dirname(self.template)
+
+        for pid, names in self._process_files().items():
+            if pid == self._pid or _pid_alive(pid):
+                continue
+
+            for name in names:
+                if name.endswith(".gz"):
+                    continue
+
+                path = os.path.join(directory, name)
+
+                try:
+                    self._gzip(path, self.rotation_filename(f"{path}.exited"))
+                except FileNotFoundError:
+                    # another process got to it first
+                    pass
+
+    def rotation_filename(self, default_name):
+        # size rollovers can happen several times within one time bucket
+        name = super().rotation_filename(default_name)
+        base, suffix = name[:-3], ".gz"
+        index = 0
+
+        while os.path.exists(name):
+            index += 1
+            name = f"{base}.{index}{suffix}"
+
+        return name
+
+    @staticmethod
+    def _gz_name(name):
+        return f"{name}.gz"
+
+    @staticmethod
+    def _gzip(source, dest):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        # keep the time of the last write, getFilesToDelete sorts on it
+        shutil.copystat(source, dest)
+        os.remove(source)
+
+    @staticmethod
+    def _age(path):
+        # name.2026-10-18.gz, name.2026-10-18.1.gz, ... name.2026-10-18.10.gz
+        stem = path[:-3]
+        head, _, index = stem.rpartition(".")
+
+        if index.isdigit():
+            return os.path.getmtime(path), head, int(index)
+
+        return os.path.getmtime(path), stem, 0
+
+    def getFilesToDelete(self):
+        # the stock matcher doesn't know about the .gz / .N.gz suffixes
+        directory = os.path.dirname(self.template)
+        own, rotated = set(), []
+
+        for pid, names in self._process_files().items():
+            if pid != self._pid and _pid_alive(pid):
+                continue
+
+            for name in names:
+                if name.endswith(".gz"):
+                    path = os.path.join(directory, name)
+                    rotated.append(path)
+                    if pid == self._pid:
+                        own.add(path)
+
+        rotated.sort(key=self._age)
+        expired = rotated[: max(len(rotated) - self.backupCount, 0)]
+
+        for path in expired:
+            if path not in own:
+                # several processes may clear the same exited one
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        return [path for path in expired if path in own]
+
+
+def _handler_by_name(name):
+    getter = getattr(logging, "getHandlerByName", None)  # Python 3.12+
+    return getter(name) if getter else logging._handlers.get(name)
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Puts records on a queue for a listener thread that passes them to the
+    ``targets`` handlers (names of handlers in the same LOGGING dict). The
+    calling thread never touches the disk.
+
+    Not a QueueHandler subclass: dictConfig gives those special treatment
+    from Python 3.12 on.
+    """
+
+    def __init__(self, targets, maxsize=10000, level=logging.NOTSET):
+        super().__init__(level)
+        # held here, dictConfig only keeps weak references to handlers no
+        # logger uses
+        self.targets = [_handler_by_name(name) for name in targets]
+
+        if None in self.targets:
+            # dictConfig retries handlers failing with this cause once the
+            # others are configured
+            raise ValueError(f"Unknown handler in {targets}") from ValueError("target not configured yet")
+
+        self.maxsize = maxsize
+        self.queue = None
+        self.listener = None
+        # records lost to a full queue, and how many of them were logged
+        self.dropped = 0
+        self.reported = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            # a fresh queue and thread after fork
+            self.queue = queue.Queue(self.maxsize)
+            self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self._pid = None
+
+    def prepare(self, record):
+        # resolve args and traceback now, they may change once this thread
+        # moves on; extras are kept for JsonFormatter
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            # never block a request on logging
+            self._drop()
+            return
+        except Exception:
+            self.handleError(record)
+            return
+
+        if self.dropped > self.reported:
+            self._report_dropped()
+
+    def _drop(self):
+        # imported here: settings.LOGGING loads this module before Django is set up
+        from payments.services.metrics import metrics
+
+        self.dropped += 1
+        metrics.inc("payments_log_records_dropped_total")
+
+    def _report_dropped(self):
+        count = self.dropped - self.reported
+        warning = logging.makeLogRecord({
+            "name": "payments",
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": "Dropped %d log records, the log queue was full",
+            "args": (count,),
+        })
+
+        try:
+            self.queue.put_nowait(self.prepare(warning))
+        except queue.Full:
+            return
+
+        self.reported += count
@@ -0,0 +1,266 @@
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from payments.models import ExternalApp, Payment
+from payments.services.benchmark import (
+    LoadRunner,
+    StubDaraja,
+    compare,
+    new_results,
+    queries_per_request,
+    save_results,
+    scrape_query_totals,
+)
+
+
+SCENARIOS = ("stk_push", "stk_callback", "c2b_confirmation", "verify", "claim")
+
+PHONE = "254700000000"
+
+# receipts looked up by the verify scenario
+VERIFY_POOL = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive a running instance at a fixed request rate and report latency, "
+        "throughput and DB queries per request. Run the instance with "
+        "MPESA_BASE_URL pointing at the stub Daraja this command starts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target", default="http://127.0.0.1:8000", help="Base URL of the instance.")
+        parser.add_argument(
+            "--scenarios",
+            default=",".join(SCENARIOS),
+            help=f"Comma separated, from: {', '.join(SCENARIOS)}.",
+        )
+        parser.add_argument("--rate", type=float, default=20, help="Requests per second per scenario.")
+        parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario.")
+        parser.add_argument("--concurrency", type=int, default=32, help="Max requests in flight.")
+        parser.add_argument("--async", dest="use_async", action="store_true", help="Use the /api/async/ views.")
+        parser.add_argument("--stub-port", type=int, default=9100, help="Port of the stub Daraja.")
+        parser.add_argument("--no-stub", action="store_true", help="Don't start the stub (already running).")
+        parser.add_argument("--stub-latency-ms", type=float, default=150)
+        parser.add_argument("--stub-jitter-ms", type=float, default=50)
+        parser.add_argument("--stub-error-rate", type=float, default=0.0, help="Share of stub answers that are HTTP 500s.")
+        parser.add_argument("--metrics-token", default=settings.PAYMENTS_METRICS_TOKEN)
+        parser.add_argument("--output", default=None, help="Results JSON (default: benchmark-<time>.json).")
+        parser.add_argument("--baseline", default=None, help="Results JSON of an earlier run to compare with.")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Allowed slowdown against --baseline before failing (0.2 = 20%%).",
+        )
+        parser.add_argument("--keep-data", action="store_true", help="Leave the benchmark payments in the DB.")
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options["scenarios"].split(",") if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        stub = None
+        if not options["no_stub"]:
+            stub = StubDaraja(
+                port=options["stub_port"],
+                latency=options["stub_latency_ms"] / 1000,
+                jitter=options["stub_jitter_ms"] / 1000,
+                error_rate=options["stub_error_rate"],
+            ).start()
+            self.stdout.write(f"Stub Daraja on {stub.url} (run the target with MPESA_BASE_URL={stub.url})")
+
+        self.prefix = f"BN{uuid.uuid4().hex[:6].upper()}"
+        self.total = max(1, int(options["rate"] * options["duration"]))
+        self.api = "/api/async/" if options["use_async"] else "/api/"
+
+        app, _ = ExternalApp.objects.get_or_create(name="BENCHMARK")
+        self.seed(app, scenarios)
+
+        runner = LoadRunner(
+            options["target"],
+            concurrency=options["concurrency"],
+            headers={"X-API-KEY": app.api_key},
+        )
+
+        results = new_results(options["target"], {
+            key: options[key]
+            for key in ("rate", "duration", "concurrency", "use_async", "stub_latency_ms", "stub_error_rate")
+        })
+
+        try:
+            for name in scenarios:
+                path, make_request = getattr(self, name)()
+                route = (self.api + path).lstrip("/")
+
+                before = scrape_query_totals(runner.session, options["target"], options["metrics_token"])
+                stats = runner.run(make_request, options["rate"], options["duration"])
+
+                # other workers write their numbers every PAYMENTS_METRICS_FLUSH_SECONDS
+                time.sleep(settings.PAYMENTS_METRICS_FLUSH_SECONDS + 0.5)
+                after = scrape_query_totals(runner.session, options["target"], options["metrics_token"])
+
+                stats["route"] = route
+                stats["queries_per_request"] = queries_per_request(before, after, route)
+                results["scenarios"][name] = stats
+                self.report(name, stats)
+        finally:
+            runner.shutdown()
+            if stub is not None:
+                stub.stop()
+            if not options["keep_data"]:
+                self.cleanup()
+
+        output = options["output"] or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        save_results(output, results)
+        self.stdout.write(f"Results saved to {output}")
+
+        if baseline is not None:
+            regressions = compare(baseline, results, options["tolerance"])
+
+            if regressions:
+                raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def report(self, name, stats):
+        latency = stats["latency_ms"]
+        qpr = stats["queries_per_request"]
+
+        self.stdout.write(
+            f"{name:<18} {stats['throughput_rps']:>8}/s  "
+            f"p50 {latency['p50']:>8}ms  p95 {latency['p95']:>8}ms  p99 {latency['p99']:>8}ms  "
+            f"errors {stats['errors']:>5}  queries/req {qpr if qpr is not None else '-'}"
+        )
+
+    # ---------------------------
+    # Data
+    # ---------------------------
+    def seed(self, app, scenarios):
+        """
+        Payments the callback, verify and claim scenarios act on.
+        """
+        payments = []
+
+        if "stk_callback" in scenarios:
+            payments += [
+                Payment(
+                    app=app,
+                    app_name=app.name,
+                    phone_number=PHONE,
+                    amount=1,
+                    payment_type="STK",
+                    external_reference=f"{self.prefix}-CB-{i}",
+                    checkout_request_id=f"{self.prefix}-CB-{i}",
+                )
+                for i in range(self.total)
+            ]
+
+        if "verify" in scenarios:
+            payments += [
+                Payment(
+                    app=app,
+                    app_name=app.name,
+                    phone_number=PHONE,
+                    amount=1,
+                    payment_type="STK",
+                    status="SUCCESS",
+                    mpesa_receipt_number=f"{self.prefix}V{i}",
+                )
+                for i in range(min(self.total, VERIFY_POOL))
+            ]
+
+        if "claim" in scenarios:
+            admin_app = ExternalApp.objects.filter(name="ADMIN_SHOP").first()
+
+            payments += [
+                Payment(
+                    app=admin_app,
+                    app_name="ADMIN_SHOP",
+                    phone_number=PHONE,
+                    amount=1,
+                    payment_type="C2B",
+                    status="SUCCESS",
+                    mpesa_receipt_number=f"{self.prefix}C{i}",
+                )
+                for i in range(self.total)
+            ]
+
+        Payment.objects.bulk_create(payments, batch_size=1000)
+
+    def cleanup(self):
+        deleted, _ = Payment.objects.filter(
+            Q(external_reference__startswith=self.prefix)
+            | Q(mpesa_receipt_number__startswith=self.prefix)
+            | Q(checkout_request_id__startswith=self.prefix)
+        ).delete()
+        self.stdout.write(f"Removed {deleted} benchmark row(s)")
+
+    # ---------------------------
+    # Scenarios: (path, make_request)
+    # ---------------------------
+    def stk_push(self):
+        def make_request(i):
+            return "POST", self.api + "stk-push/", {"json": {
+                "phone_number": PHONE,
+                "amount": "1",
+                "reference": f"{self.prefix}-P-{i}",
+                "description": "benchmark",
+            }}
+
+        return "stk-push/", make_request
+
+    def stk_callback(self):
+        def make_request(i):
+            return "POST", self.api + "mpesa/stk-callback/", {"json": {"Body": {"stkCallback": {
+                "MerchantRequestID": f"{self.prefix}-M-{i}",
+                "CheckoutRequestID": f"{self.prefix}-CB-{i}",
+                "ResultCode": 0,
+                "ResultDesc": "The service request is processed successfully.",
+                "CallbackMetadata": {"Item": [
+                    {"Name": "Amount", "Value": 1},
+                    {"Name": "MpesaReceiptNumber", "Value": f"{self.prefix}S{i}"},
+                    {"Name": "PhoneNumber", "Value": int(PHONE)},
+                ]},
+            }}}}
+
+        return "mpesa/stk-callback/", make_request
+
+    def c2b_confirmation(self):
+        def make_request(i):
+            return "POST", self.api + "mpesa/c2b/confirmation/", {"json": {
+                "TransactionType": "Pay Bill",
+                "TransID": f"{self.prefix}T{i}",
+                "TransTime": time.strftime("%Y%m%d%H%M%S"),
+                "TransAmount": "1.00",
+                "BusinessShortCode": settings.MPESA_SHORTCODE,
+                "BillRefNumber": f"{self.prefix}-C2B",
+                "MSISDN": PHONE,
+            }}
+
+        return "mpesa/c2b/confirmation/", make_request
+
+    def verify(self):
+        pool = min(self.total, VERIFY_POOL)
+
+        def make_request(i):
+            return "GET", self.api + "payments/verify/", {"params": {"receipt": f"{self.prefix}V{i % pool}"}}
+
+        return "payments/verify/", make_request
+
+    def claim(self):
+        def make_request(i):
+            return "POST", self.api + "payments/claim/", {"json": {"receipt": f"{self.prefix}C{i}"}}
+
+        return "payments/claim/", make_request
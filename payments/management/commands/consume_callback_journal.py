@@ -0,0 +1,57 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.services.callbacks import apply_callback_batch
+from payments.services.journal import JournalConsumer
+
+
+class Command(BaseCommand):
+    help = "Apply callbacks journaled by the views (PAYMENTS_CALLBACK_INGEST_MODE=journal) to the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.PAYMENTS_CALLBACK_BATCH_SIZE,
+            help="Callbacks applied per transaction.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=0.5,
+            help="Seconds to sleep when the journal is drained.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the journal once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        consumer = JournalConsumer(
+            settings.PAYMENTS_CALLBACK_JOURNAL_DIR,
+            apply_batch=apply_callback_batch,
+            batch_size=options["batch_size"],
+        )
+
+        if not consumer.lock():
+            raise CommandError("Another consumer is already running for this journal")
+
+        self.stdout.write(f"Consuming {settings.PAYMENTS_CALLBACK_JOURNAL_DIR}")
+
+        try:
+            while True:
+                applied = consumer.run_once()
+
+                if applied:
+                    self.stdout.write(f"Applied {applied} callback(s)")
+
+                if options["once"]:
+                    break
+
+                if not applied:
+                    time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
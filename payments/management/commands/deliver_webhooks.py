@@ -0,0 +1,60 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.services.webhooks import WebhookDeliverer
+
+
+class Command(BaseCommand):
+    help = "POST queued payment webhooks to ExternalApps."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.PAYMENTS_WEBHOOK_WORKERS,
+            help="Concurrent deliveries.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Events leased per round (default: 4 x workers).",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.PAYMENTS_WEBHOOK_POLL_INTERVAL,
+            help="Seconds to sleep when nothing is due.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send what is due once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        deliverer = WebhookDeliverer(
+            workers=options["workers"],
+            batch_size=options["batch_size"],
+        )
+
+        self.stdout.write(f"Webhook deliverer started as {deliverer.owner}")
+
+        try:
+            while True:
+                sent = deliverer.run_once()
+
+                if sent:
+                    self.stdout.write(f"Attempted {sent} webhook(s)")
+                    continue
+
+                if options["once"]:
+                    break
+
+                time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            deliverer.shutdown()
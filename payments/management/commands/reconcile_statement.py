@@ -0,0 +1,76 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from payments.services.reconciliation import (
+    ISSUES,
+    REPORT_FIELDS,
+    StatementError,
+    read_statement,
+    reconcile,
+)
+
+
+class Command(BaseCommand):
+    help = "Reconcile an M-Pesa statement CSV against recorded payments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("statement", help="Path to the statement CSV.")
+        parser.add_argument(
+            "--report",
+            help="Write the discrepancies as CSV to this file (default: stdout).",
+        )
+        parser.add_argument(
+            "--start",
+            help="Only look for payments missing from the statement after this datetime "
+                 "(default: first completion time on the statement).",
+        )
+        parser.add_argument(
+            "--end",
+            help="... and before this datetime (default: last completion time).",
+        )
+        parser.add_argument("--encoding", default="utf-8-sig")
+        parser.add_argument("--chunk-size", type=int, default=None)
+
+    def parse_moment(self, value):
+        if not value:
+            return None
+
+        moment = parse_datetime(value)
+        if moment is None:
+            raise CommandError(f"Invalid datetime: {value}")
+
+        return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+    def handle(self, *args, **options):
+        start = self.parse_moment(options["start"])
+        end = self.parse_moment(options["end"])
+
+        report_file = open(options["report"], "w", newline="") if options["report"] else sys.stdout
+        summary_out = self.stdout if options["report"] else self.stderr
+
+        try:
+            writer = csv.writer(report_file)
+            writer.writerow(REPORT_FIELDS)
+
+            with open(options["statement"], encoding=options["encoding"], newline="") as statement:
+                summary = reconcile(
+                    read_statement(statement),
+                    lambda *issue: writer.writerow(issue),
+                    start=start,
+                    end=end,
+                    chunk_size=options["chunk_size"],
+                )
+        except (OSError, StatementError) as e:
+            raise CommandError(str(e))
+        finally:
+            if report_file is not sys.stdout:
+                report_file.close()
+
+        summary_out.write(f"Statement rows: {summary['statement_rows']}")
+        summary_out.write(f"Matched: {summary['matched']}")
+        for issue in ISSUES:
+            summary_out.write(f"{issue}: {summary[issue]}")
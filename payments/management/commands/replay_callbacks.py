@@ -0,0 +1,220 @@
+import json
+import secrets
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from payments.models import Payment
+from payments.services.benchmark import LoadRunner, save_results
+from payments.services.replay import (
+    PATHS,
+    STK,
+    VALIDATION,
+    Anonymizer,
+    events_from_logs,
+    events_from_payloads,
+    stk_seed,
+)
+
+
+SEED_BATCH = 1000
+
+
+def ack_outcome(response):
+    """
+    HTTP status, or "rejected" for a 200 whose ResultCode isn't 0.
+    """
+    if response.status_code != 200:
+        return response.status_code
+
+    try:
+        result_code = response.json().get("ResultCode")
+    except (ValueError, AttributeError):
+        return "bad_ack"
+
+    return 200 if str(result_code) == "0" else "rejected"
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay recorded Safaricom callbacks, anonymized, against a staging "
+        "instance at N x their original rate and report ack latency and errors."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target", default="http://127.0.0.1:8000", help="Base URL of the instance.")
+        parser.add_argument(
+            "--logs",
+            nargs="+",
+            default=None,
+            help="Read callbacks from these payments log files (.gz ok) instead of PaymentPayload.",
+        )
+        parser.add_argument("--start", help="Only callbacks received after this datetime.")
+        parser.add_argument("--end", help="... and before this datetime.")
+        parser.add_argument("--limit", type=int, default=None, help="Replay at most this many callbacks.")
+        parser.add_argument("--speed", type=float, default=1.0, help="Replay at this multiple of the original rate.")
+        parser.add_argument("--max-speed", action="store_true", help="Send as fast as possible, in the original order.")
+        parser.add_argument("--concurrency", type=int, default=64, help="Max requests in flight.")
+        parser.add_argument("--async", dest="use_async", action="store_true", help="Use the /api/async/ views.")
+        parser.add_argument(
+            "--salt",
+            default=None,
+            help="Key for the pseudonyms (default: random, so every run creates new payments).",
+        )
+        parser.add_argument(
+            "--no-seed",
+            action="store_true",
+            help="Don't create the PENDING STK payments the replayed STK callbacks settle.",
+        )
+        parser.add_argument("--output", default=None, help="Write the results as JSON to this file.")
+
+    def parse_moment(self, value):
+        if not value:
+            return None
+
+        moment = parse_datetime(value)
+        if moment is None:
+            raise CommandError(f"Invalid datetime: {value}")
+
+        return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+    def handle(self, *args, **options):
+        if options["speed"] <= 0:
+            raise CommandError("--speed must be positive")
+
+        self.options = options
+        self.start = self.parse_moment(options["start"])
+        self.end = self.parse_moment(options["end"])
+        self.anonymizer = Anonymizer(options["salt"] or secrets.token_hex(16))
+
+        if not options["no_seed"]:
+            seeded = self.seed()
+            self.stdout.write(f"Created {seeded} PENDING STK payment(s) for the replayed callbacks")
+
+        runner = LoadRunner(options["target"], concurrency=options["concurrency"])
+        self.kinds = {}
+        self.counts = {"recorded_seconds": 0}
+
+        try:
+            overall, by_path = runner.replay(self.schedule(), check=ack_outcome)
+        finally:
+            runner.shutdown()
+
+        if not overall["requests"]:
+            raise CommandError("No callbacks found to replay")
+
+        results = {
+            "started_at": timezone.now().isoformat(timespec="seconds"),
+            "target": options["target"],
+            "source": options["logs"] or "PaymentPayload",
+            "speed": None if options["max_speed"] else options["speed"],
+            "recorded_seconds": round(self.counts["recorded_seconds"], 3),
+            "overall": overall,
+            "callbacks": {self.kinds[path]: stats for path, stats in by_path.items()},
+        }
+
+        for kind, stats in [("all", overall), *sorted(results["callbacks"].items())]:
+            self.report(kind, stats)
+
+        self.stdout.write(
+            f"Recorded over {results['recorded_seconds']}s, replayed in {overall['duration_seconds']}s"
+        )
+
+        if options["output"]:
+            save_results(options["output"], results)
+            self.stdout.write(f"Results saved to {options['output']}")
+
+    def report(self, kind, stats):
+        latency = stats["latency_ms"]
+        error_rate = stats["errors"] / stats["requests"]
+
+        self.stdout.write(
+            f"{kind:<12} {stats['requests']:>8} sent  {stats['throughput_rps']:>8}/s  "
+            f"ack p50 {latency['p50']:>8}ms  p95 {latency['p95']:>8}ms  p99 {latency['p99']:>8}ms  "
+            f"errors {stats['errors']} ({error_rate:.2%})  {json.dumps(stats['statuses'])}"
+        )
+
+    def events(self):
+        """
+        Anonymized callbacks in the order they were received.
+        """
+        if self.options["logs"]:
+            events = events_from_logs(self.options["logs"], self.start, self.end)
+        else:
+            events = events_from_payloads(self.start, self.end)
+
+        sent = 0
+
+        for event in events:
+            if self.options["limit"] is not None and sent >= self.options["limit"]:
+                return
+
+            event = self.anonymizer.anonymize(event)
+
+            if event is not None:
+                sent += 1
+                yield event
+
+    def schedule(self):
+        api = "/api/async/" if self.options["use_async"] else "/api/"
+        first = None
+        offset = 0.0
+
+        for event in self.events():
+            # the async views have no validation endpoint
+            prefix = "/api/" if event.kind == VALIDATION else api
+            path = prefix + PATHS[event.kind]
+            self.kinds[path] = event.kind
+
+            if event.at is not None:
+                first = first or event.at
+                self.counts["recorded_seconds"] = (event.at - first).total_seconds()
+
+                if not self.options["max_speed"]:
+                    offset = self.counts["recorded_seconds"] / self.options["speed"]
+
+            yield offset, ("POST", path, {"json": event.body})
+
+    def seed(self):
+        """
+        Create the STK pushes the replayed callbacks answer, so they take
+        the same path as in production instead of "payment not found".
+        """
+        created = 0
+        batch = []
+
+        def flush():
+            existing = set(
+                Payment.objects.filter(
+                    checkout_request_id__in=[payment.checkout_request_id for payment in batch]
+                ).values_list("checkout_request_id", flat=True)
+            )
+            fresh = {
+                payment.checkout_request_id: payment
+                for payment in batch
+                if payment.checkout_request_id not in existing
+            }
+            Payment.objects.bulk_create(fresh.values())
+            batch.clear()
+            return len(fresh)
+
+        for event in self.events():
+            if event.kind != STK:
+                continue
+
+            checkout_id, amount, phone = stk_seed(event.body)
+            batch.append(Payment(
+                phone_number=phone[:15],
+                amount=amount,
+                payment_type="STK",
+                checkout_request_id=checkout_id,
+            ))
+
+            if len(batch) >= SEED_BATCH:
+                created += flush()
+
+        if batch:
+            created += flush()
+
+        return created
@@ -0,0 +1,60 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.services.dispatcher import StkDispatcher
+
+
+class Command(BaseCommand):
+    help = "Send STK pushes queued by STKPushView (MPESA_STK_DISPATCH_MODE=queue) to Daraja."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.MPESA_STK_DISPATCH_WORKERS,
+            help="Concurrent Daraja requests.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Jobs leased per round (default: 2 x workers).",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.MPESA_STK_DISPATCH_POLL_INTERVAL,
+            help="Seconds to sleep when the queue is empty.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the queue once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = StkDispatcher(
+            workers=options["workers"],
+            batch_size=options["batch_size"],
+        )
+
+        self.stdout.write(f"STK dispatcher started as {dispatcher.owner}")
+
+        try:
+            while True:
+                sent = dispatcher.run_once()
+
+                if sent:
+                    self.stdout.write(f"Dispatched {sent} STK push(es)")
+                    continue
+
+                if options["once"]:
+                    break
+
+                time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dispatcher.shutdown()
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments.services.idempotency import sweep_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired STK push Idempotency-Keys."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Keep running and sweep every N seconds (default: sweep once).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows deleted per statement.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                deleted = sweep_expired(batch_size=options["batch_size"])
+                self.stdout.write(f"Deleted {deleted} expired key(s)")
+
+                if not options["interval"]:
+                    break
+
+                time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
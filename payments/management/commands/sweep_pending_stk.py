@@ -0,0 +1,67 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.services.sweeper import PendingStkSweeper
+
+
+class Command(BaseCommand):
+    help = "Settle PENDING STK payments whose callback never came, using Daraja STK Query."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.MPESA_STK_QUERY_WORKERS,
+            help="Concurrent Daraja requests.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Payments leased per round (default: 10 x workers).",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=settings.MPESA_STK_QUERY_RATE,
+            help="Max STK queries per second from this process.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.MPESA_STK_QUERY_POLL_INTERVAL,
+            help="Seconds to sleep when nothing is stale.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Sweep once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        sweeper = PendingStkSweeper(
+            workers=options["workers"],
+            batch_size=options["batch_size"],
+            rate=options["rate"],
+        )
+
+        self.stdout.write(f"STK sweeper started as {sweeper.owner}")
+
+        try:
+            while True:
+                queried = sweeper.run_once()
+
+                if queried:
+                    self.stdout.write(f"Queried {queried} pending STK payment(s)")
+                    continue
+
+                if options["once"]:
+                    break
+
+                time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sweeper.shutdown()
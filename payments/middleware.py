@@ -0,0 +1,70 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from payments.services.metrics import QUERY_COUNT_BUCKETS, RequestQueries, current_queries, metrics
+
+
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and DB usage of every request by route.
+
+    Routes are the URL patterns (``api/payments/verify/``), never the raw
+    path, so ids in URLs can't blow up the number of series.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        queries = RequestQueries()
+        token = current_queries.set(queries)
+        start = time.perf_counter()
+
+        try:
+            response = self.get_response(request)
+        finally:
+            current_queries.reset(token)
+
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
+
+    async def __acall__(self, request):
+        queries = RequestQueries()
+        token = current_queries.set(queries)
+        start = time.perf_counter()
+
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_queries.reset(token)
+
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
+
+    def record(self, request, response, elapsed, queries):
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match else "<unmatched>"
+        method = request.method if request.method in METHODS else "OTHER"
+        labels = {"route": route, "method": method}
+
+        metrics.observe("payments_http_request_duration_seconds", elapsed, labels)
+        metrics.inc("payments_http_responses_total", dict(labels, status=response.status_code))
+
+        metrics.observe(
+            "payments_db_queries_per_request", queries.count, {"route": route}, buckets=QUERY_COUNT_BUCKETS
+        )
+        metrics.observe("payments_db_time_per_request_seconds", queries.seconds, {"route": route})
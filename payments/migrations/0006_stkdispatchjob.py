@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_alter_payment_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StkDispatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('description', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('QUEUED', 'QUEUED'), ('DONE', 'DONE'), ('FAILED', 'FAILED')], default='QUEUED', max_length=20)),
+                ('lease_owner', models.CharField(blank=True, max_length=100, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='dispatch_job', to='payments.payment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='stkjob_status_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_stkdispatchjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['checkout_request_id'], name='payment_checkout_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['app', 'status', 'external_reference'], name='payment_app_status_ref_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('claimed', False), ('status', 'SUCCESS')), fields=['external_reference', 'app'], name='payment_unclaimed_ref_idx'),
+        ),
+    ]
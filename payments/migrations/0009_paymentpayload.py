@@ -0,0 +1,91 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:37
+
+import json
+import zlib
+
+import django.db.models.deletion
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import migrations, models
+
+
+BATCH_SIZE = 2000
+
+
+def guess_event_type(payment):
+    if payment.payment_type == "C2B":
+        return "C2B_CONFIRMATION"
+
+    if "Body" in (payment.raw_callback or {}):
+        return "STK_CALLBACK"
+
+    return "STK_INITIATION"
+
+
+def copy_raw_callbacks(apps, schema_editor):
+    Payment = apps.get_model("payments", "Payment")
+    PaymentPayload = apps.get_model("payments", "PaymentPayload")
+
+    # the payload dates from the payment's last save, when raw_callback was
+    # last written, not from this migration
+    PaymentPayload._meta.get_field("created_at").auto_now_add = False
+
+    payments = (
+        Payment.objects.filter(raw_callback__isnull=False)
+        .only("id", "payment_type", "raw_callback", "updated_at")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+
+    batch = []
+
+    for payment in payments:
+        batch.append(PaymentPayload(
+            payment_id=payment.id,
+            event_type=guess_event_type(payment),
+            data=zlib.compress(json.dumps(payment.raw_callback, cls=DjangoJSONEncoder).encode()),
+            created_at=payment.updated_at,
+        ))
+
+        if len(batch) >= BATCH_SIZE:
+            PaymentPayload.objects.bulk_create(batch)
+            batch = []
+
+    PaymentPayload.objects.bulk_create(batch)
+
+
+def restore_raw_callbacks(apps, schema_editor):
+    Payment = apps.get_model("payments", "Payment")
+    PaymentPayload = apps.get_model("payments", "PaymentPayload")
+
+    # latest payload per payment wins, as the column used to be overwritten
+    for payload in PaymentPayload.objects.order_by("id").iterator(chunk_size=BATCH_SIZE):
+        Payment.objects.filter(pk=payload.payment_id).update(
+            raw_callback=json.loads(zlib.decompress(bytes(payload.data)))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('STK_INITIATION', 'STK Initiation'), ('STK_CALLBACK', 'STK Callback'), ('C2B_CONFIRMATION', 'C2B Confirmation')], max_length=30)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='payloads', to='payments.payment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['payment', 'event_type'], name='payload_payment_event_idx')],
+            },
+        ),
+        migrations.RunPython(copy_raw_callbacks, restore_raw_callbacks),
+        migrations.RemoveField(
+            model_name='payment',
+            name='raw_callback',
+        ),
+    ]
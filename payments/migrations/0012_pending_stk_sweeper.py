@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0011_payment_app_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='paymentpayload',
+            name='event_type',
+            field=models.CharField(choices=[('STK_INITIATION', 'STK Initiation'), ('STK_QUERY', 'STK Query'), ('STK_CALLBACK', 'STK Callback'), ('C2B_CONFIRMATION', 'C2B Confirmation')], max_length=30),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('payment_type', 'STK'), ('status', 'PENDING')), fields=['created_at'], name='payment_pending_stk_idx'),
+        ),
+    ]
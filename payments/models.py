@@ -1,7 +1,10 @@
 # payments/models.py
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+import json
 import uuid
+import zlib
 # from django.contrib.auth.models import AbstractUser
 import secrets
 
@@ -17,9 +20,15 @@ class ExternalApp(models.Model):
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # payment state changes are POSTed here, see services/webhooks.py
+    webhook_url = models.URLField(blank=True)
+    webhook_secret = models.CharField(max_length=100, blank=True)
+
     def save(self, *args, **kwargs):
         if not self.api_key:
             self.api_key = secrets.token_hex(32)
+        if self.webhook_url and not self.webhook_secret:
+            self.webhook_secret = secrets.token_hex(32)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -64,13 +73,227 @@ class Payment(models.Model):
     claimed = models.BooleanField(default=False)
     claimed_at = models.DateTimeField(null=True, blank=True)
 
-    raw_callback = models.JSONField(null=True, blank=True)
+    # raw Daraja payloads live in PaymentPayload, off the hot row
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    app = models.ForeignKey(ExternalApp, on_delete=models.CASCADE, null=True, blank=True)
+    app = models.ForeignKey(
+        ExternalApp,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        db_index=False,  # covered by the app_* indexes below
+    )
+
+    # sweep_pending_stk lease, also the earliest time to query Daraja again
+    lease_owner = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # stk_callback: get(checkout_request_id=...)
+            models.Index(fields=["checkout_request_id"], name="payment_checkout_idx"),
+            # VerifyPaymentView / ClaimPaymentView reference lookups
+            models.Index(
+                fields=["app", "status", "external_reference"],
+                name="payment_app_status_ref_idx",
+            ),
+            # claimable payments only, stays small as payments get claimed
+            models.Index(
+                fields=["external_reference", "app"],
+                name="payment_unclaimed_ref_idx",
+                condition=models.Q(status="SUCCESS", claimed=False),
+            ),
+            # sweep_pending_stk: STK pushes still waiting for a result
+            models.Index(
+                fields=["created_at"],
+                name="payment_pending_stk_idx",
+                condition=models.Q(status="PENDING", payment_type="STK"),
+            ),
+            # admin changelist: newest first, keyset pages and date ranges
+            models.Index(fields=["created_at", "id"], name="payment_created_idx"),
+            # per-app export, oldest first
+            models.Index(fields=["app", "created_at", "id"], name="payment_app_created_idx"),
+            # admin search: phone prefix
+            models.Index(fields=["phone_number"], name="payment_phone_idx"),
+        ]
 
 
     def __str__(self):
         return f"{self.phone_number} - {self.amount} - {self.status}"
+
+
+
+def compress_payload(data):
+    return zlib.compress(json.dumps(data, cls=DjangoJSONEncoder).encode())
+
+
+def decompress_payload(blob):
+    return json.loads(zlib.decompress(bytes(blob)))
+
+
+class PaymentPayload(models.Model):
+    """
+    Append-only history of the raw Daraja payloads for a payment,
+    zlib-compressed JSON. Only read for audits, never on the hot path.
+    """
+
+    EVENT_CHOICES = (
+        ("STK_INITIATION", "STK Initiation"),
+        ("STK_QUERY", "STK Query"),
+        ("STK_CALLBACK", "STK Callback"),
+        ("C2B_CONFIRMATION", "C2B Confirmation"),
+    )
+
+    payment = models.ForeignKey(
+        Payment,
+        on_delete=models.CASCADE,
+        related_name="payloads",
+        db_index=False,  # covered by payload_payment_event_idx
+    )
+
+    event_type = models.CharField(max_length=30, choices=EVENT_CHOICES)
+
+    data = models.BinaryField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["payment", "event_type"], name="payload_payment_event_idx"),
+        ]
+
+    @classmethod
+    def build(cls, payment, event_type, data):
+        return cls(payment=payment, event_type=event_type, data=compress_payload(data))
+
+    @classmethod
+    def record(cls, payment, event_type, data):
+        return cls.objects.create(payment=payment, event_type=event_type, data=compress_payload(data))
+
+    @property
+    def body(self):
+        return decompress_payload(self.data)
+
+    def __str__(self):
+        return f"{self.payment_id} - {self.event_type}"
+
+
+
+class StkDispatchJob(models.Model):
+    """
+    Durable queue of STK pushes waiting to be sent to Daraja.
+    Filled by STKPushView in queue mode, drained by run_stk_dispatcher.
+    """
+
+    STATUS_CHOICES = (
+        ("QUEUED", "QUEUED"),
+        ("DONE", "DONE"),
+        ("FAILED", "FAILED"),
+    )
+
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name="dispatch_job")
+
+    description = models.CharField(max_length=255)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="QUEUED")
+
+    # worker currently sending this job, see services/leasing.py
+    lease_owner = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    last_error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="stkjob_status_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.payment_id} - {self.status}"
+
+
+
+class WebhookEvent(models.Model):
+    """
+    Outbox of webhook deliveries. Written in the same transaction as the
+    payment change, sent by `manage.py deliver_webhooks`.
+    """
+
+    STATUS_CHOICES = (
+        ("PENDING", "PENDING"),
+        ("DELIVERED", "DELIVERED"),
+        ("DEAD", "DEAD"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    app = models.ForeignKey(ExternalApp, on_delete=models.CASCADE, related_name="webhook_events")
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="webhook_events")
+
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="PENDING")
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+
+    # worker currently sending this event, see services/leasing.py
+    lease_owner = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    last_error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                name="webhook_due_idx",
+                condition=models.Q(status="PENDING"),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} - {self.app_id} - {self.status}"
+
+
+
+class IdempotencyKey(models.Model):
+    """
+    Stored STKPushView response for an Idempotency-Key, per ExternalApp.
+    Repeats within the TTL get the stored response instead of a new push.
+    """
+
+    STATUS_CHOICES = (
+        ("IN_PROGRESS", "IN_PROGRESS"),
+        ("COMPLETED", "COMPLETED"),
+    )
+
+    app = models.ForeignKey(ExternalApp, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+
+    # sha256 of the request body, a key can't be reused for another request
+    request_hash = models.CharField(max_length=64)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="IN_PROGRESS")
+
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["app", "key"], name="idempotency_app_key_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.app} - {self.key}"
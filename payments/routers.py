@@ -0,0 +1,128 @@
+"""
+Database routing for read replicas (settings.DATABASE_REPLICAS).
+
+Every write goes to the primary ("default"), and so does every read
+unless it runs inside ``replica_reads(app)``. The verify views use that,
+and the export view passes ``read_alias(app)`` explicitly. Those reads
+go to a replica unless one of these holds:
+
+- the app is pinned: it wrote recently (STK push, claim) or one of its
+  payments settled, see ``pin_to_primary``
+- the block itself wrote something
+
+Either way the client never reads older data than it just produced or
+was told about by a webhook.
+"""
+
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+PRIMARY = "default"
+
+PIN_KEY = "payments:db:primary-pin:%s"
+
+
+class _ReplicaReads:
+    def __init__(self, app):
+        self.app = app
+        # picked on the first read, so async views don't touch the cache
+        # outside sync_to_async
+        self.alias = None
+
+
+_replica_reads = ContextVar("payments_replica_reads", default=None)
+
+
+def _pins():
+    return caches[settings.PAYMENTS_DB_PIN_CACHE_ALIAS]
+
+
+def pin_to_primary(app_ids):
+    """
+    Read these apps' payments from the primary for the next
+    PAYMENTS_DB_PIN_SECONDS, because they just changed and a replica may
+    not have caught up yet.
+    """
+    state = _replica_reads.get()
+    if state is not None:
+        # raw SQL writes (claims) don't pass through db_for_write
+        state.alias = PRIMARY
+
+    if not settings.DATABASE_REPLICAS:
+        return
+
+    keys = {PIN_KEY % app_id: 1 for app_id in set(app_ids) if app_id is not None}
+
+    if keys:
+        _pins().set_many(keys, timeout=settings.PAYMENTS_DB_PIN_SECONDS)
+
+
+def is_pinned(app_id):
+    return _pins().get(PIN_KEY % app_id) is not None
+
+
+def read_alias(app):
+    """
+    Database to read ``app``'s payments from: one of the replicas, or the
+    primary while the app is pinned to it.
+    """
+    if not settings.DATABASE_REPLICAS or is_pinned(app.pk):
+        return PRIMARY
+
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def replica_reads(app):
+    """
+    Send the reads made in this block, including those handed to
+    sync_to_async threads, to ``read_alias(app)``.
+    """
+    token = _replica_reads.set(_ReplicaReads(app))
+
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class ReplicaRouter:
+    """
+    See the module docstring. Objects read from a replica are still saved
+    to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _replica_reads.get()
+
+        if state is None:
+            return None
+
+        if state.alias is None:
+            state.alias = read_alias(state.app)
+
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        state = _replica_reads.get()
+
+        if state is not None:
+            # read our own write for the rest of the block
+            state.alias = PRIMARY
+
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
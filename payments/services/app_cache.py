@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from payments.models import ExternalApp
+
+logger = logging.getLogger("payments")
+
+
+ADMIN_SHOP = "ADMIN_SHOP"
+
+GENERATION_KEY = "payments:external_app:generation"
+
+
+class ExternalAppCache:
+    """
+    Per-process TTL/LRU cache of ExternalApp rows by API key and by name.
+
+    Entries are dropped by the ExternalApp post_save/post_delete signals in
+    this process. Other processes notice through a generation counter kept
+    in the Django cache, checked at most every
+    API_KEY_CACHE_SYNC_INTERVAL seconds.
+
+    A lookup only caches what it read if nothing was invalidated while its
+    query ran, so a read racing a key rotation can't put the old row back.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._synced_at = 0.0
+        # bumped by every clear()
+        self._epoch = 0
+
+    # ---------------------------
+    # Lookups
+    # ---------------------------
+    def by_api_key(self, api_key):
+        """
+        Active app for ``api_key``, or None.
+        """
+        key = ("api_key", api_key)
+        app = self._get(key)
+
+        if app is None:
+            epoch = self._epoch
+            app = ExternalApp.objects.filter(api_key=api_key, is_active=True).first()
+
+            if app is not None:
+                self._set(key, app, epoch)
+
+        return app
+
+    def peek_api_key(self, api_key):
+        """
+        Cached app for ``api_key`` without touching the database or the
+        shared cache, so the async views can call it on the event loop.
+        None when the generation check is due: the caller then goes
+        through by_api_key in a thread, which runs it.
+        """
+        if self._sync_due():
+            return None
+
+        return self._get(("api_key", api_key))
+
+    def peek_admin_app(self):
+        if self._sync_due():
+            return None
+
+        return self._get(("name", ADMIN_SHOP))
+
+    def admin_app(self, create=False):
+        """
+        The ADMIN_SHOP intake app, created on demand when ``create`` is set.
+        """
+        key = ("name", ADMIN_SHOP)
+        app = self._get(key)
+
+        if app is None:
+            epoch = self._epoch
+
+            if create:
+                app, _ = ExternalApp.objects.get_or_create(
+                    name=ADMIN_SHOP,
+                    defaults={
+                        "is_active": True,
+                    },
+                )
+            else:
+                app = ExternalApp.objects.filter(name=ADMIN_SHOP).first()
+
+            if app is not None:
+                self._set(key, app, epoch)
+
+        return app
+
+    # ---------------------------
+    # Invalidation
+    # ---------------------------
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+
+    def invalidate(self):
+        """
+        Drop this process's entries and tell the other processes to do the same.
+        """
+        self.clear()
+
+        if not settings.API_KEY_CACHE_SHARED_INVALIDATION:
+            return
+
+        cache = caches[settings.API_KEY_CACHE_ALIAS]
+
+        try:
+            if not cache.add(GENERATION_KEY, 1, timeout=None):
+                cache.incr(GENERATION_KEY)
+        except Exception as e:
+            logger.error("Could not publish ExternalApp cache invalidation: %s", e)
+
+    def _sync_due(self):
+        return (
+            settings.API_KEY_CACHE_SHARED_INVALIDATION
+            and time.monotonic() - self._synced_at >= settings.API_KEY_CACHE_SYNC_INTERVAL
+        )
+
+    def _sync(self):
+        if not self._sync_due():
+            return
+
+        self._synced_at = time.monotonic()
+
+        try:
+            generation = caches[settings.API_KEY_CACHE_ALIAS].get(GENERATION_KEY)
+        except Exception as e:
+            logger.error("Could not read ExternalApp cache generation: %s", e)
+            return
+
+        if generation != self._generation:
+            self._generation = generation
+            self.clear()
+
+    # ---------------------------
+    # Storage
+    # ---------------------------
+    def _get(self, key):
+        self._sync()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            app, expires_at = entry
+
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return app
+
+    def _set(self, key, app, epoch):
+        expires_at = time.monotonic() + settings.API_KEY_CACHE_TTL
+
+        with self._lock:
+            if epoch != self._epoch:
+                # invalidated while it was being read, may be stale
+                return
+
+            self._entries[key] = (app, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > settings.API_KEY_CACHE_MAX_SIZE:
+                self._entries.popitem(last=False)
+
+
+app_cache = ExternalAppCache()
@@ -0,0 +1,343 @@
+"""
+Load and latency benchmark for a running instance (see
+`manage.py benchmark`).
+
+``StubDaraja`` is a local stand-in for the Daraja API: OAuth, STK push and
+STK query with configurable latency and error rate. Point the instance
+under test at it with MPESA_BASE_URL.
+
+``LoadRunner`` sends requests at a fixed rate (open loop: a slow response
+does not delay the next request). Latency is measured from the time a
+request was due, so time spent queued behind slow requests is counted
+too.
+"""
+
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from payments.services.http import build_session
+
+
+# ---------------------------
+# Stub Daraja
+# ---------------------------
+class _StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/oauth/v1/generate"):
+            return self.answer({"access_token": f"stub-{uuid.uuid4().hex}", "expires_in": "3599"})
+        self.answer({"errorMessage": "Not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.answer({"errorMessage": "Bad JSON"}, status=400)
+
+        if self.path.startswith("/mpesa/stkpush/v1/processrequest"):
+            checkout_id = f"ws_CO_{uuid.uuid4().hex[:20]}"
+            return self.answer({
+                "MerchantRequestID": uuid.uuid4().hex[:16],
+                "CheckoutRequestID": checkout_id,
+                "ResponseCode": "0",
+                "ResponseDescription": "Success. Request accepted for processing",
+                "CustomerMessage": "Success. Request accepted for processing",
+            })
+
+        if self.path.startswith("/mpesa/stkpushquery/v1/query"):
+            return self.answer({
+                "ResponseCode": "0",
+                "CheckoutRequestID": body.get("CheckoutRequestID"),
+                "ResultCode": "0",
+                "ResultDesc": "The service request is processed successfully.",
+            })
+
+        self.answer({"errorMessage": "Not found"}, status=404)
+
+    def answer(self, data, status=200):
+        server = self.server
+        server.requests[self.path.split("?", 1)[0]] += 1
+
+        if server.latency:
+            time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+
+        if status == 200 and random.random() < server.error_rate:
+            status = 500
+            data = {
+                "requestId": uuid.uuid4().hex[:16],
+                "errorCode": "500.001.1001",
+                "errorMessage": "Stub error",
+            }
+
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubDaraja(ThreadingHTTPServer):
+    """
+    ``latency`` and ``jitter`` are in seconds; ``error_rate`` (0..1) of the
+    answers are HTTP 500s. Port 0 picks a free port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__((host, port), _StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="stub-daraja", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# ---------------------------
+# Load generation
+# ---------------------------
+def percentile(ordered, q):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples, wall):
+    """
+    Stats of a list of (latency seconds, outcome) samples; outcomes are
+    HTTP status codes or the name of what went wrong.
+    """
+    ms = sorted(latency * 1000 for latency, _ in samples)
+    statuses = Counter(outcome for _, outcome in samples)
+    errors = sum(n for outcome, n in statuses.items() if not (isinstance(outcome, int) and outcome < 400))
+
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "statuses": {str(outcome): n for outcome, n in sorted(statuses.items(), key=str)},
+        "duration_seconds": round(wall, 3),
+        "throughput_rps": round(len(samples) / wall, 2) if wall else None,
+        "latency_ms": {
+            "p50": round(percentile(ms, 50), 2),
+            "p95": round(percentile(ms, 95), 2),
+            "p99": round(percentile(ms, 99), 2),
+            "max": round(ms[-1], 2),
+            "mean": round(sum(ms) / len(ms), 2),
+        } if ms else None,
+    }
+
+
+class LoadRunner:
+
+    def __init__(self, base_url, concurrency, headers=None):
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.session = build_session(pool_size=concurrency)
+        self.session.headers.update(headers or {})
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def run(self, make_request, rate, duration):
+        """
+        Send ``rate x duration`` requests; ``make_request(i)`` returns
+        ``(method, path, requests kwargs)`` for request number ``i``.
+        Returns the stats of the run.
+        """
+        total = max(1, int(rate * duration))
+        overall, _ = self.replay((i / rate, make_request(i)) for i in range(total))
+        return overall
+
+    def replay(self, schedule, check=None):
+        """
+        Send each ``(offset seconds, (method, path, kwargs))`` of
+        ``schedule`` at its offset from now, in order. ``schedule`` may be
+        a generator, it is consumed as requests are sent.
+
+        ``check(response)`` gives the outcome recorded for a response
+        (default: its status code). Returns (stats of all requests,
+        {path: stats}).
+        """
+        check = check or (lambda response: response.status_code)
+        samples = defaultdict(list)
+        lock = threading.Lock()
+
+        # bounds the requests waiting for a worker, and so memory
+        in_flight = self.concurrency * 2
+        slots = threading.BoundedSemaphore(in_flight)
+
+        def fire(method, path, kwargs, due):
+            try:
+                try:
+                    response = self.session.request(method, self.base_url + path, timeout=60, **kwargs)
+                    outcome = check(response)
+                except requests.RequestException as e:
+                    outcome = type(e).__name__
+
+                elapsed = time.perf_counter() - due
+
+                with lock:
+                    samples[path].append((elapsed, outcome))
+            finally:
+                slots.release()
+
+        start = time.perf_counter()
+
+        for offset, (method, path, kwargs) in schedule:
+            due = start + offset
+            delay = due - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            slots.acquire()
+            self.executor.submit(fire, method, path, kwargs, due)
+
+        # wait for the stragglers
+        for _ in range(in_flight):
+            slots.acquire()
+        for _ in range(in_flight):
+            slots.release()
+
+        wall = time.perf_counter() - start
+
+        return (
+            summarize([sample for path_samples in samples.values() for sample in path_samples], wall),
+            {path: summarize(path_samples, wall) for path, path_samples in samples.items()},
+        )
+
+
+# ---------------------------
+# Queries per request, from the target's /metrics
+# ---------------------------
+_QUERY_SERIES = re.compile(
+    r'^payments_db_queries_per_request_(sum|count)\{route="(?P<route>[^"]*)"\} (?P<value>\S+)$',
+    re.MULTILINE,
+)
+
+
+def scrape_query_totals(session, base_url, token=""):
+    """
+    {route: [queries, requests]} from /metrics, or None if it can't be read.
+    """
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    try:
+        response = session.get(f"{base_url.rstrip('/')}/metrics", headers=headers, timeout=10)
+    except requests.RequestException:
+        return None
+
+    if response.status_code != 200:
+        return None
+
+    totals = {}
+
+    for match in _QUERY_SERIES.finditer(response.text):
+        series = totals.setdefault(match["route"], [0.0, 0.0])
+        series[0 if match[1] == "sum" else 1] = float(match["value"])
+
+    return totals
+
+
+def queries_per_request(before, after, route):
+    if before is None or after is None or route not in after:
+        return None
+
+    queries, requests_ = after[route]
+    old_queries, old_requests = before.get(route, (0.0, 0.0))
+
+    if requests_ == old_requests:
+        return None
+
+    return round((queries - old_queries) / (requests_ - old_requests), 2)
+
+
+# ---------------------------
+# Results
+# ---------------------------
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def new_results(target, config):
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "target": target,
+        "config": config,
+        "scenarios": {},
+    }
+
+
+def compare(baseline, current, tolerance):
+    """
+    Regressions of ``current`` against ``baseline`` beyond ``tolerance``
+    (0.2 = 20%): higher p95/p99 latency, lower throughput, more queries
+    per request, or an error rate up by more than a point. Returns a list
+    of messages.
+    """
+    regressions = []
+
+    for name, now in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+
+        for q in ("p95", "p99"):
+            old, new = before["latency_ms"][q], now["latency_ms"][q]
+            if new > old * (1 + tolerance):
+                regressions.append(f"{name}: {q} {old}ms -> {new}ms")
+
+        old, new = before["throughput_rps"], now["throughput_rps"]
+        if new < old * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old}/s -> {new}/s")
+
+        old, new = before.get("queries_per_request"), now.get("queries_per_request")
+        if old is not None and new is not None and new > old:
+            regressions.append(f"{name}: queries per request {old} -> {new}")
+
+        old = before["errors"] / before["requests"]
+        new = now["errors"] / now["requests"]
+        if new > old + 0.01:
+            regressions.append(f"{name}: error rate {old:.1%} -> {new:.1%}")
+
+    return regressions
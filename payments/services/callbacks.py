@@ -0,0 +1,286 @@
+"""
+Parsing and recording of Daraja callbacks, shared by the views and the
+callback journal consumer.
+"""
+
+import logging
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from payments.models import Payment, PaymentPayload
+from payments.services.app_cache import app_cache
+from payments.services.dedupe import count_duplicate, recent_c2b_receipts
+from payments.routers import pin_to_primary
+from payments.services.notifier import publish_on_commit
+from payments.services.webhooks import enqueue_payment_events
+
+logger = logging.getLogger("payments")
+
+
+# journal record kinds
+C2B = "c2b"
+STK = "stk"
+
+
+def parse_stk_callback(data):
+    """
+    Pull the fields we store out of an STK callback body.
+    Raises KeyError/TypeError on a malformed payload.
+    """
+    stk_data = data["Body"]["stkCallback"]
+
+    receipt_number = None
+
+    if stk_data["ResultCode"] == 0:
+        metadata = stk_data.get("CallbackMetadata", {}).get("Item", [])
+
+        for item in metadata:
+            if item["Name"] == "MpesaReceiptNumber":
+                receipt_number = item["Value"]
+
+    return {
+        "checkout_request_id": stk_data["CheckoutRequestID"],
+        "result_code": stk_data["ResultCode"],
+        "result_desc": stk_data["ResultDesc"],
+        "receipt_number": receipt_number,
+    }
+
+
+def c2b_payment_fields(data):
+    """
+    Payment fields for a C2B confirmation body.
+    """
+    return {
+        "phone_number": data.get("MSISDN"),
+        "amount": data.get("TransAmount"),
+        "external_reference": data.get("BillRefNumber"),
+        "mpesa_receipt_number": data.get("TransID"),
+        "payment_type": "C2B",
+        "status": "SUCCESS",
+    }
+
+
+# ---------------------------
+# Applying callbacks
+# ---------------------------
+def is_duplicate_c2b(data):
+    """
+    True if this process recently recorded the confirmation's TransID.
+    """
+    receipt = data.get("TransID")
+
+    if receipt and receipt in recent_c2b_receipts:
+        count_duplicate("memory")
+        logger.info("C2B DUPLICATE IGNORED: Receipt=%s", receipt)
+        return True
+
+    return False
+
+
+def remember_c2b(data):
+    receipt = data.get("TransID")
+
+    if receipt:
+        recent_c2b_receipts.add(receipt)
+
+
+def apply_c2b_confirmation(data):
+    """
+    Record a C2B confirmation under the ADMIN_SHOP intake app.
+
+    Idempotent on TransID: a re-delivered confirmation hits the unique
+    receipt constraint and is counted as a duplicate instead of failing.
+    Returns True if a payment was recorded, False for a duplicate. Any
+    other IntegrityError (a malformed body missing MSISDN, TransAmount...)
+    is raised, so the caller can make Safaricom retry.
+    """
+    admin_app = app_cache.admin_app(create=True)
+
+    try:
+        with transaction.atomic():
+            payment = Payment.objects.create(
+                app=admin_app,  # ✅ assign owner
+                **c2b_payment_fields(data),
+            )
+            PaymentPayload.record(payment, "C2B_CONFIRMATION", data)
+            enqueue_payment_events([payment])
+    except IntegrityError:
+        receipt = data.get("TransID")
+
+        if not receipt or not Payment.objects.filter(mpesa_receipt_number=receipt).exists():
+            logger.error("C2B CONFIRMATION NOT RECORDED: Receipt=%s", receipt, exc_info=True)
+            raise
+
+        count_duplicate("database")
+        remember_c2b(data)
+        logger.info("C2B DUPLICATE IGNORED: Receipt=%s", receipt)
+        return False
+
+    remember_c2b(data)
+
+    logger.info(
+        "PAYMENT RECORDED: Receipt=%s Amount=%s", data.get('TransID'), data.get('TransAmount')
+    )
+
+    return True
+
+
+def apply_stk_callback(data):
+    """
+    Update the STK payment the callback belongs to.
+    Raises Payment.DoesNotExist for an unknown CheckoutRequestID.
+
+    The row is locked while the callback is applied and only the result
+    fields are written, so a concurrent claim or sweeper lease is not
+    undone. A re-delivered callback changes nothing.
+    """
+    callback = parse_stk_callback(data)
+
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().get(
+            checkout_request_id=callback["checkout_request_id"]
+        )
+
+        if _stk_callback_applied(payment, callback):
+            logger.info("STK CALLBACK ALREADY APPLIED: %s", callback["checkout_request_id"])
+            return
+
+        _update_stk_payment(payment, callback)
+
+        payment.save(update_fields=["status", "mpesa_receipt_number", "updated_at"])
+        PaymentPayload.record(payment, "STK_CALLBACK", data)
+        enqueue_payment_events([payment])
+        publish_on_commit([payment.id])
+        pin_to_primary([payment.app_id])
+
+
+def _update_stk_payment(payment, callback):
+    if callback["result_code"] == 0:
+        # SUCCESS
+        payment.status = "SUCCESS"
+        payment.mpesa_receipt_number = callback["receipt_number"]
+
+        logger.info("Payment SUCCESS: %s", callback['receipt_number'])
+
+    else:
+        payment.status = "FAILED"
+        logger.warning("Payment FAILED: %s", callback['result_desc'])
+
+
+def apply_callback_batch(records):
+    """
+    Apply journaled callbacks (see services/journal.py) in bulk.
+
+    ``records`` are {"kind": "c2b" | "stk", "body": {...}} dicts. C2B
+    confirmations go in with one bulk_create, STK results with one
+    bulk_update. Applying the same records twice is harmless, which is what
+    makes journal replay after a crash safe.
+    """
+    c2b = [r["body"] for r in records if r.get("kind") == C2B]
+    stk = [r["body"] for r in records if r.get("kind") == STK]
+
+    try:
+        with transaction.atomic():
+            _apply_c2b_batch(c2b)
+            _apply_stk_batch(stk)
+    except IntegrityError as e:
+        # one bad record must not block the journal, apply them one by one
+        logger.warning("Callback batch failed (%s), applying records one by one", e)
+
+        for record in records:
+            try:
+                with transaction.atomic():
+                    if record.get("kind") == C2B:
+                        _apply_c2b_batch([record["body"]])
+                    else:
+                        _apply_stk_batch([record["body"]])
+            except IntegrityError as e:
+                logger.error("Dropping journaled %s callback: %s", record.get('kind'), e)
+
+
+def _apply_c2b_batch(bodies):
+    if not bodies:
+        return
+
+    admin_app = app_cache.admin_app(create=True)
+
+    payments = [
+        (Payment(app=admin_app, **c2b_payment_fields(data)), data)
+        for data in bodies
+    ]
+
+    # receipts are unique, replays and Daraja re-deliveries are skipped
+    Payment.objects.bulk_create([p for p, _ in payments], ignore_conflicts=True)
+
+    # ids are generated client side, keep the payloads of rows that went in
+    inserted = set(
+        Payment.objects.filter(pk__in=[p.pk for p, _ in payments])
+        .values_list("pk", flat=True)
+    )
+
+    PaymentPayload.objects.bulk_create([
+        PaymentPayload.build(payment, "C2B_CONFIRMATION", data)
+        for payment, data in payments
+        if payment.pk in inserted
+    ])
+    enqueue_payment_events([p for p, _ in payments if p.pk in inserted])
+
+    logger.info("C2B BATCH RECORDED: %s confirmation(s)", len(bodies))
+
+
+def _stk_callback_applied(payment, callback):
+    if callback["result_code"] == 0:
+        return payment.status == "SUCCESS" and payment.mpesa_receipt_number == callback["receipt_number"]
+
+    return payment.status == "FAILED"
+
+
+def _apply_stk_batch(bodies):
+    callbacks = {}
+
+    for data in bodies:
+        try:
+            callback = parse_stk_callback(data)
+        except (KeyError, TypeError) as e:
+            logger.error("Skipping malformed STK callback: %s", e)
+            continue
+
+        callbacks[callback["checkout_request_id"]] = (callback, data)
+
+    if not callbacks:
+        return
+
+    found = Payment.objects.filter(checkout_request_id__in=list(callbacks))
+    now = timezone.now()
+
+    payments = []
+    payloads = []
+
+    for payment in found:
+        callback, data = callbacks.pop(payment.checkout_request_id)
+
+        if _stk_callback_applied(payment, callback):
+            # replayed after a crash between commit and checkpoint
+            continue
+
+        _update_stk_payment(payment, callback)
+        # bulk_update skips auto_now
+        payment.updated_at = now
+        payments.append(payment)
+        payloads.append(PaymentPayload.build(payment, "STK_CALLBACK", data))
+
+    for checkout_request_id in callbacks:
+        logger.error("Payment not found for CheckoutRequestID %s", checkout_request_id)
+
+    if not payments:
+        return
+
+    Payment.objects.bulk_update(
+        payments,
+        ["status", "mpesa_receipt_number", "updated_at"],
+    )
+    PaymentPayload.objects.bulk_create(payloads)
+    enqueue_payment_events(payments)
+    publish_on_commit(p.id for p in payments)
+    pin_to_primary(p.app_id for p in payments)
@@ -0,0 +1,215 @@
+import logging
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from payments.models import Payment
+from payments.routers import pin_to_primary
+
+logger = logging.getLogger("payments")
+
+
+CLAIMED = "CLAIMED"
+ALREADY_CLAIMED = "ALREADY_CLAIMED"
+NOT_FOUND = "NOT_FOUND"
+
+
+def claim_payment(app, admin_app, receipt=None, reference=None):
+    """
+    Claim one SUCCESS payment owned by ``app`` or by the ADMIN_SHOP intake.
+
+    A single conditional UPDATE finds the payment, checks it is unclaimed,
+    marks it claimed and moves ADMIN_SHOP payments to ``app``. When several
+    apps race for the same receipt only one UPDATE matches, so there is
+    exactly one winner.
+
+    Returns (outcome, receipt) where outcome is CLAIMED, ALREADY_CLAIMED or
+    NOT_FOUND.
+    """
+    qn = connection.ops.quote_name
+    table = qn(Payment._meta.db_table)
+
+    if receipt:
+        column, value = "mpesa_receipt_number", receipt
+    else:
+        column, value = "external_reference", reference
+
+    match = (
+        f"{qn('status')} = %s AND {qn('claimed')} = %s "
+        f"AND {qn('app_id')} IN (%s, %s) AND {qn(column)} = %s"
+    )
+    match_params = ["SUCCESS", False, app.id, admin_app.id, value]
+
+    if receipt:
+        # receipt is unique, match the row directly
+        where, where_params = match, match_params
+    else:
+        # a reference can repeat, take the oldest unclaimed one
+        where = (
+            f"{qn('id')} IN (SELECT {qn('id')} FROM {table} WHERE {match} "
+            f"ORDER BY {qn('created_at')} LIMIT 1) AND {qn('claimed')} = %s"
+        )
+        where_params = match_params + [False]
+
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+
+    sql = (
+        f"UPDATE {table} SET {qn('claimed')} = %s, {qn('claimed_at')} = %s, "
+        f"{qn('updated_at')} = %s, "
+        f"{qn('app_id')} = CASE WHEN {qn('app_id')} = %s THEN %s ELSE {qn('app_id')} END "
+        f"WHERE {where} "
+        f"RETURNING {qn('mpesa_receipt_number')}"
+    )
+    params = [True, now, now, admin_app.id, app.id] + where_params
+
+    row = _update_returning(sql, params)
+
+    if not receipt:
+        # PostgreSQL runs the LIMIT 1 subquery before locking the row; if
+        # another claim took that row meanwhile, the recheck of claimed
+        # fails even though a newer payment with this reference is free.
+        # Every lost round means another claim won a row, so this ends.
+        unclaimed = Payment.objects.filter(
+            status="SUCCESS",
+            claimed=False,
+            app__in=[app, admin_app],
+            external_reference=reference,
+        )
+
+        while row is None and unclaimed.exists():
+            row = _update_returning(sql, params)
+
+    if row:
+        # its next verify must see claimed=True (and the new owner)
+        pin_to_primary([app.id])
+        logger.info("PAYMENT CLAIMED: %s by %s", row[0], app.name)
+        return CLAIMED, row[0]
+
+    # nothing updated: tell "already claimed" apart from "not found"
+    exists = Payment.objects.filter(
+        status="SUCCESS",
+        app__in=[app, admin_app],
+        **{column: value},
+    ).exists()
+
+    return (ALREADY_CLAIMED if exists else NOT_FOUND), receipt
+
+
+def _update_returning(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+def claim_payments(app, admin_app, receipts=(), references=()):
+    """
+    Bulk version of claim_payment.
+
+    One SELECT resolves every receipt/reference, one conditional UPDATE
+    claims all the unclaimed matches (same ownership rules as
+    claim_payment). Rows another request claimed in between are simply not
+    returned by the UPDATE.
+
+    Returns a list of {"receipt" | "reference": value, "status": ...} in
+    input order (receipts, then references), status being "claimed",
+    "already_claimed" or "not_found". An identifier repeated, or a receipt
+    and a reference of the same payment, claim it once; the later ones get
+    "already_claimed".
+    """
+    rows = (
+        Payment.objects.filter(status="SUCCESS", app__in=[app, admin_app])
+        .filter(
+            Q(mpesa_receipt_number__in=receipts)
+            | Q(external_reference__in=references)
+        )
+        .order_by("created_at")
+        .values("id", "mpesa_receipt_number", "external_reference", "claimed")
+    )
+
+    by_receipt = {}
+    by_reference = {}
+
+    for row in rows:
+        by_receipt[row["mpesa_receipt_number"]] = row
+        by_reference.setdefault(row["external_reference"], []).append(row)
+
+    # pick the row each identifier claims; a row two identifiers resolve to
+    # is claimed by the first, the second finds it already claimed
+    items = []
+    chosen = {}
+
+    for receipt in receipts:
+        row = by_receipt.get(receipt)
+        items.append(("receipt", receipt, row, _choose(chosen, row)))
+
+    for reference in references:
+        matches = by_reference.get(reference, [])
+        # the oldest unclaimed one, like claim_payment
+        row = next((r for r in matches if not r["claimed"]), matches[0] if matches else None)
+        items.append(("reference", reference, row, _choose(chosen, row)))
+
+    won = _claim_rows(app, admin_app, list(chosen)) if chosen else set()
+
+    if won:
+        pin_to_primary([app.id])
+
+    results = []
+
+    for kind, value, row, claims in items:
+        if row is None:
+            result = {kind: value, "status": "not_found"}
+        elif claims and row["id"] in won:
+            result = {kind: value, "status": "claimed"}
+        else:
+            result = {kind: value, "status": "already_claimed"}
+
+        if row is not None:
+            result["receipt"] = row["mpesa_receipt_number"]
+
+        results.append(result)
+
+    logger.info("BULK CLAIM: %s payment(s) claimed by %s", len(won), app.name)
+
+    return results
+
+
+def _choose(chosen, row):
+    """
+    Add ``row`` to the rows to claim, True if this identifier claims it.
+    """
+    if row is None or row["claimed"] or row["id"] in chosen:
+        return False
+
+    chosen[row["id"]] = row
+    return True
+
+
+def _claim_rows(app, admin_app, ids):
+    """
+    Claim the given payment ids in one UPDATE, return the ids won.
+    """
+    qn = connection.ops.quote_name
+    table = qn(Payment._meta.db_table)
+    pk = Payment._meta.pk
+
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    placeholders = ", ".join(["%s"] * len(ids))
+
+    sql = (
+        f"UPDATE {table} SET {qn('claimed')} = %s, {qn('claimed_at')} = %s, "
+        f"{qn('updated_at')} = %s, "
+        f"{qn('app_id')} = CASE WHEN {qn('app_id')} = %s THEN %s ELSE {qn('app_id')} END "
+        f"WHERE {qn('id')} IN ({placeholders}) AND {qn('claimed')} = %s "
+        f"AND {qn('app_id')} IN (%s, %s) "
+        f"RETURNING {qn('id')}"
+    )
+    params = (
+        [True, now, now, admin_app.id, app.id]
+        + [pk.get_db_prep_value(i, connection) for i in ids]
+        + [False, app.id, admin_app.id]
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {pk.to_python(row[0]) for row in cursor.fetchall()}
@@ -1,9 +1,15 @@
 import requests
 import base64
+import hashlib
 from datetime import datetime
 from django.conf import settings
 import logging
 
+from payments.logs import SAMPLED
+from payments.services.http import daraja_timeout, get_daraja_session
+from payments.services.metrics import track_daraja
+from payments.services.token_cache import get_token_cache
+
 logger = logging.getLogger("payments")
 
 
@@ -18,24 +24,65 @@ class DarajaService:
         self.callback_url = settings.MPESA_CALLBACK_URL
         self.environment = settings.MPESA_ENVIRONMENT
 
-        if self.environment == "live":
+        if settings.MPESA_BASE_URL:
+            # e.g. the stub server of `manage.py benchmark`
+            self.base_url = settings.MPESA_BASE_URL.rstrip("/")
+        elif self.environment == "live":
             self.base_url = "https://api.safaricom.co.ke"
         else:
             self.base_url = "https://sandbox.safaricom.co.ke"
 
+        # pooled keep-alive session shared by the whole process
+        self.session = get_daraja_session()
+
     # ---------------------------
     # 1️⃣ Generate Access Token
     # ---------------------------
     def get_access_token(self):
-
+        """
+        Cached token shared by all workers, see TokenCache.
+        """
+        with track_daraja("get_access_token"):
+            return self.token_cache().get()
+
+    def token_cache(self):
+        # a token from a stub server must never be used against Daraja
+        key_hash = hashlib.sha256(f"{self.base_url}:{self.consumer_key}".encode()).hexdigest()[:16]
+        cache_key = f"daraja:token:{self.environment}:{key_hash}"
+
+        return get_token_cache(cache_key, self.fetch_access_token)
+
+    def fetch_access_token(self):
+        """
+        Request a new token from Daraja.
+        Returns (access_token, expires_in seconds).
+        """
         url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
 
-        response = requests.get(
-            url,
-            auth=(self.consumer_key, self.consumer_secret)
-        )
+        try:
+            with track_daraja("fetch_access_token") as call:
+                response = self.session.get(
+                    url,
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=daraja_timeout(),
+                )
+                call.status = response.status_code
+        except requests.RequestException as e:
+            logger.error("Daraja token request failed: %s", e)
+            return None, 0
 
-        return response.json().get("access_token")
+        try:
+            data = response.json()
+        except ValueError:
+            logger.error("Invalid token response from Daraja: %s", response.status_code)
+            return None, 0
+
+        access_token = data.get("access_token")
+        if not access_token:
+            logger.error("Daraja token request failed: %s", data)
+
+        # Daraja sends expires_in as a string, e.g. "3599"
+        return access_token, int(data.get("expires_in") or 3599)
 
     # ---------------------------
     # 2️⃣ Generate STK Password
@@ -50,9 +97,10 @@ class DarajaService:
     # ---------------------------
     # 3️⃣ Initiate STK Push
     # ---------------------------
-    def stk_push(self, phone_number, amount, reference, description):
-
-        access_token = self.get_access_token()
+    def build_stk_request(self, access_token, phone_number, amount, reference, description):
+        """
+        (url, headers, payload) for an STK push, shared with AsyncDarajaService.
+        """
         password, timestamp = self.generate_password()
 
         url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
@@ -76,12 +124,82 @@ class DarajaService:
             "TransactionDesc": description,
         }
 
-        logger.info(f"Initiating STK for {phone_number} amount {amount}")
+        return url, headers, payload
+
+    def stk_push(self, phone_number, amount, reference, description):
+
+        access_token = self.get_access_token()
 
-        
-        response = requests.post(url, json=payload, headers=headers)
-        logger.info(f"Daraja Response: {response.json()}")
+        url, headers, payload = self.build_stk_request(
+            access_token, phone_number, amount, reference, description
+        )
 
+        logger.info("Initiating STK for %s amount %s", phone_number, amount)
+
+        try:
+            # POST is not retried once sent, a retry would push twice
+            with track_daraja("stk_push") as call:
+                response = self.session.post(
+                    url, json=payload, headers=headers, timeout=daraja_timeout()
+                )
+                call.status = response.status_code
+        except requests.RequestException as e:
+            logger.error("Daraja STK request failed: %s", e)
+            return {
+                "error": "Daraja request failed",
+                "detail": str(e),
+            }
+
+        try:
+            data = response.json()
+            logger.info("Daraja Response: %s", data, extra=SAMPLED)
+            return data
+        except ValueError:
+            return {
+                "error": "Invalid response from Daraja",
+                "status_code": response.status_code,
+                "response_text": response.text
+            }
+
+    # ---------------------------
+    # 4️⃣ Query STK Status
+    # ---------------------------
+    def stk_query(self, checkout_request_id):
+        """
+        Ask Daraja for the result of an STK push whose callback never came.
+
+        Returns Daraja's response; ResultCode is only present once the
+        customer has answered or the push timed out.
+        """
+        access_token = self.get_access_token()
+        password, timestamp = self.generate_password()
+
+        url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
+
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+
+        try:
+            with track_daraja("stk_query") as call:
+                response = self.session.post(
+                    url, json=payload, headers=headers, timeout=daraja_timeout()
+                )
+                call.status = response.status_code
+        except requests.RequestException as e:
+            logger.error("Daraja STK query failed for %s: %s", checkout_request_id, e)
+            return {
+                "error": "Daraja request failed",
+                "detail": str(e),
+            }
 
         try:
             return response.json()
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from payments.logs import SAMPLED
+from payments.services.daraja import DarajaService
+from payments.services.metrics import track_daraja
+
+logger = logging.getLogger("payments")
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    One pooled httpx.AsyncClient per event loop (uvicorn runs one per worker).
+    Connection failures are retried by the transport; sent requests are not.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.MPESA_HTTP_POOL_SIZE,
+                max_keepalive_connections=settings.MPESA_HTTP_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(
+                settings.MPESA_HTTP_READ_TIMEOUT,
+                connect=settings.MPESA_HTTP_CONNECT_TIMEOUT,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=settings.MPESA_HTTP_MAX_RETRIES),
+        )
+        _clients[loop] = client
+
+    return client
+
+
+class AsyncDarajaService(DarajaService):
+    """
+    Non-blocking DarajaService for the async views.
+
+    Shares configuration, payload building and the OAuth TokenCache with
+    the sync service.
+    """
+
+    async def get_access_token(self):
+        token_cache = self.token_cache()
+
+        with track_daraja("get_access_token"):
+            token = token_cache.peek()
+            if token:
+                return token
+
+            # refresh (or wait for another worker's refresh) off the event loop
+            return await sync_to_async(token_cache.get, thread_sensitive=False)()
+
+    async def stk_push(self, phone_number, amount, reference, description):
+
+        access_token = await self.get_access_token()
+
+        url, headers, payload = self.build_stk_request(
+            access_token, phone_number, amount, reference, description
+        )
+
+        logger.info("Initiating STK for %s amount %s", phone_number, amount)
+
+        try:
+            with track_daraja("stk_push") as call:
+                response = await get_async_client().post(url, json=payload, headers=headers)
+                call.status = response.status_code
+        except httpx.HTTPError as e:
+            logger.error("Daraja STK request failed: %s", e)
+            return {
+                "error": "Daraja request failed",
+                "detail": str(e),
+            }
+
+        try:
+            data = response.json()
+            logger.info("Daraja Response: %s", data, extra=SAMPLED)
+            return data
+        except ValueError:
+            return {
+                "error": "Invalid response from Daraja",
+                "status_code": response.status_code,
+                "response_text": response.text
+            }
@@ -0,0 +1,62 @@
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+
+class RecentKeys:
+    """
+    Bounded, thread-safe set of recently seen keys (oldest dropped first).
+
+    Used to turn away Daraja re-deliveries without a database round-trip.
+    It is only a fast path: a key that has been evicted, or was seen by
+    another worker, is still caught by the database unique constraint.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+
+            while len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+recent_c2b_receipts = RecentKeys(settings.PAYMENTS_C2B_DEDUPE_SIZE)
+
+
+# duplicates absorbed since process start, by where they were caught
+_duplicates = Counter()
+_duplicates_lock = threading.Lock()
+
+
+def count_duplicate(source):
+    with _duplicates_lock:
+        _duplicates[source] += 1
+
+
+def duplicate_counts():
+    """
+    {"memory": n, "database": n}
+    """
+    with _duplicates_lock:
+        return {
+            "memory": _duplicates["memory"],
+            "database": _duplicates["database"],
+        }
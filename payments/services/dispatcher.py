@@ -0,0 +1,125 @@
+import logging
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from payments.models import PaymentPayload, StkDispatchJob
+from payments.services.daraja import DarajaService
+from payments.services.leasing import lease_rows
+
+logger = logging.getLogger("payments")
+
+
+class StkDispatcher:
+    """
+    Sends queued STK pushes to Daraja with a pool of worker threads.
+
+    Jobs are leased before sending, so several dispatcher processes (or
+    nodes) can drain the same queue without sending a push twice.
+    """
+
+    def __init__(self, workers=None, batch_size=None, lease_seconds=None):
+        self.workers = workers or settings.MPESA_STK_DISPATCH_WORKERS
+        self.batch_size = batch_size or self.workers * 2
+        self.lease = timedelta(seconds=lease_seconds or settings.MPESA_STK_DISPATCH_LEASE_SECONDS)
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="stk-dispatch",
+        )
+
+    def run_once(self):
+        """
+        Lease one batch of queued jobs and send them concurrently.
+        Returns the number of jobs processed.
+        """
+        queued = StkDispatchJob.objects.filter(status="QUEUED").order_by("created_at")
+
+        jobs = list(
+            lease_rows(queued, self.owner, self.batch_size, self.lease)
+            .select_related("payment")
+        )
+
+        if jobs:
+            list(self.executor.map(self.dispatch, jobs))
+
+        return len(jobs)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def dispatch(self, job):
+        close_old_connections()
+
+        payment = job.payment
+
+        try:
+            response = DarajaService().stk_push(
+                phone_number=payment.phone_number,
+                amount=payment.amount,
+                reference=payment.external_reference,
+                description=job.description,
+            )
+        except Exception as e:
+            logger.error("STK dispatch failed for payment %s: %s", payment.id, e)
+            response = {"error": str(e)}
+
+        try:
+            self._record(job, payment, response)
+        finally:
+            close_old_connections()
+
+    def _record(self, job, payment, response):
+        accepted = bool(response.get("CheckoutRequestID"))
+        # a timeout or connection error, Daraja's own errors carry a code
+        unsent = not accepted and "error" in response and "errorCode" not in response
+
+        if accepted:
+            payment.checkout_request_id = response.get("CheckoutRequestID")
+            payment.merchant_request_id = response.get("MerchantRequestID")
+            job.status = "DONE"
+            logger.info("STK dispatched for payment %s", payment.id)
+        elif unsent:
+            # the payment stays PENDING, the job is sent again once our
+            # lease runs out
+            job.last_error = str(response)
+            logger.warning("STK dispatch for payment %s not sent, will retry: %s", payment.id, response)
+        else:
+            # Daraja rejected it, the customer never got a prompt
+            payment.status = "FAILED"
+            job.status = "FAILED"
+            job.last_error = str(response)
+            logger.warning("STK dispatch rejected for payment %s: %s", payment.id, response)
+
+        with transaction.atomic():
+            if accepted:
+                # kept even if the lease was lost, the customer got this
+                # prompt and its callback has to find the payment
+                payment.save(update_fields=["checkout_request_id", "merchant_request_id", "updated_at"])
+                PaymentPayload.record(payment, "STK_INITIATION", response)
+
+            # the job only moves on while we still hold the lease; once it
+            # expired the job may have gone to another dispatcher
+            lease = {} if unsent else {"lease_owner": None, "lease_expires_at": None}
+
+            recorded = StkDispatchJob.objects.filter(pk=job.pk, lease_owner=self.owner).update(
+                status=job.status,
+                last_error=job.last_error,
+                updated_at=timezone.now(),
+                **lease,
+            )
+
+            if not recorded:
+                logger.warning("Lost the lease on STK dispatch job %s: %s", job.pk, response)
+                return
+
+            if not accepted and not unsent:
+                payment.save(update_fields=["status", "updated_at"])
+                PaymentPayload.record(payment, "STK_INITIATION", response)
@@ -0,0 +1,131 @@
+import csv
+import json
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from payments.models import Payment
+
+
+CSV = "csv"
+NDJSON = "ndjson"
+
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    NDJSON: "application/x-ndjson",
+}
+
+FIELDS = (
+    "id",
+    "created_at",
+    "external_reference",
+    "phone_number",
+    "amount",
+    "mpesa_receipt_number",
+    "checkout_request_id",
+    "payment_type",
+    "status",
+    "claimed",
+    "claimed_at",
+)
+
+# rows are joined into one write, fewer tiny chunks for the server and gzip
+ROWS_PER_WRITE = 500
+
+
+def parse_cursor(value):
+    """
+    ``"<created_at>,<id>"`` of the last row received, or None if malformed.
+    """
+    created_at, _, pk = value.partition(",")
+
+    try:
+        created_at = parse_datetime(created_at)
+        pk = uuid.UUID(pk)
+    except ValueError:
+        return None
+
+    if created_at is None:
+        return None
+
+    return created_at, pk
+
+
+def export_rows(app, start=None, end=None, after=None, using=None):
+    """
+    The app's payments oldest first, as tuples in FIELDS order.
+
+    Rows are read in chunks through a server-side cursor where the database
+    supports one, so memory stays flat however many rows match. ``after``
+    is a parsed cursor; only rows past it are returned. ``using`` picks the
+    database alias (a replica, see payments/routers.py).
+    """
+    payments = Payment.objects.using(using).filter(app=app)
+
+    if start:
+        payments = payments.filter(created_at__gte=start)
+    if end:
+        payments = payments.filter(created_at__lt=end)
+
+    if after:
+        created_at, pk = after
+        payments = payments.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+        )
+
+    return (
+        payments.order_by("created_at", "id")
+        .values_list(*FIELDS)
+        .iterator(chunk_size=settings.PAYMENTS_EXPORT_CHUNK_SIZE)
+    )
+
+
+class _Echo:
+    """
+    File-like object for csv.writer that hands back what it is given.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _full_precision(row):
+    # DjangoJSONEncoder cuts datetimes to milliseconds, the cursor needs
+    # the exact stored value
+    return [value.isoformat() if isinstance(value, datetime) else value for value in row]
+
+
+def _csv_lines(rows):
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(FIELDS)
+
+    for row in rows:
+        yield writer.writerow(_full_precision(row))
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, _full_precision(row))), cls=DjangoJSONEncoder) + "\n"
+
+
+def stream_export(rows, output):
+    """
+    Encode ``rows`` as CSV or NDJSON, yielding a few hundred rows at a time.
+    """
+    lines = _csv_lines(rows) if output == CSV else _ndjson_lines(rows)
+    buffer = []
+
+    for line in lines:
+        buffer.append(line)
+
+        if len(buffer) >= ROWS_PER_WRITE:
+            yield "".join(buffer)
+            buffer = []
+
+    if buffer:
+        yield "".join(buffer)
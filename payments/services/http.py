@@ -0,0 +1,121 @@
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class JitteredRetry(Retry):
+    """
+    urllib3 Retry with random jitter added to every backoff sleep, so workers
+    that failed together don't retry together.
+    """
+
+    jitter = 0.5
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.jitter = self.jitter
+        return retry
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+
+        if backoff <= 0:
+            return backoff
+
+        return backoff + random.uniform(0, self.jitter)
+
+
+def build_session(pool_size, max_retries=0, backoff_factor=0.5, jitter=0.5):
+    """
+    A requests.Session with a keep-alive connection pool.
+
+    Retries only apply to idempotent methods (GET, HEAD, ...) and to
+    connection errors that happen before the request was sent.
+    """
+    retry = JitteredRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    retry.jitter = jitter
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_daraja_session():
+    """
+    Process-wide session used for all Daraja calls.
+    """
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session(
+                    pool_size=settings.MPESA_HTTP_POOL_SIZE,
+                    max_retries=settings.MPESA_HTTP_MAX_RETRIES,
+                    backoff_factor=settings.MPESA_HTTP_BACKOFF_FACTOR,
+                    jitter=settings.MPESA_HTTP_BACKOFF_JITTER,
+                )
+
+    return _session
+
+
+class RateLimiter:
+    """
+    Token bucket shared by threads: ``acquire()`` blocks until a call is
+    allowed, keeping the average at ``rate`` calls per second.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def daraja_timeout():
+    """
+    (connect, read) timeout tuple for requests.
+    """
+    return (settings.MPESA_HTTP_CONNECT_TIMEOUT, settings.MPESA_HTTP_READ_TIMEOUT)
@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from payments.models import IdempotencyKey
+
+logger = logging.getLogger("payments")
+
+
+POLL_INTERVAL = 0.1
+
+
+class IdempotencyConflict(Exception):
+    """
+    The key can't be used for this request right now.
+    ``status_code`` is the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def request_fingerprint(data):
+    body = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def _kept(status_code, body):
+    # let the client retry failures
+    return status_code < 500
+
+
+def run_idempotent(app, key, fingerprint, handler, keep=_kept):
+    """
+    Run ``handler`` at most once per (app, key).
+
+    ``handler()`` returns (status_code, body). The result is stored for
+    IDEMPOTENCY_KEY_TTL seconds and returned for repeats. A repeat that
+    arrives while the first request is still running waits for it.
+    ``keep(status_code, body)`` False means the result isn't final: the
+    key is released so a retry runs the handler again (default: 5xx).
+
+    Returns (status_code, body, replayed).
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+
+    record = _claim(app, key, fingerprint, deadline)
+
+    while record is None:
+        time.sleep(POLL_INTERVAL)
+        record = _claim(app, key, fingerprint, deadline)
+
+    if record.status == "COMPLETED":
+        return record.response_status, record.response_body, True
+
+    try:
+        status_code, body = handler()
+    except Exception:
+        record.delete()
+        raise
+
+    _finish(record, status_code, body, keep)
+
+    return status_code, body, False
+
+
+async def arun_idempotent(app, key, fingerprint, handler, keep=_kept):
+    """
+    ``run_idempotent`` for the async views, ``handler`` is a coroutine
+    function. Waiting for a concurrent repeat doesn't block the loop.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+
+    record = await sync_to_async(_claim)(app, key, fingerprint, deadline)
+
+    while record is None:
+        await asyncio.sleep(POLL_INTERVAL)
+        record = await sync_to_async(_claim)(app, key, fingerprint, deadline)
+
+    if record.status == "COMPLETED":
+        return record.response_status, record.response_body, True
+
+    try:
+        status_code, body = await handler()
+    except Exception:
+        await record.adelete()
+        raise
+
+    await sync_to_async(_finish)(record, status_code, body, keep)
+
+    return status_code, body, False
+
+
+def _claim(app, key, fingerprint, deadline):
+    """
+    Create the IN_PROGRESS record, or return the finished one for a
+    repeat. None while the first request is still running.
+    """
+    while True:
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    app=app,
+                    key=key,
+                    request_hash=fingerprint,
+                    expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+                )
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(app=app, key=key).first()
+
+        if record is None:
+            # removed in between (failed or expired), try again
+            continue
+
+        if _stale(record):
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+            continue
+
+        if record.request_hash != fingerprint:
+            raise IdempotencyConflict(
+                "Idempotency-Key was already used for a different request", 422
+            )
+
+        if record.status == "COMPLETED":
+            return record
+
+        if time.monotonic() >= deadline:
+            raise IdempotencyConflict(
+                "A request with this Idempotency-Key is still in progress", 409
+            )
+
+        return None
+
+
+def _finish(record, status_code, body, keep):
+    if not keep(status_code, body):
+        record.delete()
+        return
+
+    # the record is gone if it went stale meanwhile, deleted by a repeat
+    # or by sweep_idempotency_keys; the response still goes out
+    stored = IdempotencyKey.objects.filter(pk=record.pk, status="IN_PROGRESS").update(
+        status="COMPLETED",
+        response_status=status_code,
+        response_body=body,
+    )
+
+    if not stored:
+        logger.warning("Idempotency-Key %s expired before its response was stored", record.key)
+
+
+def _stale(record):
+    now = timezone.now()
+
+    if record.expires_at <= now:
+        return True
+
+    # the process handling it died
+    lock_timeout = timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    return record.status == "IN_PROGRESS" and record.created_at <= now - lock_timeout
+
+
+def sweep_expired(batch_size=1000):
+    """
+    Delete expired keys in batches. Returns how many were deleted.
+    """
+    deleted = 0
+    now = timezone.now()
+    lock_cutoff = now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+
+    expired = IdempotencyKey.objects.filter(
+        Q(expires_at__lte=now)
+        | Q(status="IN_PROGRESS", created_at__lte=lock_cutoff)
+    )
+
+    while True:
+        ids = list(expired.values_list("pk", flat=True)[:batch_size])
+
+        if not ids:
+            break
+
+        deleted += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
+
+    if deleted:
+        logger.info("Swept %s expired idempotency key(s)", deleted)
+
+    return deleted
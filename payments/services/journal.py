@@ -0,0 +1,275 @@
+"""
+Append-only on-disk journal for Daraja callbacks.
+
+In PAYMENTS_CALLBACK_INGEST_MODE=journal the callback views only append the
+payload here and ack Safaricom; `manage.py consume_callback_journal` applies
+the entries to the database in batches.
+
+Layout of PAYMENTS_CALLBACK_JOURNAL_DIR:
+
+- ``<created_ns>-<pid>.jsonl`` segments, one JSON record per line. Each
+  process writes its own segment and starts a new one every
+  PAYMENTS_CALLBACK_JOURNAL_SEGMENT_SECONDS (or SEGMENT_BYTES).
+- ``checkpoint.json`` - how far the consumer got in each segment.
+
+Appends are fsync'ed before the view acks. Concurrent appends share one
+fsync (group commit). The consumer moves its checkpoint only after a batch
+is committed, so after a crash unapplied entries are replayed.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger("payments")
+
+
+SEGMENT_SUFFIX = ".jsonl"
+CHECKPOINT = "checkpoint.json"
+CONSUMER_LOCK = "consumer.lock"
+
+
+def segment_created_at(name):
+    return int(name.split("-", 1)[0]) / 1e9
+
+
+def segment_pid(name):
+    return int(name[: -len(SEGMENT_SUFFIX)].split("-", 1)[1])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class CallbackJournal:
+    """
+    Per-process journal writer.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._file = None
+        self._pid = None
+        self._created_at = 0.0
+        self._written = 0
+        self._synced = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def append(self, kind, body):
+        """
+        Write one callback and return once it is on disk.
+        """
+        line = json.dumps({
+            "kind": kind,
+            "received_at": time.time(),
+            "body": body,
+        }, default=str) + "\n"
+
+        with self._lock:
+            self._rotate_if_needed()
+            self._file.write(line.encode())
+            self._written += 1
+            seq = self._written
+
+        if settings.PAYMENTS_CALLBACK_JOURNAL_FSYNC:
+            self._sync(seq)
+
+    def _sync(self, seq):
+        # group commit: whoever gets the lock fsyncs for everyone before it
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+
+            target = self._written
+            os.fsync(self._file.fileno())
+            self._synced = target
+
+    def _rotate_if_needed(self):
+        # a forked child must not write into its parent's segment
+        if self._file is not None and self._pid == os.getpid():
+            age = time.time() - self._created_at
+            size = self._file.tell()
+
+            if (
+                age < settings.PAYMENTS_CALLBACK_JOURNAL_SEGMENT_SECONDS
+                and size < settings.PAYMENTS_CALLBACK_JOURNAL_SEGMENT_BYTES
+            ):
+                return
+
+        with self._sync_lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._synced = self._written
+
+            os.makedirs(self.directory, exist_ok=True)
+
+            self._pid = os.getpid()
+            self._created_at = time.time()
+            name = f"{time.time_ns()}-{os.getpid()}{SEGMENT_SUFFIX}"
+
+            # unbuffered, every write() goes straight to the OS
+            self._file = open(os.path.join(self.directory, name), "ab", buffering=0)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    global _journal
+
+    if _journal is None or _journal.directory != settings.PAYMENTS_CALLBACK_JOURNAL_DIR:
+        with _journal_lock:
+            if _journal is None or _journal.directory != settings.PAYMENTS_CALLBACK_JOURNAL_DIR:
+                _journal = CallbackJournal(settings.PAYMENTS_CALLBACK_JOURNAL_DIR)
+
+    return _journal
+
+
+class JournalConsumer:
+    """
+    Reads journal segments in order and hands batches of records to
+    ``apply_batch``. Only one consumer may run per journal directory.
+    """
+
+    def __init__(self, directory, apply_batch, batch_size):
+        self.directory = directory
+        self.apply_batch = apply_batch
+        self.batch_size = batch_size
+        self._lock_file = None
+
+    def lock(self):
+        """
+        Take the consumer lock, False if another consumer holds it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, CONSUMER_LOCK), "w")
+
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+
+        return True
+
+    def run_once(self):
+        """
+        Apply everything currently in the journal.
+        Returns the number of records applied.
+        """
+        checkpoint = self._load_checkpoint()
+        applied = 0
+
+        segments = self._segments()
+        # each writer's current segment, the older ones are closed
+        current = {segment_pid(name): name for name in segments}
+
+        for name in segments:
+            offset = checkpoint.get(name, 0)
+            path = os.path.join(self.directory, name)
+
+            while True:
+                records, end = self._read(path, offset)
+
+                if end == offset:
+                    break
+
+                if records:
+                    self.apply_batch(records)
+                    applied += len(records)
+
+                offset = end
+                checkpoint[name] = offset
+                self._save_checkpoint(checkpoint)
+
+            if self._retired(name, path, offset, current[segment_pid(name)] != name):
+                os.remove(path)
+                checkpoint.pop(name, None)
+                self._save_checkpoint(checkpoint)
+
+        return applied
+
+    def _segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        return sorted(
+            (n for n in names if n.endswith(SEGMENT_SUFFIX)),
+            key=segment_created_at,
+        )
+
+    def _read(self, path, offset):
+        records = []
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+
+            while len(records) < self.batch_size:
+                line = f.readline()
+
+                # a line without newline is still being written
+                if not line.endswith(b"\n"):
+                    break
+
+                offset += len(line)
+
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.error("Skipping corrupt journal line in %s at %s", path, offset)
+
+        return records, offset
+
+    def _retired(self, name, path, offset, closed):
+        """
+        Fully applied and nothing can be appended to it any more: its
+        writer exited, or moved on to a newer segment (``closed``).
+        """
+        writer_alive = _pid_alive(segment_pid(name))
+
+        if writer_alive and not closed:
+            return False
+
+        if offset < os.path.getsize(path):
+            if writer_alive:
+                return False
+
+            # writer died mid-line; that callback was never acked
+            logger.warning("Discarding torn write at the end of %s", path)
+
+        return True
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self, checkpoint):
+        path = os.path.join(self.directory, CHECKPOINT)
+        tmp = f"{path}.tmp"
+
+        with open(tmp, "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, path)
@@ -0,0 +1,34 @@
+from django.db.models import Q
+from django.utils import timezone
+
+
+def lease_rows(queryset, owner, limit, duration):
+    """
+    Take up to ``limit`` rows of ``queryset`` for ``owner`` until
+    ``now + duration``. Returns a queryset of the rows actually won.
+
+    The model needs ``lease_owner`` and ``lease_expires_at`` fields.
+
+    Works the same on SQLite and PostgreSQL: candidates are read first, then
+    a conditional UPDATE only takes rows whose lease is still free, so two
+    nodes racing for the same rows never both get them. A crashed worker's
+    rows become free again once its lease expires.
+    """
+    model = queryset.model
+    now = timezone.now()
+
+    free = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+
+    candidates = list(
+        queryset.filter(free).values_list("pk", flat=True)[:limit]
+    )
+
+    if not candidates:
+        return model.objects.none()
+
+    model.objects.filter(free, pk__in=candidates).update(
+        lease_owner=owner,
+        lease_expires_at=now + duration,
+    )
+
+    return model.objects.filter(pk__in=candidates, lease_owner=owner)
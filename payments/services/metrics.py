@@ -0,0 +1,378 @@
+"""
+Latency histograms and counters for the hot paths, served on /metrics in
+the Prometheus text format.
+
+Every process records into its own in-memory ``Metrics`` and a background
+thread writes a snapshot to ``<pid>-<id>.json`` in PAYMENTS_METRICS_DIR
+every PAYMENTS_METRICS_FLUSH_SECONDS. ``collect`` sums the snapshots of all
+processes on the host (gunicorn/uvicorn workers, dispatchers, sweepers),
+so a scrape sees the whole host whichever worker answers it. Snapshots of
+processes that exited are folded into ``archive.json`` so counters never
+go backwards.
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+import requests
+from django.conf import settings
+
+logger = logging.getLogger("payments")
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+HELP = {
+    "payments_http_request_duration_seconds": "Time spent in a view, by route",
+    "payments_http_responses_total": "Responses by route and status code",
+    "payments_daraja_request_duration_seconds": "Daraja calls, by operation",
+    "payments_daraja_errors_total": "Daraja calls that failed or got an HTTP error",
+    "payments_daraja_timeouts_total": "Daraja calls that timed out",
+    "payments_db_query_duration_seconds": "Database queries, by connection alias",
+    "payments_db_queries_per_request": "Database queries run by one request",
+    "payments_db_time_per_request_seconds": "Time one request spent in the database",
+    "payments_log_records_dropped_total": "Log records dropped because the log queue was full",
+}
+
+ARCHIVE = "archive.json"
+SNAPSHOT_SUFFIX = ".json"
+
+TIMEOUTS = (requests.Timeout, httpx.TimeoutException)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+class Metrics:
+    """
+    Counters and histograms of one process; safe to use from any thread.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            self._counters[_key(name, labels)] += value
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        key = _key(name, labels)
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": list(buckets),
+                    "counts": [0] * len(buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+                    break
+
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        """
+        JSON-serialisable copy; histogram counts are per bucket, not cumulative.
+        """
+        with self._lock:
+            return {
+                "counters": [
+                    [name, dict(labels), value]
+                    for (name, labels), value in self._counters.items()
+                ],
+                "histograms": [
+                    [name, dict(labels), dict(histogram, counts=list(histogram["counts"]))]
+                    for (name, labels), histogram in self._histograms.items()
+                ],
+            }
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot.get("counters", ()):
+                self._counters[_key(name, labels)] += value
+
+            for name, labels, histogram in snapshot.get("histograms", ()):
+                key = _key(name, labels)
+                current = self._histograms.get(key)
+
+                if current is None or current["buckets"] != histogram["buckets"]:
+                    # bucket layouts only differ across deploys, keep the newest
+                    self._histograms[key] = dict(histogram, counts=list(histogram["counts"]))
+                    continue
+
+                current["counts"] = [a + b for a, b in zip(current["counts"], histogram["counts"])]
+                current["sum"] += histogram["sum"]
+                current["count"] += histogram["count"]
+
+
+class ProcessMetrics(Metrics):
+    """
+    The process-wide ``Metrics``, written to PAYMENTS_METRICS_DIR in the
+    background.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._pid = None
+        self._name = None
+        self._start_lock = threading.Lock()
+
+    def inc(self, name, labels=None, value=1):
+        self._started()
+        super().inc(name, labels, value)
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        self._started()
+        super().observe(name, value, labels, buckets)
+
+    def path(self):
+        return os.path.join(settings.PAYMENTS_METRICS_DIR, self._name)
+
+    def _started(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            if self._pid is not None:
+                # forked: the parent's numbers are already in its own file
+                self._counters.clear()
+                self._histograms.clear()
+
+            self._pid = os.getpid()
+            self._name = f"{self._pid}-{uuid.uuid4().hex[:8]}{SNAPSHOT_SUFFIX}"
+
+            threading.Thread(target=self._flush_forever, name="metrics-flush", daemon=True).start()
+            atexit.register(self.flush)
+
+    def _flush_forever(self):
+        pid = os.getpid()
+
+        while self._pid == pid:
+            time.sleep(settings.PAYMENTS_METRICS_FLUSH_SECONDS)
+
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning("Could not write metrics snapshot: %s", e)
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+
+        os.makedirs(settings.PAYMENTS_METRICS_DIR, exist_ok=True)
+        _write_json(self.path(), self.snapshot())
+
+
+metrics = ProcessMetrics()
+
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp"
+
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(name):
+    try:
+        os.kill(int(name.split("-", 1)[0]), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect():
+    """
+    Metrics of every process on this host, summed.
+    """
+    metrics.flush()
+
+    directory = settings.PAYMENTS_METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    total = Metrics()
+
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        archive_path = os.path.join(directory, ARCHIVE)
+        archive = Metrics()
+        archive.merge(_read_json(archive_path) or {})
+        exited = []
+
+        for name in os.listdir(directory):
+            if name == ARCHIVE or not name.endswith(SNAPSHOT_SUFFIX):
+                continue
+
+            snapshot = _read_json(os.path.join(directory, name))
+            if snapshot is None:
+                continue
+
+            if _pid_alive(name):
+                total.merge(snapshot)
+            else:
+                archive.merge(snapshot)
+                exited.append(name)
+
+        if exited:
+            _write_json(archive_path, archive.snapshot())
+            for name in exited:
+                os.unlink(os.path.join(directory, name))
+
+    total.merge(archive.snapshot())
+
+    return total
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def render(collected):
+    """
+    Prometheus text exposition format (version 0.0.4).
+    """
+    snapshot = collected.snapshot()
+    families = defaultdict(list)
+    types = {}
+
+    for name, labels, value in snapshot["counters"]:
+        types[name] = "counter"
+        families[name].append(f"{name}{_labels(labels)} {value:g}")
+
+    for name, labels, histogram in snapshot["histograms"]:
+        types[name] = "histogram"
+        cumulative = 0
+
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative += count
+            families[name].append(f"{name}_bucket{_labels(labels, le=f'{bound:g}')} {cumulative}")
+
+        families[name].append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram['count']}")
+        families[name].append(f"{name}_sum{_labels(labels)} {histogram['sum']:g}")
+        families[name].append(f"{name}_count{_labels(labels)} {histogram['count']}")
+
+    lines = []
+
+    for name in sorted(families):
+        if name in HELP:
+            lines.append(f"# HELP {name} {HELP[name]}")
+        lines.append(f"# TYPE {name} {types[name]}")
+        lines.extend(sorted(families[name]))
+
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------
+# Daraja calls
+# ---------------------------
+class DarajaCall:
+    status = None
+
+
+@contextmanager
+def track_daraja(operation):
+    """
+    Time a Daraja call; set ``call.status`` to the HTTP status to count
+    4xx/5xx answers as errors::
+
+        with track_daraja("stk_push") as call:
+            response = session.post(...)
+            call.status = response.status_code
+    """
+    labels = {"operation": operation}
+    call = DarajaCall()
+    start = time.perf_counter()
+
+    try:
+        yield call
+    except TIMEOUTS:
+        metrics.inc("payments_daraja_timeouts_total", labels)
+        raise
+    except Exception:
+        metrics.inc("payments_daraja_errors_total", labels)
+        raise
+    else:
+        if call.status is not None and call.status >= 400:
+            metrics.inc("payments_daraja_errors_total", labels)
+    finally:
+        metrics.observe("payments_daraja_request_duration_seconds", time.perf_counter() - start, labels)
+
+
+# ---------------------------
+# Database queries
+# ---------------------------
+class RequestQueries:
+    count = 0
+    seconds = 0.0
+
+
+# set by MetricsMiddleware for the duration of a request; sync_to_async
+# copies it into the threads that run the request's queries
+current_queries = ContextVar("current_queries", default=None)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every DB connection (see signals.py).
+    """
+    start = time.perf_counter()
+
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+
+        queries = current_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += elapsed
+
+        metrics.observe(
+            "payments_db_query_duration_seconds",
+            elapsed,
+            {"alias": context["connection"].alias},
+        )
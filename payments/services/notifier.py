@@ -0,0 +1,200 @@
+"""
+Wake up requests waiting for a payment's status (see async_views.payment_status).
+
+Waiters are asyncio futures keyed by payment id, held by the ASGI worker
+that serves them. ``publish`` wakes waiters in the calling process directly
+and sends the payment ids to every other process as a datagram on a unix
+socket in PAYMENTS_NOTIFY_DIR (one ``<pid>.sock`` per listening process).
+This is a local stand-in for a pub/sub server: it only reaches processes on
+the same host, and a lost datagram only means a waiter wakes at its timeout.
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger("payments")
+
+
+SOCKET_SUFFIX = ".sock"
+
+# ids per datagram, keeps each one well under the socket buffer size
+IDS_PER_DATAGRAM = 200
+
+
+class PaymentWaiters:
+
+    def __init__(self):
+        self._waiters = defaultdict(set)
+        self._lock = threading.Lock()
+        self._socket = None
+        self._loop = None
+        self._pid = None
+
+    def wait(self, payment_id):
+        """
+        Future resolved on the next publish for ``payment_id``.
+        Must be called from the event loop that will await it.
+        """
+        loop = asyncio.get_running_loop()
+        self._listen(loop)
+
+        future = loop.create_future()
+
+        with self._lock:
+            self._waiters[str(payment_id)].add(future)
+
+        return future
+
+    def discard(self, payment_id, future):
+        with self._lock:
+            waiters = self._waiters.get(str(payment_id))
+
+            if waiters:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[str(payment_id)]
+
+    def notify(self, payment_ids):
+        """
+        Wake local waiters; safe to call from any thread.
+        """
+        with self._lock:
+            futures = [
+                future
+                for payment_id in payment_ids
+                for future in self._waiters.pop(str(payment_id), ())
+            ]
+
+        for future in futures:
+            future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def path(self):
+        return os.path.join(settings.PAYMENTS_NOTIFY_DIR, f"{os.getpid()}{SOCKET_SUFFIX}")
+
+    def _listen(self, loop):
+        if self._loop is loop and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._loop is loop and self._pid == os.getpid():
+                return
+
+            if self._socket is None or self._pid != os.getpid():
+                self._socket = self._bind()
+                self._pid = os.getpid()
+            elif self._loop is not None and not self._loop.is_closed():
+                self._loop.remove_reader(self._socket.fileno())
+
+            loop.add_reader(self._socket.fileno(), self._receive)
+            self._loop = loop
+
+    def _bind(self):
+        os.makedirs(settings.PAYMENTS_NOTIFY_DIR, exist_ok=True)
+        path = self.path()
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.setblocking(False)
+
+        atexit.register(_unlink, path)
+
+        return sock
+
+    def _receive(self):
+        while True:
+            try:
+                datagram = self._socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            try:
+                self.notify(json.loads(datagram))
+            except ValueError:
+                logger.warning("Ignoring malformed payment notification")
+
+    def is_listening(self):
+        return self._socket is not None and self._pid == os.getpid()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+waiters = PaymentWaiters()
+
+
+def publish(payment_ids):
+    """
+    Tell every waiter on this host that these payments changed.
+    """
+    payment_ids = [str(payment_id) for payment_id in payment_ids]
+
+    if not payment_ids:
+        return
+
+    waiters.notify(payment_ids)
+    _send_to_peers(payment_ids)
+
+
+def publish_on_commit(payment_ids):
+    """
+    ``publish`` once the current transaction commits, so waiters that wake
+    up read the new status.
+    """
+    payment_ids = list(payment_ids)
+    transaction.on_commit(lambda: publish(payment_ids))
+
+
+def _send_to_peers(payment_ids):
+    try:
+        names = os.listdir(settings.PAYMENTS_NOTIFY_DIR)
+    except FileNotFoundError:
+        return
+
+    own = waiters.path() if waiters.is_listening() else None
+    datagrams = [
+        json.dumps(payment_ids[i:i + IDS_PER_DATAGRAM]).encode()
+        for i in range(0, len(payment_ids), IDS_PER_DATAGRAM)
+    ]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+
+        for name in names:
+            if not name.endswith(SOCKET_SUFFIX):
+                continue
+
+            path = os.path.join(settings.PAYMENTS_NOTIFY_DIR, name)
+            if path == own:
+                continue
+
+            try:
+                for datagram in datagrams:
+                    sock.sendto(datagram, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the process is gone
+                _unlink(path)
+            except (BlockingIOError, OSError) as e:
+                logger.warning("Payment notification to %s dropped: %s", name, e)
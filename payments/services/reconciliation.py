@@ -0,0 +1,228 @@
+"""
+Reconcile an M-Pesa statement export against recorded payments.
+
+The statement is read as a stream and joined with Payment in chunks of
+PAYMENTS_RECONCILE_CHUNK_SIZE receipts: one ``mpesa_receipt_number IN (...)``
+query per chunk, matched in a dict. Besides the current chunk only the set
+of statement receipts is kept, to find payments missing from the statement.
+"""
+
+import csv
+import logging
+from collections import Counter, namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.utils import timezone
+
+from payments.models import Payment
+
+logger = logging.getLogger("payments")
+
+
+MISSING = "missing"                    # on the statement, not recorded here
+AMOUNT_MISMATCH = "amount_mismatch"
+PHONE_MISMATCH = "phone_mismatch"
+NOT_ON_STATEMENT = "not_on_statement"  # recorded here, not on the statement
+
+ISSUES = (MISSING, AMOUNT_MISMATCH, PHONE_MISMATCH, NOT_ON_STATEMENT)
+
+REPORT_FIELDS = ("issue", "receipt", "statement_amount", "amount", "statement_phone", "phone")
+
+# header names used by the org portal export and by C2B style CSVs
+RECEIPT_COLUMNS = ("receipt no.", "receipt no", "receipt", "transid")
+AMOUNT_COLUMNS = ("paid in", "amount", "transamount")
+PHONE_COLUMNS = ("other party info", "msisdn", "phone", "phone number")
+TIME_COLUMNS = ("completion time", "transtime", "date")
+STATUS_COLUMNS = ("transaction status", "status")
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%d-%m-%Y %H:%M:%S", "%Y%m%d%H%M%S", "%d/%m/%Y %H:%M")
+
+
+StatementRow = namedtuple("StatementRow", "receipt amount phone completed_at")
+
+
+class StatementError(ValueError):
+    pass
+
+
+def _column(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def _parse_time(value):
+    for fmt in TIME_FORMATS:
+        try:
+            return timezone.make_aware(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_phone(value):
+    # "254712345678 - JOHN DOE"
+    return value.split(" - ", 1)[0].strip()
+
+
+def read_statement(lines):
+    """
+    Yield StatementRow for every completed incoming payment in a CSV
+    statement. ``lines`` is any iterable of text lines, e.g. an open file.
+
+    Leading report metadata is skipped up to the header row.
+    """
+    reader = csv.reader(lines)
+
+    for header in reader:
+        header = [cell.strip().lower() for cell in header]
+        receipt_col = _column(header, RECEIPT_COLUMNS)
+        if receipt_col is not None:
+            break
+    else:
+        raise StatementError("No receipt column found in the statement")
+
+    amount_col = _column(header, AMOUNT_COLUMNS)
+    if amount_col is None:
+        raise StatementError("No amount column found in the statement")
+
+    phone_col = _column(header, PHONE_COLUMNS)
+    time_col = _column(header, TIME_COLUMNS)
+    status_col = _column(header, STATUS_COLUMNS)
+
+    for line_no, row in enumerate(reader, start=2):
+        if len(row) <= max(receipt_col, amount_col):
+            continue
+
+        if status_col is not None and row[status_col].strip().lower() not in ("", "completed"):
+            continue
+
+        receipt = row[receipt_col].strip()
+        amount = row[amount_col].strip().replace(",", "")
+
+        # withdrawals and charges have no paid-in amount
+        if not receipt or not amount:
+            continue
+
+        try:
+            amount = Decimal(amount)
+        except InvalidOperation:
+            logger.warning("Statement line %s: bad amount %r", line_no, row[amount_col])
+            continue
+
+        if amount <= 0:
+            continue
+
+        yield StatementRow(
+            receipt=receipt,
+            amount=amount,
+            phone=_parse_phone(row[phone_col]) if phone_col is not None else "",
+            completed_at=_parse_time(row[time_col].strip()) if time_col is not None else None,
+        )
+
+
+def phones_match(statement_phone, phone):
+    """
+    Statements mask part of the number ("2547****5678"), masked digits
+    match anything.
+    """
+    if not statement_phone or not phone:
+        return True
+
+    if len(statement_phone) != len(phone):
+        return False
+
+    return all(s == "*" or s == p for s, p in zip(statement_phone, phone))
+
+
+def reconcile(rows, report, start=None, end=None, chunk_size=None):
+    """
+    Join statement ``rows`` with Payment on mpesa_receipt_number.
+
+    ``report(issue, receipt, statement_amount, amount, statement_phone,
+    phone)`` is called for every discrepancy as it is found. SUCCESS
+    payments between ``start`` and ``end`` (default: the statement's first
+    and last completion time) that are not on the statement are reported
+    as NOT_ON_STATEMENT.
+
+    Returns a Counter with "statement_rows", "matched" and one entry per
+    issue.
+    """
+    chunk_size = chunk_size or settings.PAYMENTS_RECONCILE_CHUNK_SIZE
+    summary = Counter({issue: 0 for issue in ISSUES})
+    seen = set()
+    first = last = None
+    chunk = {}
+
+    def flush():
+        recorded = Payment.objects.filter(
+            mpesa_receipt_number__in=list(chunk)
+        ).values_list("mpesa_receipt_number", "amount", "phone_number")
+
+        for receipt, amount, phone in recorded:
+            row = chunk.pop(receipt)
+            matched = True
+
+            if row.amount != amount:
+                matched = False
+                summary[AMOUNT_MISMATCH] += 1
+                report(AMOUNT_MISMATCH, receipt, row.amount, amount, row.phone, phone)
+
+            if not phones_match(row.phone, phone):
+                matched = False
+                summary[PHONE_MISMATCH] += 1
+                report(PHONE_MISMATCH, receipt, row.amount, amount, row.phone, phone)
+
+            summary["matched"] += matched
+
+        for receipt, row in chunk.items():
+            summary[MISSING] += 1
+            report(MISSING, receipt, row.amount, None, row.phone, None)
+
+        chunk.clear()
+
+    for row in rows:
+        summary["statement_rows"] += 1
+
+        if row.receipt in seen:
+            continue
+
+        seen.add(row.receipt)
+        chunk[row.receipt] = row
+
+        if row.completed_at:
+            first = min(first, row.completed_at) if first else row.completed_at
+            last = max(last, row.completed_at) if last else row.completed_at
+
+        if len(chunk) >= chunk_size:
+            flush()
+
+    if chunk:
+        flush()
+
+    start = start or first
+    end = end or last
+
+    if start and end:
+        recorded = (
+            Payment.objects.filter(
+                status="SUCCESS",
+                mpesa_receipt_number__isnull=False,
+                created_at__gte=start,
+                created_at__lte=end,
+            )
+            .values_list("mpesa_receipt_number", "amount", "phone_number")
+            .iterator(chunk_size=chunk_size)
+        )
+
+        for receipt, amount, phone in recorded:
+            if receipt not in seen:
+                summary[NOT_ON_STATEMENT] += 1
+                report(NOT_ON_STATEMENT, receipt, None, amount, None, phone)
+
+    logger.info("Statement reconciled: %s", dict(summary))
+
+    return summary
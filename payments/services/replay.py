@@ -0,0 +1,248 @@
+"""
+Replay recorded Safaricom callbacks against a (staging) instance, see
+`manage.py replay_callbacks`.
+
+Callbacks come from the PaymentPayload table or from the payments log
+(JSON lines, the older ``asctime | level | name | message`` format, or
+rotated .gz files of either). Phone numbers, receipts, checkout ids and
+payer names are replaced by pseudonyms before anything is sent: the same
+value maps to the same pseudonym within a run, so a callback still
+matches the push it belongs to.
+"""
+
+import ast
+import gzip
+import hashlib
+import hmac
+import heapq
+import json
+import string
+from collections import namedtuple
+from datetime import datetime
+
+from django.utils import timezone
+
+from payments.models import PaymentPayload
+
+
+STK = "stk"
+C2B = "c2b"
+VALIDATION = "validation"
+
+PATHS = {
+    STK: "mpesa/stk-callback/",
+    C2B: "mpesa/c2b/confirmation/",
+    VALIDATION: "mpesa/c2b/validation/",
+}
+
+# log message prefixes of the callback views
+LOG_PREFIXES = {
+    "STK Callback Received: ": STK,
+    "C2B CONFIRMATION RECEIVED: ": C2B,
+    "C2B VALIDATION REQUEST: ": VALIDATION,
+}
+
+PAYLOAD_KINDS = {
+    "STK_CALLBACK": STK,
+    "C2B_CONFIRMATION": C2B,
+}
+
+LOG_TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S,%f")
+
+
+CallbackEvent = namedtuple("CallbackEvent", "at kind body")
+
+
+# ---------------------------
+# Sources
+# ---------------------------
+def events_from_payloads(start=None, end=None, chunk_size=2000):
+    """
+    Callbacks stored in PaymentPayload, oldest first.
+    """
+    payloads = PaymentPayload.objects.filter(event_type__in=PAYLOAD_KINDS)
+
+    if start:
+        payloads = payloads.filter(created_at__gte=start)
+    if end:
+        payloads = payloads.filter(created_at__lte=end)
+
+    payloads = payloads.order_by("created_at", "id").only("event_type", "data", "created_at")
+
+    for payload in payloads.iterator(chunk_size=chunk_size):
+        yield CallbackEvent(payload.created_at, PAYLOAD_KINDS[payload.event_type], payload.body)
+
+
+def _log_time(value):
+    for fmt in LOG_TIME_FORMATS:
+        try:
+            return timezone.make_aware(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return None
+
+
+def parse_log_line(line):
+    """
+    (time or None, message) of a payments log line in any of its formats.
+    """
+    line = line.rstrip("\n")
+
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+            return _log_time(entry.get("ts", "")), entry.get("msg", "")
+        except ValueError:
+            pass
+
+    parts = line.split(" | ", 3)
+    if len(parts) == 4:
+        at = _log_time(parts[0])
+        if at:
+            return at, parts[3]
+
+    return None, line
+
+
+def _events_from_log(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    last = None
+
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            at, message = parse_log_line(line)
+            last = at or last
+
+            for prefix, kind in LOG_PREFIXES.items():
+                if message.startswith(prefix):
+                    break
+            else:
+                continue
+
+            try:
+                # logged as the repr of the parsed body
+                body = ast.literal_eval(message[len(prefix):])
+            except (ValueError, SyntaxError):
+                continue
+
+            if isinstance(body, dict):
+                # lines without a time (old plain logs) go right after the previous one
+                yield CallbackEvent(last, kind, body)
+
+
+def events_from_logs(paths, start=None, end=None):
+    """
+    Callbacks logged in ``paths`` (any order), merged by time.
+    """
+    epoch = timezone.make_aware(datetime(1970, 1, 1))
+    merged = heapq.merge(*(_events_from_log(path) for path in paths), key=lambda event: event.at or epoch)
+
+    for event in merged:
+        if start and event.at and event.at < start:
+            continue
+        if end and event.at and event.at > end:
+            break
+        yield event
+
+
+# ---------------------------
+# Anonymizing
+# ---------------------------
+class Anonymizer:
+    """
+    Keyed pseudonyms that keep the shape of the original: phone numbers
+    keep their country code and length, receipts their length and
+    alphabet.
+    """
+
+    def __init__(self, salt):
+        self.salt = salt.encode()
+
+    def _digest(self, kind, value):
+        return hmac.new(self.salt, f"{kind}:{value}".encode(), hashlib.sha256).digest()
+
+    def _digits(self, kind, value, length):
+        number = int.from_bytes(self._digest(kind, value), "big")
+        return str(number % 10 ** length).zfill(length)
+
+    def phone(self, value):
+        if value in (None, ""):
+            return value
+
+        text = str(value)
+
+        if text.isdigit() and len(text) > 3:
+            fake = text[:3] + self._digits("phone", text, len(text) - 3)
+        else:
+            # Safaricom already masks/hashes some MSISDNs
+            fake = self._digest("phone", text).hex()[:len(text)]
+
+        return int(fake) if isinstance(value, int) else fake
+
+    def receipt(self, value):
+        if not value:
+            return value
+
+        alphabet = string.ascii_uppercase + string.digits
+        digest = self._digest("receipt", value)
+        return "".join(alphabet[digest[i % len(digest)] % len(alphabet)] for i in range(len(value)))
+
+    def checkout_id(self, value):
+        if not value:
+            return value
+
+        return f"ws_CO_{self._digest('checkout', value).hex()[:24]}"
+
+    def stk(self, body):
+        body = json.loads(json.dumps(body))
+        callback = body["Body"]["stkCallback"]
+
+        callback["CheckoutRequestID"] = self.checkout_id(callback.get("CheckoutRequestID"))
+        callback["MerchantRequestID"] = self.checkout_id(callback.get("MerchantRequestID"))
+
+        for item in callback.get("CallbackMetadata", {}).get("Item", []):
+            if item.get("Name") == "MpesaReceiptNumber":
+                item["Value"] = self.receipt(item.get("Value"))
+            elif item.get("Name") == "PhoneNumber":
+                item["Value"] = self.phone(item.get("Value"))
+
+        return body
+
+    def c2b(self, body):
+        body = dict(body)
+
+        body["TransID"] = self.receipt(body.get("TransID"))
+        body["MSISDN"] = self.phone(body.get("MSISDN"))
+
+        # account numbers are often the payer's phone number
+        if str(body.get("BillRefNumber") or "").isdigit():
+            body["BillRefNumber"] = self.phone(body["BillRefNumber"])
+
+        for name in ("FirstName", "MiddleName", "LastName"):
+            if body.get(name):
+                body[name] = "Customer" if name == "FirstName" else ""
+
+        return body
+
+    def anonymize(self, event):
+        try:
+            body = self.stk(event.body) if event.kind == STK else self.c2b(event.body)
+        except (KeyError, TypeError, AttributeError):
+            # can't be anonymized safely, so it isn't replayed
+            return None
+
+        return event._replace(body=body)
+
+
+def stk_seed(body):
+    """
+    (checkout_request_id, amount, phone) of the STK push an anonymized
+    callback answers, to create it as PENDING before the replay.
+    """
+    callback = body["Body"]["stkCallback"]
+    items = {
+        item.get("Name"): item.get("Value")
+        for item in callback.get("CallbackMetadata", {}).get("Item", [])
+    }
+
+    return callback["CheckoutRequestID"], items.get("Amount") or 1, str(items.get("PhoneNumber") or "")
@@ -0,0 +1,141 @@
+import logging
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from payments.models import Payment, PaymentPayload
+from payments.routers import pin_to_primary
+from payments.services.daraja import DarajaService
+from payments.services.http import RateLimiter
+from payments.services.leasing import lease_rows
+from payments.services.notifier import publish_on_commit
+from payments.services.webhooks import enqueue_payment_events
+
+logger = logging.getLogger("payments")
+
+
+class PendingStkSweeper:
+    """
+    Settles STK payments whose callback never arrived, using STK Query.
+    Only failures are settled this way, a successful payment needs the
+    receipt number that only its callback carries.
+
+    Payments are leased before querying so several sweepers (or nodes) never
+    query the same one. A payment Daraja can't answer for yet keeps its lease
+    until MPESA_STK_QUERY_RETRY_SECONDS from now, which doubles as the wait
+    before the next query.
+    """
+
+    def __init__(self, workers=None, batch_size=None, rate=None):
+        self.workers = workers or settings.MPESA_STK_QUERY_WORKERS
+        self.batch_size = batch_size or self.workers * 10
+        self.limiter = RateLimiter(rate or settings.MPESA_STK_QUERY_RATE)
+        self.retry = timedelta(seconds=settings.MPESA_STK_QUERY_RETRY_SECONDS)
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="stk-query",
+        )
+
+    @staticmethod
+    def stale():
+        cutoff = timezone.now() - timedelta(seconds=settings.MPESA_STK_QUERY_AFTER_SECONDS)
+
+        # served by payment_pending_stk_idx
+        return Payment.objects.filter(
+            status="PENDING",
+            payment_type="STK",
+            created_at__lt=cutoff,
+            checkout_request_id__isnull=False,
+        ).order_by("created_at")
+
+    def run_once(self):
+        """
+        Lease one batch of stale payments, query them and save the results.
+        Returns the number of payments queried.
+        """
+        payments = list(lease_rows(self.stale(), self.owner, self.batch_size, self.retry))
+
+        if not payments:
+            return 0
+
+        responses = list(self.executor.map(self.query, payments))
+        self._record(payments, responses)
+
+        return len(payments)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def query(self, payment):
+        self.limiter.acquire()
+
+        try:
+            return DarajaService().stk_query(payment.checkout_request_id)
+        except Exception as e:
+            logger.error("STK query failed for payment %s: %s", payment.id, e)
+            return {"error": str(e)}
+        finally:
+            close_old_connections()
+
+    def _record(self, payments, responses):
+        now = timezone.now()
+        give_up = now - timedelta(seconds=settings.MPESA_STK_QUERY_GIVE_UP_SECONDS)
+        payloads = []
+
+        for payment, response in zip(payments, responses):
+            result_code = response.get("ResultCode")
+
+            if result_code is None:
+                # still being processed, or Daraja/the network failed
+                if payment.created_at < give_up:
+                    payment.status = "FAILED"
+                    logger.warning("Giving up on STK payment %s: %s", payment.id, response)
+                else:
+                    logger.info("STK payment %s not settled yet: %s", payment.id, response)
+            elif str(result_code) == "0":
+                # paid, but the query result carries no receipt number, which
+                # verify and claim need; left PENDING for the callback (or
+                # reconcile_statement) and never given up on
+                logger.warning("STK payment %s paid according to query, waiting for its callback", payment.id)
+            else:
+                payment.status = "FAILED"
+                logger.info(
+                    "STK payment %s settled as FAILED by query: %s",
+                    payment.id,
+                    response.get('ResultDesc'),
+                )
+
+            payment.lease_owner = None
+            payment.lease_expires_at = None if payment.status != "PENDING" else now + self.retry
+            # bulk_update skips auto_now
+            payment.updated_at = now
+
+            payloads.append(PaymentPayload.build(payment, "STK_QUERY", response))
+
+        with transaction.atomic():
+            # a callback that landed meanwhile wins, only PENDING rows change;
+            # locked so none can land between this read and the update
+            pending = Payment.objects.filter(status="PENDING")
+            unchanged = set(
+                pending.filter(pk__in=[p.pk for p in payments])
+                .select_for_update()
+                .values_list("pk", flat=True)
+            )
+
+            pending.bulk_update(
+                payments,
+                ["status", "lease_owner", "lease_expires_at", "updated_at"],
+            )
+            PaymentPayload.objects.bulk_create(payloads)
+            settled = [p for p in payments if p.pk in unchanged and p.status != "PENDING"]
+            enqueue_payment_events(settled)
+            publish_on_commit(p.id for p in settled)
+            pin_to_primary(p.app_id for p in settled)
@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger("payments")
+
+
+class TokenCache:
+    """
+    Shares an OAuth access token between all worker processes.
+
+    The token lives in the Django cache (see ``CACHES`` in settings) so every
+    gunicorn worker reuses it. A copy is also kept in-process so the common
+    case never leaves memory.
+
+    - the token is kept for its ``expires_in`` lifetime
+    - once inside ``MPESA_TOKEN_REFRESH_MARGIN`` of expiry, the current token
+      is still served while a background thread fetches a new one
+    - a cache lock makes sure only one refresh runs at a time
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, key, fetch):
+        # fetch() -> (access_token, expires_in seconds)
+        self.key = key
+        self.lock_key = f"{key}:lock"
+        self.fetch = fetch
+        self._local = None
+        self._refreshing = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[settings.MPESA_TOKEN_CACHE_ALIAS]
+
+    def get(self):
+        now = time.time()
+
+        entry = self._local
+        if entry is None or now >= entry["refresh_at"]:
+            entry = self.cache.get(self.key) or entry
+            self._local = entry
+
+        if entry and now < entry["refresh_at"]:
+            return entry["token"]
+
+        if entry and now < entry["expires_at"]:
+            # still valid, refresh ahead of expiry without blocking the caller
+            self._refresh_in_background()
+            return entry["token"]
+
+        return self._refresh_blocking()
+
+    def peek(self):
+        """
+        The in-process token if it needs no refresh, else None.
+        Never blocks, so it is safe to call from async code.
+        """
+        entry = self._local
+
+        if entry and time.time() < entry["refresh_at"]:
+            return entry["token"]
+
+        return None
+
+    def invalidate(self):
+        self._local = None
+        self.cache.delete(self.key)
+
+    # ---------------------------
+    # Refresh helpers
+    # ---------------------------
+    def _acquire_lock(self):
+        timeout = settings.MPESA_TOKEN_LOCK_TIMEOUT
+        return self.cache.add(self.lock_key, os.getpid(), timeout=timeout)
+
+    def _release_lock(self):
+        self.cache.delete(self.lock_key)
+
+    def _refresh(self):
+        token, expires_in = self.fetch()
+
+        if not token:
+            return None
+
+        now = time.time()
+        margin = min(settings.MPESA_TOKEN_REFRESH_MARGIN, expires_in // 2)
+
+        entry = {
+            "token": token,
+            "expires_at": now + expires_in,
+            "refresh_at": now + expires_in - margin,
+        }
+
+        self.cache.set(self.key, entry, timeout=expires_in)
+        self._local = entry
+
+        logger.info("Daraja access token refreshed, expires in %ss", expires_in)
+
+        return token
+
+    def _refresh_in_background(self):
+        # one thread per process, one refresh across processes
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        if not self._acquire_lock():
+            self._refreshing.release()
+            return
+
+        def run():
+            try:
+                self._refresh()
+            except Exception as e:
+                logger.error("Background token refresh failed: %s", e)
+            finally:
+                self._release_lock()
+                self._refreshing.release()
+
+        threading.Thread(target=run, name="daraja-token-refresh", daemon=True).start()
+
+    def _refresh_blocking(self):
+        if self._acquire_lock():
+            try:
+                return self._refresh()
+            finally:
+                self._release_lock()
+
+        # another worker is already fetching, wait for its result
+        deadline = time.time() + settings.MPESA_TOKEN_LOCK_TIMEOUT
+
+        while time.time() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+
+            entry = self.cache.get(self.key)
+            if entry and time.time() < entry["expires_at"]:
+                self._local = entry
+                return entry["token"]
+
+        # lock holder died or stalled, fetch it ourselves
+        return self._refresh()
+
+
+_token_caches = {}
+_registry_lock = threading.Lock()
+
+
+def get_token_cache(key, fetch):
+    """
+    Return the process-wide TokenCache for ``key``.
+    """
+    with _registry_lock:
+        token_cache = _token_caches.get(key)
+
+        if token_cache is None:
+            token_cache = TokenCache(key, fetch)
+            _token_caches[key] = token_cache
+
+        # always fetch with the latest service configuration
+        token_cache.fetch = fetch
+
+        return token_cache
@@ -0,0 +1,306 @@
+"""
+Outbound webhooks for payment state changes.
+
+Views and workers call ``enqueue_payment_events`` inside the transaction
+that changes the payment, so an event exists exactly when the change was
+committed (transactional outbox). `manage.py deliver_webhooks` sends them.
+
+Every request carries:
+
+- ``X-Webhook-Id``: the event id, the same on every retry
+- ``X-Webhook-Signature``: ``t=<unix time>,v1=<hex HMAC-SHA256>`` of
+  ``"<t>.<body>"`` keyed with the app's webhook_secret
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from payments.models import ExternalApp, WebhookEvent
+from payments.services.http import build_session
+from payments.services.leasing import lease_rows
+
+logger = logging.getLogger("payments")
+
+
+PAYMENT_SUCCEEDED = "payment.succeeded"
+PAYMENT_FAILED = "payment.failed"
+
+EVENT_TYPES = {
+    "SUCCESS": PAYMENT_SUCCEEDED,
+    "FAILED": PAYMENT_FAILED,
+}
+
+
+def payment_event_data(payment):
+    return {
+        "id": payment.id,
+        "status": payment.status,
+        "payment_type": payment.payment_type,
+        "amount": payment.amount,
+        "phone": payment.phone_number,
+        "receipt": payment.mpesa_receipt_number,
+        "reference": payment.external_reference,
+        "checkout_request_id": payment.checkout_request_id,
+        "claimed": payment.claimed,
+        "date": payment.created_at,
+    }
+
+
+def enqueue_payment_events(payments):
+    """
+    Queue a webhook for each payment whose app has a webhook_url.
+    Call inside the transaction that saved the payments.
+    """
+    payments = [p for p in payments if p.app_id and p.status in EVENT_TYPES]
+
+    if not payments:
+        return []
+
+    subscribed = set(
+        ExternalApp.objects.filter(
+            pk__in={p.app_id for p in payments},
+            is_active=True,
+        )
+        .exclude(webhook_url="")
+        .values_list("pk", flat=True)
+    )
+
+    now = timezone.now()
+    events = []
+
+    for payment in payments:
+        if payment.app_id not in subscribed:
+            continue
+
+        event_id = uuid.uuid4()
+        event_type = EVENT_TYPES[payment.status]
+
+        events.append(WebhookEvent(
+            id=event_id,
+            app_id=payment.app_id,
+            payment=payment,
+            event_type=event_type,
+            payload={
+                "id": event_id,
+                "type": event_type,
+                "created_at": now,
+                "data": payment_event_data(payment),
+            },
+            next_attempt_at=now,
+        ))
+
+    return WebhookEvent.objects.bulk_create(events)
+
+
+def sign(secret, timestamp, body):
+    message = f"{timestamp}.".encode() + body
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def backoff(attempts):
+    """
+    Delay before retry number ``attempts``: exponential, capped, jittered.
+    """
+    delay = min(
+        settings.PAYMENTS_WEBHOOK_BACKOFF_SECONDS * 2 ** (attempts - 1),
+        settings.PAYMENTS_WEBHOOK_BACKOFF_MAX_SECONDS,
+    )
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+class WebhookDeliverer:
+    """
+    Sends due webhook events with a pool of worker threads.
+
+    Events are leased like STK dispatch jobs, so several delivery processes
+    can run. At most PAYMENTS_WEBHOOK_MAX_PER_ENDPOINT requests per process
+    go to one host at a time, so a slow endpoint can't take every worker:
+    events for a host that is at its limit go back to the queue for
+    PAYMENTS_WEBHOOK_BUSY_DELAY_SECONDS instead of waiting for a slot.
+    """
+
+    def __init__(self, workers=None, batch_size=None):
+        self.workers = workers or settings.PAYMENTS_WEBHOOK_WORKERS
+        self.batch_size = batch_size or self.workers * 4
+        self.lease = timedelta(seconds=settings.PAYMENTS_WEBHOOK_LEASE_SECONDS)
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.session = build_session(pool_size=self.workers)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="webhook",
+        )
+
+        self._endpoints = {}
+        self._endpoints_lock = threading.Lock()
+
+    def run_once(self):
+        """
+        Lease one batch of due events and send them concurrently.
+        Returns the number of events attempted.
+        """
+        due = WebhookEvent.objects.filter(
+            status="PENDING",
+            next_attempt_at__lte=timezone.now(),
+        ).order_by("next_attempt_at")
+
+        events = list(
+            lease_rows(due, self.owner, self.batch_size, self.lease)
+            .select_related("app")
+        )
+
+        if not events:
+            return 0
+
+        list(self.executor.map(self.deliver, events))
+
+        for event in events:
+            self._save(event)
+
+        return len(events)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def endpoint_slots(self, url):
+        host = urlsplit(url).netloc
+
+        with self._endpoints_lock:
+            if host not in self._endpoints:
+                self._endpoints[host] = threading.BoundedSemaphore(
+                    settings.PAYMENTS_WEBHOOK_MAX_PER_ENDPOINT
+                )
+            return self._endpoints[host]
+
+    def deliver(self, event):
+        """
+        POST one event and record the outcome on it (saved by run_once).
+        """
+        app = event.app
+        error = None
+
+        if not app.webhook_url or not app.is_active:
+            error = "App has no active webhook subscription"
+        else:
+            body = json.dumps(event.payload, cls=DjangoJSONEncoder).encode()
+            timestamp = int(time.time())
+
+            headers = {
+                "Content-Type": "application/json",
+                "X-Webhook-Id": str(event.id),
+                "X-Webhook-Signature": f"t={timestamp},v1={sign(app.webhook_secret, timestamp, body)}",
+            }
+
+            slots = self.endpoint_slots(app.webhook_url)
+
+            if not slots.acquire(blocking=False):
+                # the host has its share of workers, keep this one for others
+                self._defer(event)
+                return
+
+            try:
+                response = self.session.post(
+                    app.webhook_url,
+                    data=body,
+                    headers=headers,
+                    timeout=settings.PAYMENTS_WEBHOOK_TIMEOUT,
+                )
+
+                if not 200 <= response.status_code < 300:
+                    error = f"HTTP {response.status_code}: {response.text[:500]}"
+            except requests.RequestException as e:
+                error = str(e)
+            finally:
+                slots.release()
+
+        self._record(event, error)
+
+    def _save(self, event):
+        """
+        Store the outcome of an attempt, unless the lease ran out meanwhile
+        and another deliverer took the event over.
+        """
+        saved = WebhookEvent.objects.filter(pk=event.pk, lease_owner=self.owner).update(
+            status=event.status,
+            attempts=event.attempts,
+            next_attempt_at=event.next_attempt_at,
+            lease_owner=event.lease_owner,
+            lease_expires_at=event.lease_expires_at,
+            last_error=event.last_error,
+            delivered_at=event.delivered_at,
+        )
+
+        if not saved:
+            logger.warning("Lost the lease on webhook %s, dropping its result", event.id)
+
+    def _defer(self, event):
+        """
+        Hand the event back without counting an attempt.
+        """
+        event.next_attempt_at = timezone.now() + timedelta(seconds=settings.PAYMENTS_WEBHOOK_BUSY_DELAY_SECONDS)
+        event.lease_owner = None
+        event.lease_expires_at = None
+
+    def _record(self, event, error):
+        now = timezone.now()
+
+        event.attempts += 1
+        event.lease_owner = None
+        event.lease_expires_at = None
+
+        if error is None:
+            event.status = "DELIVERED"
+            event.delivered_at = now
+            event.last_error = ""
+            logger.info("Webhook %s delivered to %s", event.id, event.app.name)
+
+        elif event.attempts >= settings.PAYMENTS_WEBHOOK_MAX_ATTEMPTS:
+            event.status = "DEAD"
+            event.last_error = error
+            logger.error(
+                "Webhook %s to %s dead after %s attempt(s): %s",
+                event.id,
+                event.app.name,
+                event.attempts,
+                error,
+            )
+
+        else:
+            event.next_attempt_at = now + backoff(event.attempts)
+            event.last_error = error
+            logger.warning(
+                "Webhook %s to %s failed (attempt %s): %s",
+                event.id,
+                event.app.name,
+                event.attempts,
+                error,
+            )
+
+
+def requeue(events):
+    """
+    Put dead events back in the queue with a fresh set of attempts.
+    """
+    return events.filter(status="DEAD").update(
+        status="PENDING",
+        attempts=0,
+        next_attempt_at=timezone.now(),
+        last_error="",
+    )
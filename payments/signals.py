@@ -0,0 +1,24 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from payments.models import ExternalApp
+from payments.services.app_cache import app_cache
+from payments.services.metrics import time_query
+
+
+@receiver(post_save, sender=ExternalApp)
+@receiver(post_delete, sender=ExternalApp)
+def invalidate_external_app_cache(sender, **kwargs):
+    # key rotation, deactivation or removal must apply immediately, and
+    # again once committed: a lookup in between still reads the old row
+    app_cache.invalidate()
+    transaction.on_commit(app_cache.invalidate)
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    # fires again for every reconnect, the wrapper list lives on the wrapper
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
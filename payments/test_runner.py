@@ -0,0 +1,23 @@
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+class PaymentsTestRunner(DiscoverRunner):
+    """
+    Runs the tests without psycopg's connection pool (DB_POOL_SIZE).
+
+    Django opens the pool against the configured database before it
+    switches to the test database, so with a pool the migrations and the
+    tests would run against (and flush) the real one.
+    """
+
+    def setup_databases(self, **kwargs):
+        for connection in connections.all(initialized_only=True):
+            connection.close()
+            # opened by PaymentsConfig.ready() against the real database
+            getattr(connection, "close_pool", lambda: None)()
+
+        for alias in connections:
+            connections[alias].settings_dict["OPTIONS"].pop("pool", None)
+
+        return super().setup_databases(**kwargs)
@@ -1,3 +1,2353 @@
-from django.test import TestCase
+import asyncio
+import copy
+import csv
+import gc
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DatabaseError, connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from urllib3.util.retry import RequestHistory
+
+from payments.admin import PaymentAdmin, prefix_q
+from payments.logs import SAMPLED, BackgroundHandler, CompressedRotatingFileHandler, JsonFormatter, SamplingFilter
+from payments.models import (
+    ExternalApp,
+    IdempotencyKey,
+    Payment,
+    PaymentPayload,
+    StkDispatchJob,
+    WebhookEvent,
+    decompress_payload,
+)
+from payments.routers import PIN_KEY, ReplicaRouter, is_pinned, pin_to_primary, replica_reads
+from payments.services.app_cache import app_cache
+from payments.services.benchmark import LoadRunner, StubDaraja, compare
+from payments.services.daraja import DarajaService
+from payments.services.dispatcher import StkDispatcher
+from payments.services.dedupe import duplicate_counts, recent_c2b_receipts
+from payments.services.http import JitteredRetry, build_session
+from payments.services.leasing import lease_rows
+from payments.services.idempotency import IdempotencyConflict, run_idempotent, sweep_expired
+from payments.services.metrics import Metrics, collect, metrics
+from payments.services.reconciliation import (
+    AMOUNT_MISMATCH,
+    MISSING,
+    NOT_ON_STATEMENT,
+    PHONE_MISMATCH,
+    read_statement,
+    reconcile,
+)
+from payments.services.replay import Anonymizer, CallbackEvent, events_from_logs
+from payments.services.sweeper import PendingStkSweeper
+from payments.services.token_cache import TokenCache
+from payments.services.notifier import publish, waiters
+from payments.services.webhooks import WebhookDeliverer, sign
+from payments.services.callbacks import C2B, STK, apply_callback_batch
+from payments.services.journal import CallbackJournal, JournalConsumer
+from payments.services import claims
+from payments.services.claims import ALREADY_CLAIMED, CLAIMED, NOT_FOUND, claim_payment
+
+
+@override_settings(
+    CACHES={"tokens": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tokens"}},
+    MPESA_TOKEN_CACHE_ALIAS="tokens",
+    MPESA_TOKEN_REFRESH_MARGIN=300,
+)
+class TokenCacheTests(TestCase):
+
+    def setUp(self):
+        self.fetched = []
+        self.addCleanup(caches["tokens"].clear)
+
+    def fetch(self, expires_in=3600, delay=0):
+        def fetch():
+            time.sleep(delay)
+            self.fetched.append(threading.current_thread().name)
+            return f"token-{len(self.fetched)}", expires_in
+
+        return fetch
+
+    def test_hit_is_shared_between_workers(self):
+        self.assertEqual(TokenCache("daraja", self.fetch()).get(), "token-1")
+
+        # another worker process, same cache
+        worker = TokenCache("daraja", self.fetch())
+        self.assertEqual(worker.get(), "token-1")
+        self.assertEqual(worker.peek(), "token-1")
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_refresh_margin(self):
+        token_cache = TokenCache("daraja", self.fetch())
+        token_cache.get()
+        entry = caches["tokens"].get("daraja")
+        self.assertEqual(entry["expires_at"] - entry["refresh_at"], 300)
+
+        # short-lived tokens are refreshed half way through
+        token_cache = TokenCache("short", self.fetch(expires_in=100))
+        token_cache.get()
+        entry = caches["tokens"].get("short")
+        self.assertEqual(entry["expires_at"] - entry["refresh_at"], 50)
+
+    def test_inside_margin_serves_current_token_and_refreshes_ahead(self):
+        token_cache = TokenCache("daraja", self.fetch())
+        token_cache.get()
+
+        # within the margin, not expired
+        now = time.time()
+        token_cache._local = dict(token_cache._local, refresh_at=now - 1, expires_at=now + 60)
+        caches["tokens"].set("daraja", token_cache._local)
+
+        self.assertIsNone(token_cache.peek())
+        self.assertEqual(token_cache.get(), "token-1")
+
+        # background refresh
+        with token_cache._refreshing:
+            pass
+        self.assertEqual(token_cache.get(), "token-2")
+        self.assertEqual(self.fetched[-1], "daraja-token-refresh")
+
+    def test_expired_token_refreshed_before_use(self):
+        token_cache = TokenCache("daraja", self.fetch())
+        token_cache.get()
+
+        now = time.time()
+        token_cache._local = dict(token_cache._local, refresh_at=now - 60, expires_at=now - 1)
+        caches["tokens"].set("daraja", token_cache._local)
+
+        self.assertEqual(token_cache.get(), "token-2")
+        self.assertEqual(self.fetched[-1], threading.current_thread().name)
+
+    def test_one_refresh_under_concurrency(self):
+        # one TokenCache per thread, like separate worker processes
+        workers = 8
+        barrier = threading.Barrier(workers)
+        tokens = []
+
+        def get():
+            token_cache = TokenCache("daraja", self.fetch(delay=0.2))
+            barrier.wait()
+            tokens.append(token_cache.get())
+
+        threads = [threading.Thread(target=get) for _ in range(workers)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ["token-1"] * workers)
+        self.assertEqual(len(self.fetched), 1)
+
+
+class DarajaSessionTests(TestCase):
+
+    def setUp(self):
+        self.stub = StubDaraja(error_rate=1).start()
+        self.addCleanup(self.stub.stop)
+
+        self.session = build_session(pool_size=1, max_retries=2, backoff_factor=0, jitter=0)
+        self.addCleanup(self.session.close)
+
+    def test_idempotent_requests_retried_on_5xx(self):
+        response = self.session.get(f"{self.stub.url}/oauth/v1/generate", timeout=5)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.stub.requests["/oauth/v1/generate"], 3)
+
+    def test_post_not_retried_once_sent(self):
+        response = self.session.post(f"{self.stub.url}/mpesa/stkpush/v1/processrequest", json={}, timeout=5)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.stub.requests["/mpesa/stkpush/v1/processrequest"], 1)
+
+    def test_connect_errors_retried_for_any_method(self):
+        # nothing listens here any more
+        url = self.stub.url
+        self.stub.stop()
+        increment = JitteredRetry.increment
+
+        with mock.patch.object(JitteredRetry, "increment", autospec=True, side_effect=increment) as failures:
+            with self.assertRaises(requests.ConnectionError):
+                self.session.post(f"{url}/mpesa/stkpush/v1/processrequest", json={}, timeout=5)
+
+        # the first try and two retries
+        self.assertEqual(failures.call_count, 3)
+
+    def test_backoff_is_exponential_with_jitter(self):
+        retry = JitteredRetry(total=5, backoff_factor=0.5)
+        retry.jitter = 0.25
+
+        for failures, base in [(1, 0), (2, 1), (3, 2), (4, 4)]:
+            history = tuple(RequestHistory("GET", "/", None, 503, None) for _ in range(failures))
+            backoff = retry.new(history=history).get_backoff_time()
+
+            if base:
+                self.assertGreaterEqual(backoff, base)
+                self.assertLessEqual(backoff, base + 0.25)
+            else:
+                self.assertEqual(backoff, 0)
+
+
+class PaymentIndexTests(TestCase):
+    """
+    The hot lookups must be served by the index meant for them, not a table
+    scan. Plans are taken for the SQL the endpoints actually send.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+        cls.admin_app = ExternalApp.objects.create(name="ADMIN_SHOP")
+
+        Payment.objects.create(
+            app=cls.app,
+            phone_number="254700000000",
+            amount=10,
+            external_reference="ORDER001",
+            mpesa_receipt_number="RCP001",
+            checkout_request_id="ws_CO_001",
+            payment_type="STK",
+            status="SUCCESS",
+        )
+
+        # enough rows for the planner to tell the indexes apart
+        Payment.objects.bulk_create([
+            Payment(
+                app=(cls.app, cls.admin_app)[i % 2],
+                phone_number=f"2547{i:08d}",
+                amount=10,
+                external_reference=f"FILL{i}",
+                mpesa_receipt_number=f"RFILL{i}",
+                checkout_request_id=f"ws_CO_fill{i}",
+                payment_type=("STK", "C2B")[i % 2],
+                status=("SUCCESS", "FAILED", "PENDING")[i % 3],
+                claimed=i % 4 == 0,
+            )
+            for i in range(500)
+        ])
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {Payment._meta.db_table}")
+
+    def setUp(self):
+        app_cache.clear()
+
+        if connection.vendor == "postgresql":
+            # test tables are still small enough to be scanned
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+
+    def explain(self, sql):
+        prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+        # the export reads through a server-side cursor
+        sql = re.sub(r"^DECLARE .*? FOR ", "", sql)
+
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql)
+            return "\n".join(str(row[-1]) for row in cursor.fetchall())
+
+    def plans(self, call):
+        """
+        Plans of the queries on the payments table ``call`` sends.
+        """
+        table = Payment._meta.db_table
+
+        with CaptureQueriesContext(connection) as queries:
+            call()
+
+        plans = [
+            self.explain(query["sql"])
+            for query in queries.captured_queries
+            if table in query["sql"] and not query["sql"].startswith(("INSERT", "SAVEPOINT", "RELEASE"))
+        ]
+
+        self.assertTrue(plans, "no query on the payments table")
+
+        for plan in plans:
+            self.assertNotRegex(plan, r"\bSCAN payments_payment\b(?! USING)|Seq Scan", plan)
+
+        return "\n".join(plans)
+
+    def receipt_indexes(self):
+        table = Payment._meta.db_table
+
+        if connection.vendor == "sqlite":
+            sql = (
+                "SELECT il.name FROM pragma_index_list(%s) AS il, pragma_index_info(il.name) AS ii "
+                "WHERE ii.name = 'mpesa_receipt_number'"
+            )
+        else:
+            sql = "SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexdef LIKE '%%(mpesa_receipt_number%%'"
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            return [row[0] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, plan, *names):
+        self.assertTrue(any(name in plan for name in names), f"none of {names} in\n{plan}")
+
+    def get(self, path, params):
+        return self.client.get(path, params, HTTP_X_API_KEY=self.app.api_key)
+
+    def post(self, path, data):
+        return self.client.post(path, data, content_type="application/json", HTTP_X_API_KEY=self.app.api_key)
+
+    def test_stk_callback_lookup(self):
+        callback = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_001", "ResultCode": 1032, "ResultDesc": "x"}}}
+        plan = self.plans(
+            lambda: self.client.post("/api/mpesa/stk-callback/", callback, content_type="application/json")
+        )
+
+        self.assertUsesIndex(plan, "payment_checkout_idx")
+
+    def test_verify_by_reference(self):
+        plan = self.plans(lambda: self.get("/api/payments/verify/", {"reference": "ORDER001"}))
+
+        self.assertUsesIndex(plan, "payment_app_status_ref_idx")
+
+    def test_verify_by_receipt(self):
+        plan = self.plans(
+            lambda: self.get("/api/payments/verify/", {"receipt": "RCP001", "phone": "254700000000"})
+        )
+
+        self.assertUsesIndex(plan, *self.receipt_indexes())
+
+    def test_claim_by_receipt(self):
+        plan = self.plans(lambda: self.post("/api/payments/claim/", {"receipt": "RCP001"}))
+
+        self.assertUsesIndex(plan, *self.receipt_indexes())
+
+    def test_claim_by_reference(self):
+        plan = self.plans(lambda: self.post("/api/payments/claim/", {"reference": "ORDER001"}))
+
+        # SQLite only uses a partial index when the WHERE has the literal
+        # values, the claim binds them as parameters
+        self.assertUsesIndex(plan, "payment_unclaimed_ref_idx", "payment_app_status_ref_idx")
+
+    def test_bulk_claim(self):
+        plan = self.plans(
+            lambda: self.post("/api/payments/claim/bulk/", {"receipts": ["RCP001"], "references": ["FILL3"]})
+        )
+
+        # both the receipts and the references, claimed or not, of the two apps
+        self.assertUsesIndex(plan, "payment_app_status_ref_idx")
+
+    def test_export_by_app(self):
+        plan = self.plans(lambda: b"".join(self.get("/api/payments/export/", {}).streaming_content))
+
+        self.assertUsesIndex(plan, "payment_app_created_idx")
+
+    def test_admin_changelist_order(self):
+        plan = Payment.objects.order_by("-created_at", "-id")[:100].explain()
+
+        self.assertUsesIndex(plan, "payment_created_idx")
+
+    def test_pending_stk_sweep(self):
+        self.assertUsesIndex(PendingStkSweeper.stale().explain(), "payment_pending_stk_idx")
+
+    def test_admin_phone_prefix_search(self):
+        plan = Payment.objects.filter(prefix_q("phone_number", "2547")).explain()
+
+        self.assertUsesIndex(plan, "payment_phone_idx")
+
+    def test_no_redundant_indexes(self):
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, Payment._meta.db_table)
+
+        # the app_* composites lead with app_id, the bare FK index is dead weight
+        self.assertFalse([
+            name for name, info in indexes.items()
+            if info["index"] and info["columns"] == ["app_id"]
+        ])
+        self.assertNotIn("payment_reference_idx", indexes)
+
+
+class PaymentPayloadMigrationTests(TransactionTestCase):
+
+    before = [("payments", "0008_idempotencykey")]
+    after = [("payments", "0009_paymentpayload")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_raw_callbacks_copied_with_their_date(self):
+        apps = self.migrate(self.before)
+        Payment = apps.get_model("payments", "Payment")
+        saved = timezone.now() - timedelta(days=30)
+
+        bodies = {
+            "C2B_CONFIRMATION": ("C2B", {"TransID": "MIG001", "TransAmount": "10.00"}),
+            "STK_CALLBACK": ("STK", {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_mig", "ResultCode": 0}}}),
+            "STK_INITIATION": ("STK", {"CheckoutRequestID": "ws_CO_mig2", "ResponseCode": "0"}),
+        }
+        payments = {
+            event_type: Payment.objects.create(
+                phone_number="254700000000", amount=10, payment_type=payment_type, raw_callback=body
+            )
+            for event_type, (payment_type, body) in bodies.items()
+        }
+        Payment.objects.create(phone_number="254700000000", amount=10)
+        Payment.objects.update(updated_at=saved)
+
+        apps = self.migrate(self.after)
+        PaymentPayload = apps.get_model("payments", "PaymentPayload")
+
+        self.assertEqual(PaymentPayload.objects.count(), 3)
+
+        for event_type, payment in payments.items():
+            payload = PaymentPayload.objects.get(payment_id=payment.pk)
+            self.assertEqual(payload.event_type, event_type)
+            self.assertEqual(decompress_payload(payload.data), bodies[event_type][1])
+            self.assertEqual(payload.created_at, saved)
+
+
+class PaymentAdminTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser("admin", "admin@example.com", "pw")
+
+        for i in range(7):
+            Payment.objects.create(
+                phone_number=f"25470000000{i}",
+                amount=10,
+                mpesa_receipt_number=f"RCP00{i}",
+                status="SUCCESS",
+            )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def changelist(self, query=""):
+        response = self.client.get(f"/admin/payments/payment/{query}")
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    @mock.patch.object(PaymentAdmin, "list_per_page", 3)
+    def test_keyset_pages_cover_every_row_once(self):
+        seen = []
+        query = ""
+
+        while True:
+            response = self.changelist(query)
+            cl = response.context["cl"]
+            seen.extend(p.pk for p in cl.result_list)
+
+            if not cl.next_cursor:
+                break
+
+            match = re.search(r'href="(\?[^"]*cursor=[^"]*)" class="end"', response.content.decode())
+            query = match.group(1).replace("&amp;", "&")
+
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(set(seen), set(Payment.objects.values_list("pk", flat=True)))
+        self.assertEqual(cl.result_count, 7)
+
+    def test_search_is_exact_or_phone_prefix(self):
+        cl = self.changelist("?q=rcp003").context["cl"]
+        self.assertEqual([p.mpesa_receipt_number for p in cl.result_list], ["RCP003"])
+
+        cl = self.changelist("?q=RCP00").context["cl"]
+        self.assertEqual(list(cl.result_list), [])
+
+        cl = self.changelist("?q=2547000").context["cl"]
+        self.assertEqual(len(cl.result_list), 7)
+
+    @mock.patch.object(PaymentAdmin, "list_per_page", 3)
+    def test_count_stops_at_limit(self):
+        with self.settings(PAYMENTS_ADMIN_COUNT_LIMIT=5):
+            response = self.changelist()
+
+        self.assertContains(response, "5+ payments")
+
+
+# replicas are other connections, they can't see this TestCase's rows
+@override_settings(DATABASE_REPLICAS=[])
+class ExportPaymentsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+        other_app = ExternalApp.objects.create(name="other")
+
+        for i in range(5):
+            Payment.objects.create(
+                app=cls.app,
+                phone_number="254700000000",
+                amount=10 + i,
+                mpesa_receipt_number=f"EXP00{i}",
+                status="SUCCESS",
+            )
+
+        Payment.objects.create(app=other_app, phone_number="254700000001", amount=1)
+
+    def export(self, **params):
+        return self.client.get("/api/payments/export/", params, HTTP_X_API_KEY=self.app.api_key)
+
+    def test_csv_export_only_has_own_payments(self):
+        response = self.export()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual([r["mpesa_receipt_number"] for r in rows], [f"EXP00{i}" for i in range(5)])
+
+    def test_ndjson_export_resumes_after_cursor(self):
+        response = self.export(output="ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 5)
+
+        cursor = f"{rows[1]['created_at']},{rows[1]['id']}"
+        response = self.export(output="ndjson", after=cursor)
+        resumed = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual(resumed, rows[2:])
+
+    def test_export_is_gzipped_when_accepted(self):
+        response = self.client.get(
+            "/api/payments/export/",
+            HTTP_X_API_KEY=self.app.api_key,
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+    def test_bad_params_are_rejected(self):
+        self.assertEqual(self.export(output="xml").status_code, 400)
+        self.assertEqual(self.export(start="yesterday").status_code, 400)
+        self.assertEqual(self.export(after="nope").status_code, 400)
+
+
+STATEMENT = """Account Holder:,ACME LTD
+Time Period:,2026-10-17 - 2026-10-17
+
+Receipt No.,Completion Time,Details,Transaction Status,Paid In,Withdrawn,Balance,Other Party Info
+REC001,2026-10-17 08:00:00,Pay Bill,Completed,100.00,,100.00,2547****0001 - JANE DOE
+REC002,2026-10-17 09:00:00,Pay Bill,Completed,"1,000.00",,1100.00,2547****0002 - JOHN DOE
+REC003,2026-10-17 10:00:00,Pay Bill,Completed,50.00,,1150.00,2547****0003 - MARY DOE
+REC004,2026-10-17 11:00:00,Pay Bill,Completed,75.00,,1225.00,2547****0004 - PAUL DOE
+CHG001,2026-10-17 11:30:00,Charge,Completed,,10.00,1215.00,
+REC006,2026-10-17 12:00:00,Pay Bill,Failed,20.00,,1215.00,2547****0006 - ANN DOE
+"""
+
+
+class ReconciliationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        def payment(receipt, amount, phone, hour):
+            Payment.objects.filter(
+                pk=Payment.objects.create(
+                    phone_number=phone,
+                    amount=amount,
+                    mpesa_receipt_number=receipt,
+                    status="SUCCESS",
+                ).pk
+            ).update(created_at=timezone.make_aware(datetime(2026, 10, 17, hour)))
+
+        payment("REC001", 100, "254700000001", 8)
+        payment("REC002", 999, "254700000002", 9)     # amount differs
+        payment("REC003", 50, "254700009993", 10)     # phone differs
+        payment("REC005", 30, "254700000005", 10)     # not on the statement
+        payment("REC007", 30, "254700000007", 20)     # outside the statement window
+
+    def reconcile(self, **kwargs):
+        issues = []
+        summary = reconcile(
+            read_statement(io.StringIO(STATEMENT)),
+            lambda *issue: issues.append(issue[:2]),
+            **kwargs,
+        )
+        return summary, sorted(issues)
+
+    def test_reports_every_discrepancy(self):
+        summary, issues = self.reconcile(chunk_size=2)
+
+        self.assertEqual(issues, [
+            (AMOUNT_MISMATCH, "REC002"),
+            (MISSING, "REC004"),
+            (NOT_ON_STATEMENT, "REC005"),
+            (PHONE_MISMATCH, "REC003"),
+        ])
+        self.assertEqual(summary["statement_rows"], 4)
+        self.assertEqual(summary["matched"], 1)
+
+    def test_admin_upload(self):
+        user = get_user_model().objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.force_login(user)
+
+        upload = io.BytesIO(STATEMENT.encode())
+        upload.name = "statement.csv"
+
+        response = self.client.post("/admin/payments/payment/reconcile/", {"statement": upload})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(response.context["summary"])[MISSING], 1)
+        self.assertContains(response, "REC004")
+
+
+class PendingStkSweeperTests(TestCase):
+
+    RESPONSES = {
+        "ws_CO_paid": {"ResultCode": "0", "ResultDesc": "The service request is processed successfully."},
+        "ws_CO_cancelled": {"ResultCode": "1032", "ResultDesc": "Request cancelled by user"},
+        "ws_CO_processing": {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"},
+    }
+
+    def setUp(self):
+        old = timezone.now() - timedelta(hours=1)
+
+        for checkout_id in [*self.RESPONSES, "ws_CO_fresh"]:
+            payment = Payment.objects.create(
+                phone_number="254700000000",
+                amount=10,
+                checkout_request_id=checkout_id,
+                payment_type="STK",
+            )
+
+            if checkout_id != "ws_CO_fresh":
+                Payment.objects.filter(pk=payment.pk).update(created_at=old)
+
+        self.sweeper = PendingStkSweeper(workers=2, rate=1000)
+        self.addCleanup(self.sweeper.shutdown)
+
+    def status(self, checkout_id):
+        return Payment.objects.get(checkout_request_id=checkout_id).status
+
+    @mock.patch("payments.services.sweeper.DarajaService.stk_query")
+    def test_settles_stale_payments(self, stk_query):
+        stk_query.side_effect = lambda checkout_id: self.RESPONSES[checkout_id]
+
+        self.assertEqual(self.sweeper.run_once(), 3)
+
+        # the query carries no receipt, the callback settles it
+        self.assertEqual(self.status("ws_CO_paid"), "PENDING")
+        self.assertEqual(self.status("ws_CO_cancelled"), "FAILED")
+        self.assertEqual(self.status("ws_CO_processing"), "PENDING")
+        self.assertEqual(self.status("ws_CO_fresh"), "PENDING")
+        self.assertEqual(PaymentPayload.objects.filter(event_type="STK_QUERY").count(), 3)
+
+        # the unsettled ones wait for MPESA_STK_QUERY_RETRY_SECONDS
+        self.assertEqual(self.sweeper.run_once(), 0)
+
+    # replicas are other connections, they can't see this TestCase's rows
+    @override_settings(DATABASE_REPLICAS=[])
+    @mock.patch("payments.services.sweeper.DarajaService.stk_query")
+    def test_paid_by_query_waits_for_the_callback(self, stk_query):
+        stk_query.side_effect = lambda checkout_id: self.RESPONSES[checkout_id]
+        app = ExternalApp.objects.create(name="shop")
+        ExternalApp.objects.create(name="ADMIN_SHOP")
+        app_cache.clear()
+        Payment.objects.filter(checkout_request_id="ws_CO_paid").update(app=app, external_reference="ORDER-Q")
+
+        with self.settings(MPESA_STK_QUERY_GIVE_UP_SECONDS=60):
+            self.sweeper.run_once()
+
+        # not given up on either
+        self.assertEqual(self.status("ws_CO_paid"), "PENDING")
+        self.assertEqual(self.status("ws_CO_processing"), "FAILED")
+
+        headers = {"HTTP_X_API_KEY": app.api_key}
+        response = self.client.get("/api/payments/verify/", {"reference": "ORDER-Q"}, **headers)
+        self.assertFalse(response.json()["paid"])
+
+        response = self.client.post(
+            "/api/payments/claim/", {"reference": "ORDER-Q"}, content_type="application/json", **headers
+        )
+        self.assertEqual(response.status_code, 404)
+
+        self.client.post("/api/mpesa/stk-callback/", {"Body": {"stkCallback": {
+            "CheckoutRequestID": "ws_CO_paid",
+            "ResultCode": 0,
+            "ResultDesc": "Processed",
+            "CallbackMetadata": {"Item": [{"Name": "MpesaReceiptNumber", "Value": "RQUERY01"}]},
+        }}}, content_type="application/json")
+
+        response = self.client.post(
+            "/api/payments/claim/", {"reference": "ORDER-Q"}, content_type="application/json", **headers
+        )
+        self.assertEqual(response.json()["receipt"], "RQUERY01")
+
+    def test_callback_that_lands_first_wins(self):
+        payments = list(self.sweeper.stale())
+        responses = [{"ResultCode": "1037", "ResultDesc": "DS timeout user cannot be reached"}] * len(payments)
+
+        # callback arrives while the queries are in flight
+        Payment.objects.filter(checkout_request_id="ws_CO_paid").update(status="SUCCESS")
+
+        self.sweeper._record(payments, responses)
+
+        self.assertEqual(self.status("ws_CO_paid"), "SUCCESS")
+        self.assertEqual(self.status("ws_CO_cancelled"), "FAILED")
+
+
+    @skipUnless(connection.features.has_select_for_update, "needs SELECT ... FOR UPDATE")
+    def test_pending_rows_locked_until_recorded(self):
+        payments = list(self.sweeper.stale())
+        responses = [{"ResultCode": "1032", "ResultDesc": "Request cancelled by user"}] * len(payments)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.sweeper._record(payments, responses)
+
+        sql = [q["sql"] for q in queries.captured_queries]
+        locked = next(i for i, query in enumerate(sql) if query.endswith("FOR UPDATE"))
+        updated = next(i for i, query in enumerate(sql) if query.startswith("UPDATE"))
+        self.assertLess(locked, updated)
+
+
+class StkDispatcherTests(TransactionTestCase):
+    """
+    Jobs are recorded from the dispatcher's threads, which need to see the
+    committed rows.
+    """
+
+    ACCEPTED = {"MerchantRequestID": "m-1", "CheckoutRequestID": "ws_CO_queued", "ResponseCode": "0"}
+
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            phone_number="254700000000",
+            amount=10,
+            external_reference="ORDER001",
+            payment_type="STK",
+        )
+        self.job = StkDispatchJob.objects.create(payment=self.payment, description="order")
+
+        self.dispatcher = StkDispatcher(workers=2)
+        # the exited worker threads' connections would keep the test
+        # database busy until collected
+        self.addCleanup(gc.collect)
+        self.addCleanup(self.dispatcher.shutdown)
+
+    @mock.patch("payments.services.dispatcher.DarajaService.stk_push")
+    def test_dispatches_queued_jobs(self, stk_push):
+        stk_push.return_value = self.ACCEPTED
+
+        self.assertEqual(self.dispatcher.run_once(), 1)
+
+        stk_push.assert_called_once_with(
+            phone_number="254700000000", amount=self.payment.amount, reference="ORDER001", description="order"
+        )
+        self.payment.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual((self.payment.checkout_request_id, self.payment.status), ("ws_CO_queued", "PENDING"))
+        self.assertEqual(self.job.status, "DONE")
+        self.assertIsNone(self.job.lease_owner)
+        self.assertTrue(self.payment.payloads.filter(event_type="STK_INITIATION").exists())
+
+        self.assertEqual(self.dispatcher.run_once(), 0)
+
+    @mock.patch("payments.services.dispatcher.DarajaService.stk_push")
+    def test_rejected_push_fails_the_payment(self, stk_push):
+        stk_push.return_value = {"errorCode": "400.002.02", "errorMessage": "Bad Request - Invalid PhoneNumber"}
+
+        self.dispatcher.run_once()
+
+        self.payment.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual(self.payment.status, "FAILED")
+        self.assertEqual(self.job.status, "FAILED")
+        self.assertIn("Invalid PhoneNumber", self.job.last_error)
+
+    @mock.patch("payments.services.dispatcher.DarajaService.stk_push")
+    def test_leased_jobs_are_not_sent_twice(self, stk_push):
+        other = StkDispatcher(workers=1)
+        self.addCleanup(other.shutdown)
+        lease_rows(StkDispatchJob.objects.all(), other.owner, 10, other.lease)
+
+        self.assertEqual(self.dispatcher.run_once(), 0)
+        stk_push.assert_not_called()
+
+    @mock.patch("payments.services.dispatcher.DarajaService.stk_push")
+    def test_unsent_push_is_retried(self, stk_push):
+        stk_push.return_value = {"error": "Daraja request failed", "detail": "Read timed out."}
+
+        self.dispatcher.run_once()
+
+        self.payment.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual(self.payment.status, "PENDING")
+        self.assertEqual(self.job.status, "QUEUED")
+        self.assertIn("Read timed out", self.job.last_error)
+        # not before the lease runs out
+        self.assertEqual(self.job.lease_owner, self.dispatcher.owner)
+        self.assertEqual(self.dispatcher.run_once(), 0)
+
+        StkDispatchJob.objects.update(lease_expires_at=timezone.now())
+        stk_push.return_value = self.ACCEPTED
+        self.assertEqual(self.dispatcher.run_once(), 1)
+
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "DONE")
+
+    def test_job_left_alone_once_the_lease_is_lost(self):
+        lease_rows(StkDispatchJob.objects.all(), self.dispatcher.owner, 10, self.dispatcher.lease)
+        job = StkDispatchJob.objects.select_related("payment").get()
+
+        # the lease expired and another dispatcher took the job
+        StkDispatchJob.objects.update(lease_owner="other")
+
+        self.dispatcher._record(job, job.payment, self.ACCEPTED)
+
+        self.job.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.lease_owner), ("QUEUED", "other"))
+        # the customer got the prompt, its callback must find the payment
+        self.assertEqual(self.payment.checkout_request_id, "ws_CO_queued")
+        self.assertTrue(self.payment.payloads.filter(event_type="STK_INITIATION").exists())
+
+        # a rejection does not fail the payment under the other dispatcher
+        self.dispatcher._record(job, job.payment, {"errorCode": "500.001.1001", "errorMessage": "busy"})
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "PENDING")
+
+
+class WebhookTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop", webhook_url="https://shop.example.com/hooks")
+        cls.quiet_app = ExternalApp.objects.create(name="quiet")
+
+    def setUp(self):
+        app_cache.clear()
+
+    def stk_payment(self, app, checkout_id):
+        return Payment.objects.create(
+            app=app,
+            phone_number="254700000000",
+            amount=10,
+            checkout_request_id=checkout_id,
+            payment_type="STK",
+        )
+
+    def callback(self, checkout_id, result_code=0):
+        stk_callback = {
+            "MerchantRequestID": "m",
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": result_code,
+            "ResultDesc": "done",
+        }
+
+        if result_code == 0:
+            stk_callback["CallbackMetadata"] = {
+                "Item": [{"Name": "MpesaReceiptNumber", "Value": f"R{checkout_id}"}]
+            }
+
+        return self.client.post(
+            "/api/mpesa/stk-callback/",
+            {"Body": {"stkCallback": stk_callback}},
+            content_type="application/json",
+        )
+
+    def test_callback_queues_event_for_subscribed_app(self):
+        self.stk_payment(self.app, "ws_CO_hook")
+        self.stk_payment(self.quiet_app, "ws_CO_quiet")
+
+        self.callback("ws_CO_hook")
+        self.callback("ws_CO_quiet", result_code=1032)
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.app, self.app)
+        self.assertEqual(event.event_type, "payment.succeeded")
+        self.assertEqual(event.payload["data"]["receipt"], "Rws_CO_hook")
+
+    def test_delivery_is_signed_and_retried(self):
+        self.stk_payment(self.app, "ws_CO_hook")
+        self.callback("ws_CO_hook")
+
+        deliverer = WebhookDeliverer(workers=2)
+        self.addCleanup(deliverer.shutdown)
+
+        with mock.patch.object(deliverer.session, "post") as post:
+            post.return_value = mock.Mock(status_code=503, text="busy")
+            self.assertEqual(deliverer.run_once(), 1)
+
+            event = WebhookEvent.objects.get()
+            self.assertEqual((event.status, event.attempts), ("PENDING", 1))
+            self.assertGreater(event.next_attempt_at, timezone.now())
+
+            # not due yet
+            self.assertEqual(deliverer.run_once(), 0)
+
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+            post.return_value = mock.Mock(status_code=200, text="ok")
+            deliverer.run_once()
+
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ("DELIVERED", 2))
+
+        headers = post.call_args.kwargs["headers"]
+        timestamp, signature = [part.split("=", 1)[1] for part in headers["X-Webhook-Signature"].split(",")]
+        self.assertEqual(signature, sign(self.app.webhook_secret, timestamp, post.call_args.kwargs["data"]))
+        self.assertEqual(headers["X-Webhook-Id"], str(event.id))
+
+    def test_gives_up_after_max_attempts(self):
+        self.stk_payment(self.app, "ws_CO_hook")
+        self.callback("ws_CO_hook")
+
+        deliverer = WebhookDeliverer(workers=1)
+        self.addCleanup(deliverer.shutdown)
+
+        with self.settings(PAYMENTS_WEBHOOK_MAX_ATTEMPTS=2), \
+                mock.patch.object(deliverer.session, "post", side_effect=requests.ConnectionError("refused")):
+            for _ in range(2):
+                WebhookEvent.objects.update(next_attempt_at=timezone.now())
+                deliverer.run_once()
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, "DEAD")
+        self.assertIn("refused", event.last_error)
+
+    def test_result_dropped_once_the_lease_is_lost(self):
+        self.stk_payment(self.app, "ws_CO_hook")
+        self.callback("ws_CO_hook")
+
+        deliverer = WebhookDeliverer(workers=1)
+        self.addCleanup(deliverer.shutdown)
+
+        def slow_post(*args, **kwargs):
+            # the lease ran out and another deliverer took the event
+            WebhookEvent.objects.update(lease_owner="other", attempts=1)
+            return mock.Mock(status_code=503, text="busy")
+
+        # in this thread, it writes to the test transaction
+        with mock.patch.object(deliverer.executor, "map", map), \
+                mock.patch.object(deliverer.session, "post", side_effect=slow_post):
+            self.assertEqual(deliverer.run_once(), 1)
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.lease_owner), ("PENDING", 1, "other"))
+        self.assertEqual(event.last_error, "")
+
+    def test_busy_host_pushes_events_back(self):
+        for i in range(3):
+            self.stk_payment(self.app, f"ws_CO_hook{i}")
+            self.callback(f"ws_CO_hook{i}")
+
+        deliverer = WebhookDeliverer(workers=3)
+        self.addCleanup(deliverer.shutdown)
+
+        # both slots taken by requests that are still running
+        entered = threading.Barrier(3, timeout=5)
+        release = threading.Event()
+
+        def slow_post(*args, **kwargs):
+            entered.wait()
+            release.wait(5)
+            return mock.Mock(status_code=200, text="ok")
+
+        events = list(WebhookEvent.objects.select_related("app").order_by("pk"))
+
+        with self.settings(PAYMENTS_WEBHOOK_MAX_PER_ENDPOINT=2, PAYMENTS_WEBHOOK_BUSY_DELAY_SECONDS=60), \
+                mock.patch.object(deliverer.session, "post", side_effect=slow_post) as post:
+            futures = [deliverer.executor.submit(deliverer.deliver, event) for event in events[:2]]
+            entered.wait()
+
+            deliverer.deliver(events[2])
+            release.set()
+
+            for future in futures:
+                future.result(timeout=5)
+
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual([e.status for e in events[:2]], ["DELIVERED", "DELIVERED"])
+
+        deferred = events[2]
+        self.assertEqual((deferred.status, deferred.attempts), ("PENDING", 0))
+        self.assertIsNone(deferred.lease_owner)
+        self.assertGreater(deferred.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+
+class PaymentStatusTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+        cls.payment = Payment.objects.create(
+            app=cls.app,
+            phone_number="254700000000",
+            amount=10,
+            checkout_request_id="ws_CO_wait",
+            payment_type="STK",
+        )
+
+    def setUp(self):
+        app_cache.clear()
+
+    def status(self, **params):
+        return self.async_client.get(
+            "/api/async/payments/status/", params, headers={"X-API-KEY": self.app.api_key}
+        )
+
+    async def settle(self):
+        await Payment.objects.filter(pk=self.payment.pk).aupdate(
+            status="SUCCESS", mpesa_receipt_number="RWAIT01"
+        )
+
+    async def test_returns_when_the_result_is_published(self):
+        request = asyncio.ensure_future(self.status(checkout_request_id="ws_CO_wait", timeout=10))
+        await asyncio.sleep(0.2)
+        self.assertFalse(request.done())
+
+        await self.settle()
+        publish([self.payment.pk])
+
+        response = await asyncio.wait_for(request, 2)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "SUCCESS")
+        self.assertEqual(response.json()["receipt"], "RWAIT01")
+
+    async def test_times_out_with_current_status(self):
+        response = await self.status(payment_id=str(self.payment.pk), timeout=0.1)
+
+        self.assertEqual(response.json()["status"], "PENDING")
+        self.assertFalse(response.json()["paid"])
+
+    async def test_wakes_on_notification_from_another_process(self):
+        request = asyncio.ensure_future(self.status(payment_id=str(self.payment.pk), timeout=10))
+        await asyncio.sleep(0.2)
+        await self.settle()
+
+        # what publish sends from another worker process
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(json.dumps([str(self.payment.pk)]).encode(), waiters.path())
+
+        response = await asyncio.wait_for(request, 2)
+        self.assertEqual(response.json()["status"], "SUCCESS")
+
+    async def test_event_stream_ends_once_settled(self):
+        await self.settle()
+
+        response = await self.async_client.get(
+            "/api/async/payments/status/",
+            {"payment_id": str(self.payment.pk)},
+            headers={"X-API-KEY": self.app.api_key, "Accept": "text/event-stream"},
+        )
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(body.startswith("event: status\ndata: "))
+        self.assertIn('"status": "SUCCESS"', body)
+
+    async def test_unknown_payment(self):
+        response = await self.status(payment_id="not-a-uuid")
+        self.assertEqual(response.status_code, 404)
+
+
+class ClaimPaymentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+        cls.other_app = ExternalApp.objects.create(name="other")
+        cls.admin_app = ExternalApp.objects.create(name="ADMIN_SHOP")
+
+    def claim(self, app, **data):
+        return self.client.post(
+            "/api/payments/claim/",
+            data,
+            content_type="application/json",
+            HTTP_X_API_KEY=app.api_key,
+        )
+
+    def test_claim_transfers_c2b_payment(self):
+        payment = Payment.objects.create(
+            app=self.admin_app,
+            phone_number="254700000000",
+            amount=10,
+            mpesa_receipt_number="C2B001",
+            status="SUCCESS",
+        )
+
+        response = self.claim(self.app, receipt="C2B001")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["receipt"], "C2B001")
+
+        payment.refresh_from_db()
+        self.assertTrue(payment.claimed)
+        self.assertIsNotNone(payment.claimed_at)
+        self.assertEqual(payment.app, self.app)
+
+        response = self.claim(self.app, receipt="C2B001")
+        self.assertEqual(response.status_code, 400)
+
+    def test_claim_by_reference(self):
+        Payment.objects.create(
+            app=self.app,
+            phone_number="254700000000",
+            amount=10,
+            external_reference="ORDER001",
+            mpesa_receipt_number="STK001",
+            payment_type="STK",
+            status="SUCCESS",
+        )
+
+        response = self.claim(self.app, reference="ORDER001")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["receipt"], "STK001")
+
+    def test_reference_claim_retried_after_losing_the_race(self):
+        for receipt in ["STK010", "STK011", "STK012"]:
+            Payment.objects.create(
+                app=self.app,
+                phone_number="254700000000",
+                amount=10,
+                external_reference="ORDER010",
+                mpesa_receipt_number=receipt,
+                payment_type="STK",
+                status="SUCCESS",
+            )
+
+        update_returning = claims._update_returning
+
+        def lose_twice(sql, params):
+            if update.call_count <= 2:
+                # its row went to another claim, each time
+                Payment.objects.filter(
+                    mpesa_receipt_number=f"STK01{update.call_count - 1}"
+                ).update(claimed=True)
+                return None
+            return update_returning(sql, params)
+
+        with mock.patch("payments.services.claims._update_returning", side_effect=lose_twice) as update:
+            response = self.claim(self.app, reference="ORDER010")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(update.call_count, 3)
+        self.assertEqual(response.json()["receipt"], "STK012")
+
+    def test_cannot_claim_other_apps_payment(self):
+        Payment.objects.create(
+            app=self.other_app,
+            phone_number="254700000000",
+            amount=10,
+            mpesa_receipt_number="STK002",
+            status="SUCCESS",
+        )
+
+        response = self.claim(self.app, receipt="STK002")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Payment.objects.get(mpesa_receipt_number="STK002").claimed)
+
+
+# replicas are other connections, they can't see this TestCase's rows
+@override_settings(DATABASE_REPLICAS=[])
+class BulkClaimPaymentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+        cls.other_app = ExternalApp.objects.create(name="other")
+        cls.admin_app = ExternalApp.objects.create(name="ADMIN_SHOP")
+
+        def payment(app, receipt, reference=None, claimed=False):
+            return Payment.objects.create(
+                app=app,
+                phone_number="254700000000",
+                amount=10,
+                mpesa_receipt_number=receipt,
+                external_reference=reference,
+                status="SUCCESS",
+                claimed=claimed,
+            )
+
+        cls.c2b = payment(cls.admin_app, "BLK001")
+        cls.first_order = payment(cls.app, "BLK002", "ORDER001")
+        cls.second_order = payment(cls.app, "BLK003", "ORDER001")
+        cls.claimed = payment(cls.app, "BLK004", "ORDER002", claimed=True)
+        cls.foreign = payment(cls.other_app, "BLK005", "ORDER003")
+
+    def setUp(self):
+        app_cache.clear()
+
+    def post(self, path, **data):
+        return self.client.post(path, data, content_type="application/json", HTTP_X_API_KEY=self.app.api_key)
+
+    def claim(self, **data):
+        return self.post("/api/payments/claim/bulk/", **data)
+
+    def statuses(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [(item.get("receipt"), item["status"]) for item in response.json()["results"]]
+
+    def test_mixed_receipts_and_references(self):
+        response = self.claim(receipts=["BLK001", "BLK004", "BLK005", "NOPE"], references=["ORDER001", "ORDER002"])
+
+        self.assertEqual(self.statuses(response), [
+            ("BLK001", "claimed"),
+            ("BLK004", "already_claimed"),
+            ("BLK005", "not_found"),
+            ("NOPE", "not_found"),
+            ("BLK002", "claimed"),
+            ("BLK004", "already_claimed"),
+        ])
+
+        self.c2b.refresh_from_db()
+        self.assertEqual((self.c2b.claimed, self.c2b.app), (True, self.app))
+        self.assertFalse(Payment.objects.get(pk=self.second_order.pk).claimed)
+        self.assertFalse(Payment.objects.get(pk=self.foreign.pk).claimed)
+
+    def test_duplicated_identifier_claims_once(self):
+        response = self.claim(receipts=["BLK001", "BLK001"], references=["ORDER001", "ORDER001"])
+
+        self.assertEqual(self.statuses(response), [
+            ("BLK001", "claimed"),
+            ("BLK001", "already_claimed"),
+            ("BLK002", "claimed"),
+            ("BLK002", "already_claimed"),
+        ])
+        self.assertFalse(Payment.objects.get(pk=self.second_order.pk).claimed)
+
+    def test_receipt_and_reference_of_one_payment(self):
+        response = self.claim(receipts=["BLK002"], references=["ORDER001"])
+
+        # the reference must not move on to the next ORDER001 payment
+        self.assertEqual(self.statuses(response), [("BLK002", "claimed"), ("BLK002", "already_claimed")])
+        self.assertFalse(Payment.objects.get(pk=self.second_order.pk).claimed)
+
+    def test_claimed_by_another_request_in_between(self):
+        claim_rows = claims._claim_rows
+
+        def race(app, admin_app, ids):
+            # another request wins between the SELECT and the UPDATE
+            claim_payment(self.app, admin_app, receipt="BLK001")
+            return claim_rows(app, admin_app, ids)
+
+        with mock.patch("payments.services.claims._claim_rows", side_effect=race):
+            response = self.claim(receipts=["BLK001", "BLK002"])
+
+        self.assertEqual(self.statuses(response), [("BLK001", "already_claimed"), ("BLK002", "claimed")])
+
+    def test_over_limit_batch_rejected(self):
+        with self.settings(PAYMENTS_BULK_MAX_ITEMS=3):
+            response = self.claim(receipts=["BLK001", "BLK002"], references=["ORDER001", "ORDER002"])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Payment.objects.filter(claimed=True).exclude(pk=self.claimed.pk).exists())
+
+    def test_bulk_verify(self):
+        response = self.post(
+            "/api/payments/verify/bulk/",
+            receipts=["BLK002", "BLK003", "BLK005"],
+            references=["ORDER001", "ORDER003"],
+            phones={"BLK003": "254799999999"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["receipts"]["BLK002"]["receipt"], "BLK002")
+        # wrong phone, and another app's payment
+        self.assertEqual(body["receipts"]["BLK003"], {"paid": False})
+        self.assertEqual(body["receipts"]["BLK005"], {"paid": False})
+        self.assertTrue(body["references"]["ORDER001"]["paid"])
+        self.assertEqual(body["references"]["ORDER003"], {"paid": False})
+
+        with self.settings(PAYMENTS_BULK_MAX_ITEMS=1):
+            response = self.post("/api/payments/verify/bulk/", receipts=["BLK002", "BLK003"])
+
+        self.assertEqual(response.status_code, 400)
+
+
+class ConcurrentClaimTests(TransactionTestCase):
+
+    THREADS = 16
+
+    def setUp(self):
+        self.admin_app = ExternalApp.objects.create(name="ADMIN_SHOP")
+
+        Payment.objects.create(
+            app=self.admin_app,
+            phone_number="254700000000",
+            amount=10,
+            mpesa_receipt_number="RACE001",
+            status="SUCCESS",
+        )
+
+    def race(self, apps, **identifier):
+        barrier = threading.Barrier(len(apps))
+        outcomes = []
+
+        def claim(app):
+            try:
+                barrier.wait()
+                outcome, _ = claim_payment(app, self.admin_app, **(identifier or {"receipt": "RACE001"}))
+                outcomes.append((app, outcome))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(app,)) for app in apps]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return outcomes
+
+    def test_one_winner_across_apps(self):
+        apps = [
+            ExternalApp.objects.create(name=f"app-{i}")
+            for i in range(self.THREADS)
+        ]
+
+        outcomes = self.race(apps)
+
+        winners = [app for app, outcome in outcomes if outcome == CLAIMED]
+        self.assertEqual(len(outcomes), self.THREADS)
+        self.assertEqual(len(winners), 1)
+
+        # the payment now belongs to the winner, the others can't see it
+        losers = [outcome for app, outcome in outcomes if app != winners[0]]
+        self.assertEqual(set(losers), {NOT_FOUND})
+
+        payment = Payment.objects.get(mpesa_receipt_number="RACE001")
+        self.assertTrue(payment.claimed)
+        self.assertEqual(payment.app, winners[0])
+
+    def test_racing_reference_claims_take_every_payment(self):
+        app = ExternalApp.objects.create(name="shop")
+
+        # more payments than one retry can cover when several claims lose
+        # to the same winners
+        for i in range(5):
+            Payment.objects.create(
+                app=app,
+                phone_number="254700000000",
+                amount=10,
+                external_reference="ORDER-RACE",
+                mpesa_receipt_number=f"RACE00{i + 2}",
+                status="SUCCESS",
+            )
+
+        outcomes = [outcome for _, outcome in self.race([app] * self.THREADS, reference="ORDER-RACE")]
+
+        self.assertEqual(outcomes.count(CLAIMED), 5)
+        self.assertFalse(Payment.objects.filter(external_reference="ORDER-RACE", claimed=False).exists())
+
+    def test_one_winner_within_app(self):
+        app = ExternalApp.objects.create(name="shop")
+
+        outcomes = [outcome for _, outcome in self.race([app] * self.THREADS)]
+
+        self.assertEqual(outcomes.count(CLAIMED), 1)
+        self.assertEqual(outcomes.count(ALREADY_CLAIMED), self.THREADS - 1)
+
+
+class C2BConfirmationTests(TestCase):
+
+    def setUp(self):
+        # cached rows from other tests were rolled back
+        app_cache.clear()
+        recent_c2b_receipts.clear()
+
+    def confirm(self, receipt, **fields):
+        body = {
+            "TransID": receipt,
+            "MSISDN": "254700000000",
+            "TransAmount": "10.00",
+            "BillRefNumber": "ACC001",
+        }
+        body.update(fields)
+
+        return self.client.post("/api/mpesa/c2b/confirmation/", body, content_type="application/json")
+
+    def test_redelivery_is_acked_once_recorded(self):
+        before = duplicate_counts()
+
+        for _ in range(3):
+            response = self.confirm("C2BDUP1")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["ResultCode"], 0)
+
+        self.assertEqual(Payment.objects.filter(mpesa_receipt_number="C2BDUP1").count(), 1)
+        self.assertEqual(
+            PaymentPayload.objects.filter(payment__mpesa_receipt_number="C2BDUP1").count(), 1
+        )
+        self.assertEqual(duplicate_counts()["memory"] - before["memory"], 2)
+
+    def test_duplicate_caught_by_database(self):
+        before = duplicate_counts()
+
+        self.confirm("C2BDUP2")
+        # another worker recorded it, this one never saw it
+        recent_c2b_receipts.clear()
+
+        response = self.confirm("C2BDUP2")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Payment.objects.filter(mpesa_receipt_number="C2BDUP2").count(), 1)
+        self.assertEqual(duplicate_counts()["database"] - before["database"], 1)
+
+    def test_malformed_confirmation_is_not_acked(self):
+        before = duplicate_counts()
+
+        with self.assertLogs("payments", "ERROR"):
+            response = self.confirm("C2BBAD1", TransAmount=None)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertNotEqual(response.json()["ResultCode"], 0)
+        self.assertFalse(Payment.objects.filter(mpesa_receipt_number="C2BBAD1").exists())
+        self.assertEqual(duplicate_counts(), before)
+
+        # the retry goes through once the body is complete
+        response = self.confirm("C2BBAD1")
+        self.assertEqual(response.json()["ResultCode"], 0)
+        self.assertTrue(Payment.objects.filter(mpesa_receipt_number="C2BBAD1").exists())
+
+    async def test_async_confirmation_uses_the_shared_service(self):
+        # subscribed, so the outbox event is written with the payment
+        await ExternalApp.objects.acreate(name="ADMIN_SHOP", webhook_url="https://intake.example/hook")
+
+        response = await self.async_client.post(
+            "/api/async/mpesa/c2b/confirmation/", "{not json", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        body = {"TransID": "C2BASYNC1", "MSISDN": "254700000000", "BillRefNumber": "ACC001"}
+
+        with self.assertLogs("payments", "ERROR"):
+            response = await self.async_client.post(
+                "/api/async/mpesa/c2b/confirmation/", body, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 500)
+
+        body["TransAmount"] = "10.00"
+
+        for _ in range(2):
+            response = await self.async_client.post(
+                "/api/async/mpesa/c2b/confirmation/", body, content_type="application/json"
+            )
+            self.assertEqual(response.json()["ResultCode"], 0)
+
+        payment = await Payment.objects.aget(mpesa_receipt_number="C2BASYNC1")
+        self.assertEqual(await PaymentPayload.objects.filter(payment=payment).acount(), 1)
+        self.assertEqual(await WebhookEvent.objects.filter(payment=payment).acount(), 1)
+
+
+class CallbackJournalTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop", webhook_url="https://shop.example.com/hooks")
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+
+        app_cache.clear()
+        recent_c2b_receipts.clear()
+
+    def journal_callbacks(self, count):
+        journal = CallbackJournal(self.dir)
+
+        for i in range(count):
+            Payment.objects.create(
+                app=self.app,
+                phone_number="254700000000",
+                amount=10,
+                checkout_request_id=f"ws_CO_j{i}",
+                payment_type="STK",
+            )
+            journal.append(STK, {"Body": {"stkCallback": {
+                "CheckoutRequestID": f"ws_CO_j{i}",
+                "ResultCode": 0,
+                "ResultDesc": "done",
+                "CallbackMetadata": {"Item": [{"Name": "MpesaReceiptNumber", "Value": f"RJS{i}"}]},
+            }}})
+            journal.append(C2B, {
+                "TransID": f"RJC{i}", "MSISDN": "254700000000", "TransAmount": "10.00", "BillRefNumber": "A",
+            })
+
+    def test_replay_after_crash_has_no_duplicates_or_losses(self):
+        self.journal_callbacks(4)
+        batches = []
+
+        class Crash(Exception):
+            pass
+
+        def crashing_apply(records):
+            batches.append(records)
+
+            if len(batches) == 2:
+                # killed after the commit, before the checkpoint
+                apply_callback_batch(records)
+                raise Crash
+
+            if len(batches) == 3:
+                # killed inside the transaction
+                with mock.patch("payments.services.callbacks._apply_stk_batch", side_effect=Crash):
+                    apply_callback_batch(records)
+
+            apply_callback_batch(records)
+
+        for _ in range(2):
+            with self.assertRaises(Crash):
+                JournalConsumer(self.dir, crashing_apply, batch_size=3).run_once()
+
+        JournalConsumer(self.dir, crashing_apply, batch_size=3).run_once()
+
+        self.assertEqual(Payment.objects.filter(payment_type="C2B").count(), 4)
+        self.assertEqual(Payment.objects.filter(payment_type="STK", status="SUCCESS").count(), 4)
+        self.assertEqual(PaymentPayload.objects.filter(event_type="C2B_CONFIRMATION").count(), 4)
+        self.assertEqual(
+            sorted(PaymentPayload.objects.filter(event_type="STK_CALLBACK").values_list("payment__checkout_request_id", flat=True)),
+            [f"ws_CO_j{i}" for i in range(4)],
+        )
+        self.assertEqual(WebhookEvent.objects.filter(app=self.app).count(), 4)
+
+    def segment(self, created_ns, pid, text="{}\n"):
+        name = f"{created_ns}-{pid}.jsonl"
+        with open(os.path.join(self.dir, name), "w") as f:
+            f.write(text)
+        return name
+
+    def test_segments_retired_once_their_writer_is_done(self):
+        # no process has this pid
+        exited = self.segment(1, 4194305)
+        torn = self.segment(2, 4194305, '{"kind": "c2b"')
+        closed = self.segment(3, os.getpid())
+        current = self.segment(4, os.getpid())
+
+        JournalConsumer(self.dir, lambda records: None, batch_size=10).run_once()
+
+        remaining = os.listdir(self.dir)
+        self.assertNotIn(exited, remaining)
+        self.assertNotIn(torn, remaining)
+        self.assertNotIn(closed, remaining)
+        self.assertIn(current, remaining)
+
+
+class IdempotencyTests(TestCase):
+
+    PUSH = {"phone_number": "254700000000", "amount": 1, "reference": "ORDER1", "description": "test"}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+
+    def setUp(self):
+        app_cache.clear()
+        self.stub = StubDaraja().start()
+        self.addCleanup(self.stub.stop)
+
+        settings_override = self.settings(MPESA_BASE_URL=self.stub.url, MPESA_STK_DISPATCH_MODE="sync")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def push(self, key, path="/api/stk-push/", **data):
+        return self.client.post(
+            path,
+            dict(self.PUSH, **data),
+            content_type="application/json",
+            headers={"X-API-KEY": self.app.api_key, "Idempotency-Key": key},
+        )
+
+    def pushes(self):
+        return self.stub.requests["/mpesa/stkpush/v1/processrequest"]
+
+    def test_repeat_replays_first_response(self):
+        first = self.push("key-1")
+        repeat = self.push("key-1")
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(repeat.json()["payment_id"], str(first.json()["payment_id"]))
+        self.assertEqual(repeat["Idempotent-Replayed"], "true")
+        self.assertEqual(self.pushes(), 1)
+        self.assertEqual(Payment.objects.filter(external_reference="ORDER1").count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        self.push("key-2")
+
+        response = self.push("key-2", amount=2)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.pushes(), 1)
+
+    def test_daraja_error_is_not_replayed(self):
+        self.stub.error_rate = 1
+
+        response = self.push("key-3")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["daraja_response"]["errorMessage"], "Stub error")
+        self.assertFalse(IdempotencyKey.objects.filter(key="key-3").exists())
+
+        # the retry pushes again
+        self.stub.error_rate = 0
+        response = self.push("key-3")
+
+        self.assertIn("CheckoutRequestID", response.json()["daraja_response"])
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(self.pushes(), 2)
+
+    def test_key_taken_over_while_running(self):
+        def slow_push():
+            # went stale, a repeat deleted it and is running itself now
+            IdempotencyKey.objects.filter(key="key-5").delete()
+            IdempotencyKey.objects.create(
+                app=self.app,
+                key="key-5",
+                request_hash="hash",
+                expires_at=timezone.now() + timedelta(hours=1),
+            )
+            return 200, {"ok": True}
+
+        result = run_idempotent(self.app, "key-5", "hash", slow_push)
+
+        # answered, without overwriting the repeat's record
+        self.assertEqual(result, (200, {"ok": True}, False))
+        self.assertEqual(IdempotencyKey.objects.get(key="key-5").status, "IN_PROGRESS")
+
+    def test_key_swept_while_running(self):
+        def slow_push():
+            sweep_expired()
+            return 200, {"ok": True}
+
+        with self.settings(IDEMPOTENCY_LOCK_TIMEOUT=-1):
+            result = run_idempotent(self.app, "key-6", "hash", slow_push)
+
+        self.assertEqual(result, (200, {"ok": True}, False))
+        self.assertFalse(IdempotencyKey.objects.filter(key="key-6").exists())
+
+    async def test_async_view_shares_keys_with_sync_view(self):
+        first = await sync_to_async(self.push)("key-4")
+        repeat = await self.async_client.post(
+            "/api/async/stk-push/",
+            self.PUSH,
+            content_type="application/json",
+            headers={"X-API-KEY": self.app.api_key, "Idempotency-Key": "key-4"},
+        )
+
+        self.assertEqual(repeat.status_code, 200)
+        self.assertEqual(repeat["Idempotent-Replayed"], "true")
+        self.assertEqual(repeat.json()["payment_id"], str(first.json()["payment_id"]))
+        self.assertEqual(self.pushes(), 1)
+
+
+class ConcurrentIdempotencyTests(TransactionTestCase):
+
+    def setUp(self):
+        self.app = ExternalApp.objects.create(name="shop")
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def handler(self):
+        self.calls.append(1)
+        self.started.set()
+        self.release.wait(5)
+        return 200, {"ok": True}
+
+    def first_request(self):
+        def run():
+            try:
+                run_idempotent(self.app, "key", "hash", self.handler)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.release.set)
+        self.assertTrue(self.started.wait(5))
+
+    def test_repeat_waits_for_the_first_request(self):
+        self.first_request()
+        threading.Timer(0.3, self.release.set).start()
+
+        status_code, body, replayed = run_idempotent(self.app, "key", "hash", self.handler)
+
+        self.assertEqual((status_code, body, replayed), (200, {"ok": True}, True))
+        self.assertEqual(len(self.calls), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0.2)
+    def test_repeat_gives_up_while_in_progress(self):
+        self.first_request()
+
+        with self.assertRaises(IdempotencyConflict) as raised:
+            run_idempotent(self.app, "key", "hash", self.handler)
+
+        self.assertEqual(raised.exception.status_code, 409)
+        self.assertEqual(len(self.calls), 1)
+
+
+class AsyncViewsTests(TestCase):
+
+    PUSH = {"phone_number": "254700000000", "amount": 1, "reference": "ORDER1", "description": "test"}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop", webhook_url="https://shop.example/hook")
+        cls.admin_app = ExternalApp.objects.create(name="ADMIN_SHOP")
+
+    def setUp(self):
+        app_cache.clear()
+        self.stub = StubDaraja().start()
+        self.addCleanup(self.stub.stop)
+
+        settings_override = self.settings(MPESA_BASE_URL=self.stub.url, MPESA_STK_DISPATCH_MODE="sync")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def post(self, path, data, **headers):
+        return self.async_client.post(
+            f"/api/async/{path}", data, content_type="application/json", headers=headers
+        )
+
+    async def test_stk_push(self):
+        response = await self.post("stk-push/", self.PUSH, **{"X-API-KEY": self.app.api_key})
+
+        self.assertEqual(response.status_code, 200)
+        payment = await Payment.objects.aget(pk=response.json()["payment_id"])
+        self.assertEqual(payment.checkout_request_id, response.json()["daraja_response"]["CheckoutRequestID"])
+        self.assertEqual(payment.status, "PENDING")
+
+        response = await self.post("stk-push/", dict(self.PUSH, phone_number=""), **{"X-API-KEY": self.app.api_key})
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.post("stk-push/", self.PUSH, **{"X-API-KEY": "wrong"})
+        self.assertEqual(response.status_code, 403)
+
+    async def test_stk_push_saved_in_one_transaction(self):
+        with mock.patch("payments.api.views.PaymentPayload.record", side_effect=DatabaseError("disk full")):
+            with self.assertRaises(DatabaseError):
+                await self.post("stk-push/", self.PUSH, **{"X-API-KEY": self.app.api_key})
+
+        self.assertFalse(await Payment.objects.filter(app=self.app).aexists())
+
+    async def test_stk_push_queue_mode(self):
+        with self.settings(MPESA_STK_DISPATCH_MODE="queue"):
+            response = await self.post("stk-push/", self.PUSH, **{"X-API-KEY": self.app.api_key})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(await StkDispatchJob.objects.filter(payment_id=response.json()["payment_id"]).aexists())
+        self.assertEqual(self.stub.requests["/mpesa/stkpush/v1/processrequest"], 0)
+
+    async def test_stk_callback(self):
+        payment = await Payment.objects.acreate(
+            app=self.app,
+            phone_number="254700000000",
+            amount=1,
+            payment_type="STK",
+            checkout_request_id="ws_CO_async",
+        )
+
+        response = await self.post("mpesa/stk-callback/", {"Body": {"stkCallback": {
+            "MerchantRequestID": "1",
+            "CheckoutRequestID": "ws_CO_async",
+            "ResultCode": 0,
+            "ResultDesc": "Processed",
+            "CallbackMetadata": {"Item": [{"Name": "MpesaReceiptNumber", "Value": "RASYNC01"}]},
+        }}})
+
+        self.assertEqual(response.json()["ResultCode"], 0)
+        await payment.arefresh_from_db()
+        self.assertEqual((payment.status, payment.mpesa_receipt_number), ("SUCCESS", "RASYNC01"))
+        self.assertTrue(await PaymentPayload.objects.filter(payment=payment, event_type="STK_CALLBACK").aexists())
+        self.assertEqual(await WebhookEvent.objects.filter(payment=payment).acount(), 1)
+
+        # unknown checkout ids are acked too
+        response = await self.post("mpesa/stk-callback/", {"Body": {"stkCallback": {
+            "CheckoutRequestID": "ws_CO_unknown", "ResultCode": 1032, "ResultDesc": "Cancelled",
+        }}})
+        self.assertEqual(response.json()["ResultCode"], 0)
+
+    async def test_stk_callback_redelivered(self):
+        lease_expires_at = timezone.now() + timedelta(minutes=1)
+        payment = await Payment.objects.acreate(
+            app=self.app,
+            phone_number="254700000000",
+            amount=1,
+            payment_type="STK",
+            checkout_request_id="ws_CO_again",
+            lease_owner="sweeper",
+            lease_expires_at=lease_expires_at,
+        )
+        body = {"Body": {"stkCallback": {
+            "MerchantRequestID": "1",
+            "CheckoutRequestID": "ws_CO_again",
+            "ResultCode": 0,
+            "ResultDesc": "Processed",
+            "CallbackMetadata": {"Item": [{"Name": "MpesaReceiptNumber", "Value": "RAGAIN01"}]},
+        }}}
+
+        await self.post("mpesa/stk-callback/", body)
+        await Payment.objects.filter(pk=payment.pk).aupdate(claimed=True)
+        await self.post("mpesa/stk-callback/", body)
+
+        await payment.arefresh_from_db()
+        self.assertEqual((payment.status, payment.mpesa_receipt_number), ("SUCCESS", "RAGAIN01"))
+        # only the result fields are written
+        self.assertTrue(payment.claimed)
+        self.assertEqual((payment.lease_owner, payment.lease_expires_at), ("sweeper", lease_expires_at))
+        # the second delivery changes nothing
+        self.assertEqual(await PaymentPayload.objects.filter(payment=payment, event_type="STK_CALLBACK").acount(), 1)
+        self.assertEqual(await WebhookEvent.objects.filter(payment=payment).acount(), 1)
+
+    async def test_verify_and_claim(self):
+        await Payment.objects.acreate(
+            app=self.admin_app,
+            phone_number="254700000000",
+            amount=10,
+            mpesa_receipt_number="CASYNC01",
+            status="SUCCESS",
+        )
+        headers = {"X-API-KEY": self.app.api_key}
+
+        # C2B payments belong to the intake until claimed
+        response = await self.async_client.get("/api/async/payments/verify/", {"receipt": "CASYNC01"}, headers=headers)
+        self.assertFalse(response.json()["paid"])
+
+        response = await self.post("payments/claim/", {"receipt": "CASYNC01"}, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["receipt"], "CASYNC01")
+
+        response = await self.async_client.get("/api/async/payments/verify/", {"receipt": "CASYNC01"}, headers=headers)
+        self.assertTrue(response.json()["paid"])
+        self.assertTrue(response.json()["claimed"])
+
+        response = await self.post("payments/claim/", {"receipt": "CASYNC01"}, **headers)
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.post("payments/claim/", {"receipt": "NOPE"}, **headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_peek_leaves_the_generation_check_to_a_thread(self):
+        app_cache.by_api_key(self.app.api_key)
+        self.assertEqual(app_cache.peek_api_key(self.app.api_key), self.app)
+
+        app_cache._synced_at = 0
+
+        with mock.patch("payments.services.app_cache.caches") as caches:
+            self.assertIsNone(app_cache.peek_api_key(self.app.api_key))
+
+        caches.assert_not_called()
+
+
+@override_settings(API_KEY_CACHE_SHARED_INVALIDATION=False)
+class ExternalAppCacheTests(TestCase):
+
+    def setUp(self):
+        app_cache.clear()
+        self.app = ExternalApp.objects.create(name="shop")
+        self.key = self.app.api_key
+
+    def test_save_invalidates(self):
+        self.assertEqual(app_cache.by_api_key(self.key), self.app)
+        self.assertEqual(app_cache.peek_api_key(self.key), self.app)
+
+        # rotation
+        self.app.api_key = "rotated"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app.save()
+
+        self.assertIsNone(app_cache.by_api_key(self.key))
+        self.assertEqual(app_cache.by_api_key("rotated"), self.app)
+
+        # deactivation
+        self.app.is_active = False
+        self.app.save()
+
+        self.assertIsNone(app_cache.peek_api_key("rotated"))
+        self.assertIsNone(app_cache.by_api_key("rotated"))
+
+    def test_read_racing_an_invalidation_is_not_cached(self):
+        filter_apps = ExternalApp.objects.filter
+
+        def racing_filter(*args, **kwargs):
+            # the key is revoked while this lookup's query runs
+            app_cache.invalidate()
+            return filter_apps(*args, **kwargs)
+
+        with mock.patch.object(ExternalApp.objects, "filter", side_effect=racing_filter):
+            self.assertEqual(app_cache.by_api_key(self.key), self.app)
+
+        self.assertIsNone(app_cache.peek_api_key(self.key))
+
+        # the next lookup caches it again
+        app_cache.by_api_key(self.key)
+        self.assertEqual(app_cache.peek_api_key(self.key), self.app)
+
+
+class LoggingPipelineTests(TestCase):
+
+    def record(self, level=logging.INFO, **extra):
+        record = logging.makeLogRecord({"levelno": level, "levelname": logging.getLevelName(level)})
+        record.msg, record.args = "Receipt=%s", ("RCP001",)
+        record.__dict__.update(extra)
+        return record
+
+    def test_sampling_only_thins_marked_info_records(self):
+        sampling = SamplingFilter(rate=0)
+
+        self.assertFalse(sampling.filter(self.record(**SAMPLED)))
+        self.assertTrue(sampling.filter(self.record()))
+        self.assertTrue(sampling.filter(self.record(logging.WARNING, **SAMPLED)))
+
+    def test_json_lines_carry_extras(self):
+        line = JsonFormatter().format(self.record(payment_id=7, **SAMPLED))
+        entry = json.loads(line)
+
+        self.assertEqual(entry["msg"], "Receipt=RCP001")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["payment_id"], 7)
+        self.assertNotIn("sampled", entry)
+
+
+    def log_dir(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return directory.name
+
+    def test_each_process_writes_its_own_file(self):
+        directory = self.log_dir()
+        handler = CompressedRotatingFileHandler(os.path.join(directory, "payments.log"), delay=True)
+        self.addCleanup(handler.close)
+
+        handler.emit(self.record())
+
+        self.assertEqual(os.listdir(directory), [f"payments.{os.getpid()}.log"])
+
+    def test_oldest_backups_deleted_first(self):
+        directory = self.log_dir()
+        handler = CompressedRotatingFileHandler(os.path.join(directory, "payments.log"), backupCount=2, delay=True)
+        self.addCleanup(handler.close)
+        base = os.path.basename(handler.baseFilename)
+
+        # exited process, a pid no process has
+        orphan = os.path.join(directory, "payments.4194305.log")
+        with open(orphan, "w") as f:
+            f.write("{}\n")
+        os.utime(orphan, (1, 1))
+        handler._gzip_orphans()
+
+        names = [f"{base}.2026-10-18.gz"] + [f"{base}.2026-10-18.{i}.gz" for i in range(1, 11)]
+        for age, name in enumerate(reversed(names)):
+            path = os.path.join(directory, name)
+            with open(path, "w"):
+                pass
+            os.utime(path, (1000 - age, 1000 - age))
+
+        expired = handler.getFilesToDelete()
+
+        self.assertNotIn("payments.4194305.log.exited.gz", os.listdir(directory))
+        self.assertEqual(len(expired), 9)
+        self.assertNotIn(os.path.join(directory, f"{base}.2026-10-18.10.gz"), expired)
+        self.assertNotIn(os.path.join(directory, f"{base}.2026-10-18.9.gz"), expired)
+
+    def test_dropped_records_counted_and_reported(self):
+        handler = BackgroundHandler(["file"], maxsize=2)
+        # no listener thread, the test reads the queue
+        handler.queue = queue.Queue(2)
+        handler._pid = os.getpid()
+
+        def dropped():
+            counters = {name: value for name, labels, value in metrics.snapshot()["counters"]}
+            return counters.get("payments_log_records_dropped_total", 0)
+
+        before = dropped()
+
+        for _ in range(3):
+            handler.emit(self.record())
+
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(dropped(), before + 1)
+
+        handler.queue.get_nowait()
+        handler.queue.get_nowait()
+        handler.emit(self.record())
+
+        handler.queue.get_nowait()
+        warning = handler.queue.get_nowait()
+        self.assertEqual(warning.levelno, logging.WARNING)
+        self.assertEqual(warning.getMessage(), "Dropped 1 log records, the log queue was full")
+        self.assertEqual(handler.reported, 1)
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.dir = directory.name
+        override = self.settings(PAYMENTS_METRICS_DIR=self.dir, PAYMENTS_METRICS_TOKEN="")
+        override.enable()
+        self.addCleanup(override.disable)
+
+        app_cache.clear()
+        recent_c2b_receipts.clear()
+
+    def value(self, kind, name, **labels):
+        for entry_name, entry_labels, value in collect().snapshot()[kind]:
+            if entry_name == name and entry_labels == labels:
+                return value
+        return 0 if kind == "counters" else {"count": 0, "sum": 0}
+
+    def test_request_latency_status_and_queries(self):
+        route = {"route": "api/mpesa/c2b/confirmation/"}
+        responses = self.value("counters", "payments_http_responses_total", method="POST", status=200, **route)
+        queries = self.value("histograms", "payments_db_queries_per_request", **route)
+
+        self.client.post(
+            "/api/mpesa/c2b/confirmation/",
+            {"TransID": "MTR001", "MSISDN": "254700000000", "TransAmount": "10.00", "BillRefNumber": "A"},
+            content_type="application/json",
+        )
+
+        self.assertEqual(
+            self.value("counters", "payments_http_responses_total", method="POST", status=200, **route),
+            responses + 1,
+        )
+        after = self.value("histograms", "payments_db_queries_per_request", **route)
+        self.assertEqual(after["count"], queries["count"] + 1)
+        self.assertGreater(after["sum"], queries["sum"])
+
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn("# TYPE payments_http_request_duration_seconds histogram", body)
+        self.assertIn(
+            'payments_http_request_duration_seconds_bucket{method="POST",route="api/mpesa/c2b/confirmation/",le="+Inf"}',
+            body,
+        )
+
+    def test_exited_processes_are_archived(self):
+        dead = Metrics()
+        dead.inc("payments_daraja_errors_total", {"operation": "stk_push"}, 3)
+
+        # no process has this pid
+        with open(os.path.join(self.dir, "4194305-deadbeef.json"), "w") as f:
+            json.dump(dead.snapshot(), f)
+
+        labels = {"operation": "stk_push"}
+        first = self.value("counters", "payments_daraja_errors_total", **labels)
+
+        self.assertNotIn("4194305-deadbeef.json", os.listdir(self.dir))
+        self.assertIn("archive.json", os.listdir(self.dir))
+        self.assertEqual(self.value("counters", "payments_daraja_errors_total", **labels), first)
+        self.assertGreaterEqual(first, 3)
+
+    @mock.patch.object(DarajaService, "get_access_token", return_value="token")
+    def test_daraja_timeouts_counted(self, get_access_token):
+        service = DarajaService()
+        labels = {"operation": "stk_query"}
+        before = self.value("counters", "payments_daraja_timeouts_total", **labels)
+
+        with mock.patch.object(service.session, "post", side_effect=requests.Timeout("read timed out")):
+            response = service.stk_query("ws_CO_slow")
+
+        self.assertEqual(response["error"], "Daraja request failed")
+        self.assertEqual(self.value("counters", "payments_daraja_timeouts_total", **labels), before + 1)
+
+    def test_token_required_when_set(self):
+        with self.settings(PAYMENTS_METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+
+
+class BenchmarkTests(TestCase):
+
+    def setUp(self):
+        self.stub = StubDaraja().start()
+        self.addCleanup(self.stub.stop)
+
+    def test_daraja_service_against_stub(self):
+        with self.settings(MPESA_BASE_URL=self.stub.url):
+            response = DarajaService().stk_push("254700000000", 1, "ORDER1", "test")
+
+        self.assertEqual(response["ResponseCode"], "0")
+        self.assertTrue(response["CheckoutRequestID"].startswith("ws_CO_"))
+        self.assertEqual(self.stub.requests["/oauth/v1/generate"], 1)
+
+        self.stub.error_rate = 1
+
+        with self.settings(MPESA_BASE_URL=self.stub.url):
+            response = DarajaService().stk_query(response["CheckoutRequestID"])
+
+        self.assertEqual(response["errorMessage"], "Stub error")
+
+    def test_compare_flags_regressions(self):
+        runner = LoadRunner(self.stub.url, concurrency=4)
+        self.addCleanup(runner.shutdown)
+
+        stats = runner.run(lambda i: ("GET", "/oauth/v1/generate", {}), rate=50, duration=0.2)
+
+        self.assertEqual(stats["requests"], 10)
+        self.assertEqual(stats["statuses"], {"200": 10})
+
+        baseline = {"scenarios": {"verify": dict(stats, queries_per_request=1.0)}}
+        slower = dict(
+            stats,
+            latency_ms=dict(stats["latency_ms"], p95=stats["latency_ms"]["p95"] * 2 + 1),
+            queries_per_request=3.0,
+        )
+
+        self.assertEqual(compare(baseline, baseline, 0.2), [])
+        regressions = compare(baseline, {"scenarios": {"verify": slower}}, 0.2)
+        self.assertEqual(len(regressions), 2)
+
+
+class CallbackReplayTests(TestCase):
+
+    STK_BODY = {"Body": {"stkCallback": {
+        "MerchantRequestID": "29115-34620561-1",
+        "CheckoutRequestID": "ws_CO_191220191020363925",
+        "ResultCode": 0,
+        "ResultDesc": "The service request is processed successfully.",
+        "CallbackMetadata": {"Item": [
+            {"Name": "Amount", "Value": 10},
+            {"Name": "MpesaReceiptNumber", "Value": "NLJ7RT61SV"},
+            {"Name": "PhoneNumber", "Value": 254708374149},
+        ]},
+    }}}
+
+    C2B_BODY = {
+        "TransID": "RKTQDM7W6S",
+        "TransAmount": "10.00",
+        "MSISDN": "254708374149",
+        "BillRefNumber": "254708374149",
+        "FirstName": "JOHN",
+        "LastName": "DOE",
+    }
+
+    def test_reads_every_log_format_in_time_order(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        old = os.path.join(directory.name, "payments.log.2026-02-28.gz")
+        with gzip.open(old, "wt") as f:
+            f.write(f"2026-02-28 10:00:00,000 | INFO | payments | STK Callback Received: {self.STK_BODY!r}\n")
+            f.write("2026-02-28 10:00:01,000 | INFO | payments | Payment SUCCESS: NLJ7RT61SV\n")
+
+        current = os.path.join(directory.name, "payments.log")
+        with open(current, "w") as f:
+            f.write(json.dumps({
+                "ts": "2026-02-28T10:00:00.500",
+                "level": "INFO",
+                "msg": f"C2B CONFIRMATION RECEIVED: {self.C2B_BODY!r}",
+            }) + "\n")
+
+        events = list(events_from_logs([current, old]))
+
+        self.assertEqual([event.kind for event in events], ["stk", "c2b"])
+        self.assertEqual(events[0].body, self.STK_BODY)
+        self.assertEqual((events[1].at - events[0].at).total_seconds(), 0.5)
+
+    def test_anonymized_consistently(self):
+        anonymizer = Anonymizer("salt")
+
+        stk = anonymizer.anonymize(CallbackEvent(None, "stk", self.STK_BODY)).body
+        c2b = anonymizer.anonymize(CallbackEvent(None, "c2b", self.C2B_BODY)).body
+
+        items = {item["Name"]: item["Value"] for item in stk["Body"]["stkCallback"]["CallbackMetadata"]["Item"]}
+
+        # the same phone maps to the same pseudonym, in its original type
+        self.assertEqual(str(items["PhoneNumber"]), c2b["MSISDN"])
+        self.assertNotEqual(c2b["MSISDN"], self.C2B_BODY["MSISDN"])
+        self.assertTrue(c2b["MSISDN"].startswith("254") and len(c2b["MSISDN"]) == 12)
+
+        self.assertRegex(items["MpesaReceiptNumber"], r"^[A-Z0-9]{10}$")
+        self.assertNotEqual(items["MpesaReceiptNumber"], "NLJ7RT61SV")
+        self.assertNotIn("ws_CO_191220191020363925", json.dumps(stk))
+        self.assertEqual(c2b["FirstName"], "Customer")
+
+        self.assertEqual(Anonymizer("salt").anonymize(CallbackEvent(None, "c2b", self.C2B_BODY)).body, c2b)
+        self.assertNotEqual(Anonymizer("other").receipt("RKTQDM7W6S"), c2b["TransID"])
+
+        # left unchanged
+        self.assertEqual(self.STK_BODY["Body"]["stkCallback"]["CallbackMetadata"]["Item"][1]["Value"], "NLJ7RT61SV")
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite tuning")
+class SqliteTuningTests(TestCase):
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_pragmas_applied_on_connect(self):
+        self.assertEqual(self.pragma("journal_mode"), "wal")
+        self.assertEqual(self.pragma("synchronous"), 1)  # NORMAL
+        self.assertGreater(self.pragma("busy_timeout"), 0)
+        self.assertGreater(self.pragma("mmap_size"), 0)
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"])
+class ReplicaRoutingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.app = ExternalApp.objects.create(name="shop")
+        cls.other_app = ExternalApp.objects.create(name="other")
+        cls.admin_app = ExternalApp.objects.create(name="ADMIN_SHOP")
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.unpin()
+        # ids are reused once a test's rows are rolled back
+        self.addCleanup(self.unpin)
+
+    def unpin(self):
+        caches[settings.PAYMENTS_DB_PIN_CACHE_ALIAS].delete_many(
+            [PIN_KEY % app.id for app in (self.app, self.other_app, self.admin_app)]
+        )
+
+    def test_only_replica_blocks_read_from_replicas(self):
+        self.assertIsNone(self.router.db_for_read(Payment))
+
+        with replica_reads(self.app):
+            self.assertEqual(self.router.db_for_read(Payment), "replica1")
+            self.assertEqual(self.router.db_for_write(Payment), "default")
+            # reads its own write
+            self.assertEqual(self.router.db_for_read(Payment), "default")
+
+        self.assertFalse(self.router.allow_migrate("replica1", "payments"))
+        self.assertIsNone(self.router.allow_migrate("default", "payments"))
+
+    def test_pinned_app_reads_from_primary(self):
+        pin_to_primary([self.app.id, None])
+
+        with replica_reads(self.app):
+            self.assertEqual(self.router.db_for_read(Payment), "default")
+
+        with replica_reads(self.other_app):
+            self.assertEqual(self.router.db_for_read(Payment), "replica1")
+
+    def test_claim_pins_app(self):
+        Payment.objects.create(
+            app=self.admin_app,
+            phone_number="254700000000",
+            amount=10,
+            mpesa_receipt_number="PIN001",
+            status="SUCCESS",
+        )
+
+        self.assertEqual(claim_payment(self.app, self.admin_app, receipt="PIN001")[0], CLAIMED)
+
+        self.assertTrue(is_pinned(self.app.id))
+        self.assertFalse(is_pinned(self.other_app.id))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        pin_to_primary([self.app.id])
+
+        self.assertFalse(is_pinned(self.app.id))
+
+        with replica_reads(self.app):
+            self.assertEqual(self.router.db_for_read(Payment), "default")
+
+
+class ReplicaReadsTests(TransactionTestCase):
+    """
+    Reads go through the first DB_REPLICAS alias, or without one through a
+    second connection to the test database standing in for a replica.
+    """
+
+    MIRROR = "replica_mirror"
+
+    databases = {"default", *settings.DATABASE_REPLICAS}
+
+    @classmethod
+    def setUpClass(cls):
+        if not settings.DATABASE_REPLICAS:
+            # like a DB_REPLICAS alias, see settings.py
+            mirror = copy.deepcopy(connections["default"].settings_dict)
+            mirror["TEST"] = {"MIRROR": "default"}
+            connections.settings[cls.MIRROR] = mirror
+            cls.databases = {"default", cls.MIRROR}
+            cls.addClassCleanup(cls.remove_mirror)
+
+        super().setUpClass()
+
+    @classmethod
+    def remove_mirror(cls):
+        connections[cls.MIRROR].close()
+        del connections[cls.MIRROR]
+        del connections.settings[cls.MIRROR]
+
+    def setUp(self):
+        app_cache.clear()
+        self.replica = (settings.DATABASE_REPLICAS or [self.MIRROR])[0]
+
+        replicas = self.settings(DATABASE_REPLICAS=[self.replica])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+        self.app = ExternalApp.objects.create(name="shop")
+        ExternalApp.objects.create(name="ADMIN_SHOP")
+
+        pins = caches[settings.PAYMENTS_DB_PIN_CACHE_ALIAS]
+        pins.delete(PIN_KEY % self.app.id)
+        self.addCleanup(pins.delete, PIN_KEY % self.app.id)
+
+        Payment.objects.create(
+            app=self.app,
+            phone_number="254700000000",
+            amount=10,
+            mpesa_receipt_number="REP001",
+            status="SUCCESS",
+        )
+
+    def verify(self):
+        with CaptureQueriesContext(connections[self.replica]) as replica_queries:
+            response = self.client.get(
+                "/api/payments/verify/",
+                {"receipt": "REP001"},
+                HTTP_X_API_KEY=self.app.api_key,
+            )
+
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(replica_queries)
+
+    def test_verify_reads_replica_until_app_writes(self):
+        body, replica_queries = self.verify()
+        self.assertTrue(body["paid"])
+        self.assertFalse(body["claimed"])
+        self.assertEqual(replica_queries, 1)
+
+        response = self.client.post(
+            "/api/payments/claim/",
+            {"receipt": "REP001"},
+            content_type="application/json",
+            HTTP_X_API_KEY=self.app.api_key,
+        )
+        self.assertEqual(response.status_code, 200)
+
+        body, replica_queries = self.verify()
+        self.assertTrue(body["claimed"])
+        self.assertEqual(replica_queries, 0)
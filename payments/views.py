@@ -1,3 +1,24 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+
+from payments.services.metrics import collect, render
+
+
+@require_GET
+def metrics(request):
+    """
+    Prometheus scrape endpoint, summed over every process on this host.
+    Needs ``Authorization: Bearer <PAYMENTS_METRICS_TOKEN>`` when the
+    token is set.
+    """
+    token = settings.PAYMENTS_METRICS_TOKEN
+
+    if token:
+        expected = f"Bearer {token}"
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            return HttpResponse(status=401)
+
+    return HttpResponse(render(collect()), content_type="text/plain; version=0.0.4; charset=utf-8")